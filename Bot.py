@@ -1,17 +1,32 @@
 # Bot.py
 from telegram.ext import (
     Updater, CommandHandler, MessageHandler, Filters,
-    ConversationHandler, CallbackQueryHandler
+    ConversationHandler, CallbackQueryHandler, TypeHandler, ExtBot, JobQueue
 )
-from telegram import ReplyKeyboardRemove
+from telegram import Update, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.utils.request import Request
 import logging
+from queue import Queue
 import re
-from datetime import datetime
-import json
+from datetime import date
+import csv
+import io
+import tempfile
 
 import db
+import memory
+import metrics
 import scheduler
-from config import TELEGRAM_TOKEN, DEFAULT_TZ
+import throttle
+from executor import OrderedDispatcher
+from persistence import SQLitePersistence, PersistentConversationHandler
+from config import (
+    require_token, TELEGRAM_API_URL, DEFAULT_TZ, PROGRESS_MAX_DAYS, BOT_MODE, DISPATCHER_WORKERS,
+    WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_URL, WEBHOOK_MAX_CONNECTIONS,
+    HANDLER_LANES, HANDLER_QUEUE_SIZE, METRICS_PORT, METRICS_ADDR,
+    THROTTLE_RATE, THROTTLE_BURST, THROTTLE_MAX_PENDING, THROTTLE_CALLBACK_WINDOW,
+    CONVERSATION_TIMEOUT, USER_DATA_TTL, MEMORY_SWEEP_INTERVAL, LEADER_ELECTION,
+)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -21,6 +36,12 @@ MED_NAME, MED_DOSE, MED_TIMES = range(3)
 EX_NAME, EX_QTY = range(3, 5)
 DEL_MED, DEL_EX = range(5, 7)
 
+# Entries per page in the delete lists
+PAGE_SIZE = 10
+
+# user_data keys the conversations fill in; dropped whenever a conversation ends
+FLOW_KEYS = ("med_name", "med_dose", "ex_name")
+
 # Helpers
 def parse_times_input(text):
     """
@@ -81,6 +102,7 @@ def parse_quantity_input(text):
     raise ValueError("Couldn't parse quantity")
 
 # ---------------- Handlers ----------------
+@metrics.handler
 def start(update, context):
     user = update.effective_user
     db.add_user(user.id, user.username)
@@ -91,25 +113,31 @@ def start(update, context):
         "/log_exercise - log exercise routine in the format (name → minutes) and track your self progress\n"
         "/delete_medicine - cancel future reminders for a medicine\n"
         "/delete_exercise - delete a logged exercise entry\n"
-        "/progress - simple weekly summary of medicine intake and exercise routine.\n"
+        "/progress - simple weekly summary of medicine intake and exercise routine (/progress 30 for a longer period).\n"
+        "/missed - doses from the last week you missed or never answered\n"
+        "/export - download your full history as a CSV file\n"
     )
 
 # ---- Medicine flow ----
+@metrics.handler
 def add_med_start(update, context):
     update.message.reply_text("Medicine name? (e.g., Paracetamol)")
     return MED_NAME
 
+@metrics.handler
 def add_med_dose(update, context):
     context.user_data['med_name'] = update.message.text.strip()
     update.message.reply_text("Dose? (e.g., 500 mg or 1 tablet)")
     return MED_DOSE
 
+@metrics.handler
 def med_ask_times(update, context):
     context.user_data['med_dose'] = update.message.text.strip()
     update.message.reply_text("Suggest time for the reminder as comma-separated. e.g., 09:00, 21:00 or 9am, 9pm")
     return MED_TIMES
 
 
+@metrics.handler
 def add_med_times(update, context):
     user_input = update.message.text.strip()
     try:
@@ -123,23 +151,23 @@ def add_med_times(update, context):
     med_dose = context.user_data.get('med_dose', '').strip()
 
     med_id = db.add_medicine(user_id, med_name, med_dose, times)
-
-    med_row = db.get_medicine(med_id)
-    if med_row:
-        scheduler.schedule_med_jobs_for_med(med_row)
+    scheduler.reschedule_med(med_id)
 
     update.message.reply_text(f"Saved medicine #{med_id}: {med_name} ({med_dose}) at {', '.join(times)} daily ✅ .")
-    return ConversationHandler.END
+    return _end(context)
 
+@metrics.handler
 def ex_start(update, context):
     update.message.reply_text("What exercise did you do? (e.g., cycling, pushups)")
     return EX_NAME
 
+@metrics.handler
 def ex_qty(update, context):
     context.user_data['ex_name'] = update.message.text.strip().lower()
     update.message.reply_text("Duration of the exercise today? (e.g., 45 or 45 mins)")
     return EX_QTY
 
+@metrics.handler
 def ex_save(update, context):
     user_input = update.message.text.strip()
     try:
@@ -157,23 +185,37 @@ def ex_save(update, context):
 
     db.add_exercise(user_id, stored_name, minutes)
     update.message.reply_text(f"✅ Logged {int(qty)} {unit} for {name} today. (You can log as many times for the same exercise or different exercise as you wish)")
-    return ConversationHandler.END
-
+    return _end(context)
+
+def _pager(kind, page):
+    """Older/Newer buttons carrying the keyset cursor of the neighbouring page."""
+    buttons = []
+    if page.older:
+        buttons.append(InlineKeyboardButton("⬅️ Older", callback_data="|".join(["PG", kind, "o", *map(str, page.older)])))
+    if page.newer:
+        buttons.append(InlineKeyboardButton("Newer ➡️", callback_data="|".join(["PG", kind, "n", *map(str, page.newer)])))
+    return InlineKeyboardMarkup([buttons]) if buttons else None
+
+def _medicine_page(user_id, before=None, after=None):
+    page = db.medicines_page(user_id, before=before, after=after, limit=PAGE_SIZE)
+    lines = [f"{m.med_id}) {m.name} ({m.dose}) — times: {', '.join(m.times)}" for m in page.rows]
+    return page, "Reply with the medicine ID to cancel future reminders:\n\n" + "\n".join(lines)
+
+def _exercise_page(user_id, before=None, after=None):
+    page = db.exercises_page(user_id, before=before, after=after, limit=PAGE_SIZE)
+    lines = [f"{r['id']}) {r['date']} — {int(r['minutes'])} mins {r['name']}" for r in page.rows]
+    return page, "Reply with the entry ID to delete:\n\n" + "\n".join(lines)
+
+@metrics.handler
 def delete_med_start(update, context):
-    meds = db.list_medicines(update.effective_user.id)
-    if not meds:
+    page, text = _medicine_page(update.effective_user.id)
+    if not page.rows:
         update.message.reply_text("You have no active medicines.")
         return ConversationHandler.END
-    lines = []
-    for m in meds:
-        try:
-            times = json.loads(m['times'] or "[]")
-        except Exception:
-            times = [m['times']]
-        lines.append(f"{m['med_id']}) {m['name']} ({m['dose']}) — times: {', '.join(times)}")
-    update.message.reply_text("Reply with the medicine ID to cancel future reminders:\n\n" + "\n".join(lines))
+    update.message.reply_text(text, reply_markup=_pager("med", page))
     return DEL_MED
 
+@metrics.handler
 def delete_med_confirm(update, context):
     s = update.message.text.strip()
     try:
@@ -182,23 +224,22 @@ def delete_med_confirm(update, context):
         update.message.reply_text("Please reply with a numeric medicine ID.")
         return DEL_MED
     user_id = update.effective_user.id
-    # remove scheduled jobs
-    scheduler.remove_med_jobs(med_id)
     db.delete_medicine(med_id, user_id)
+    # drops the scheduled jobs only if the medicine (owned by this user) is gone
+    scheduler.reschedule_med(med_id)
     update.message.reply_text(f"Cancelled future reminders for medicine #{med_id} ✅. ")
     return ConversationHandler.END
 
+@metrics.handler
 def delete_ex_start(update, context):
-    rows = db.list_recent_exercises(update.effective_user.id)
-    if not rows:
+    page, text = _exercise_page(update.effective_user.id)
+    if not page.rows:
         update.message.reply_text("No exercise entries found.")
         return ConversationHandler.END
-    lines = []
-    for r in rows[:20]:
-        lines.append(f"{r['id']}) {r['date']} — {int(r['minutes'])} mins {r['name']}")
-    update.message.reply_text("Reply with the entry ID to delete:\n\n" + "\n".join(lines))
+    update.message.reply_text(text, reply_markup=_pager("ex", page))
     return DEL_EX
 
+@metrics.handler
 def delete_ex_confirm(update, context):
     s = update.message.text.strip()
     try:
@@ -212,9 +253,45 @@ def delete_ex_confirm(update, context):
     return ConversationHandler.END
 
 
-def on_callback(update, context):
+def _edit_later(q, text, **kwargs):
+    """Replace a reminder's text from the delivery workers instead of this handler lane."""
+    if q.message is None:
+        q.edit_message_text(text, **kwargs)
+    else:
+        scheduler.delivery.submit_edit(q.message.chat_id, q.message.message_id, text, **kwargs)
+
+@metrics.handler
+def on_page(update, context):
+    """Older/Newer buttons under the delete lists: PG|<ex|med>|<o|n>|<cursor...>"""
     q = update.callback_query
     q.answer()
+    try:
+        _, kind, direction, *cursor = q.data.split("|")
+        if kind == "ex":
+            cursor = (cursor[0], int(cursor[1]))
+            render = _exercise_page
+        elif kind == "med":
+            cursor = (int(cursor[0]),)
+            render = _medicine_page
+        else:
+            raise ValueError(f"unknown list {kind!r}")
+        if direction == "o":
+            page, text = render(q.from_user.id, before=cursor)
+        else:
+            page, text = render(q.from_user.id, after=cursor)
+        if not page.rows:
+            page, text = render(q.from_user.id)  # entries around the cursor were deleted; start over
+        if not page.rows:
+            text = "Nothing left in this list."
+        _edit_later(q, text, reply_markup=_pager(kind, page))
+    except Exception:
+        logger.exception("page callback error")
+        _edit_later(q, "Error processing button. Try again.")
+
+@metrics.handler
+def on_callback(update, context):
+    q = update.callback_query
+    q.answer()  # stop the button spinner before doing anything else
     data = q.data  
     try:
         parts = data.split("|")
@@ -222,100 +299,240 @@ def on_callback(update, context):
             med_id = int(parts[1])
             sched_short = parts[2]
             status = parts[3]
+            if status not in ("taken", "missed"):
+                raise ValueError(f"unknown status {status!r}")
             user_id = q.from_user.id
+            # idempotent per (med_id, scheduled time); queued on the write-behind writer
             db.log_med_status(med_id, user_id, sched_short, status)
-            q.edit_message_text(f"Logged: {status.upper()} ✅")
+            _edit_later(q, f"Logged: {status.upper()} ✅")
         elif parts[0] == "EX":
             action = parts[3]
             if action == "done":
-                q.edit_message_text("Great! keep going on the fitness streak 🎯💪")
+                _edit_later(q, "Great! keep going on the fitness streak 🎯💪")
             else:
-                q.edit_message_text("No worries! Try a short session later — even 10 minutes helps. Remember, any amount of physical activity is better than none 💪")
+                _edit_later(q, "No worries! Try a short session later — even 10 minutes helps. Remember, any amount of physical activity is better than none 💪")
         else:
-            q.edit_message_text("Unknown callback")
+            _edit_later(q, "Unknown callback")
     except Exception:
         logger.exception("callback error")
-        q.edit_message_text("Error processing button. Try again.")
+        _edit_later(q, "Error processing button. Try again.")
 
+@metrics.handler
 def progress(update, context):
     user_id = update.effective_user.id
-    days = db.days_exercised_last_7_days(user_id)
-    total_minutes = db.total_minutes_last_7_days(user_id)
-    most_common = db.most_common_activity_last_7_days(user_id) or "—"
-    taken = db.taken_count_last_7_days(user_id)
-    expected = db.expected_doses_last_7_days(user_id)
-    pct = int((taken * 100 / expected)) if expected else 0
+    days = 7
+    if context.args:
+        try:
+            days = int(context.args[0])
+        except ValueError:
+            days = 0
+        if not 1 <= days <= PROGRESS_MAX_DAYS:
+            update.message.reply_text(f"Usage: /progress [days], e.g. /progress 30 (1-{PROGRESS_MAX_DAYS}).")
+            return
+    summary = db.progress_summary(user_id, days)
+    streaks = db.streaks(user_id, PROGRESS_MAX_DAYS)
+    per_med = "".join(f"   – {r['name']}: {r['taken']}/{r['expected']} taken, {r['missed']} missed\n"
+                      for r in db.medicine_adherence(user_id, days))
+    since = db.ledger_start(days)
+    if per_med and since > db.window_start(days):
+        per_med = f"   per medicine, since {since}:\n" + per_med
     update.message.reply_text(
-        f"📊 Last 7 days summary:\n"
-        f"• Exercise days: {days}\n"
-        f"• Total minutes: {total_minutes}\n"
-        f"• Most common activity: {most_common}\n"
-        f"• Medicine adherence: {taken}/{expected} ({pct}%)"
+        f"📊 Last {days} days summary:\n"
+        f"• Exercise days: {summary.exercise_days}\n"
+        f"• Total minutes: {summary.total_minutes}\n"
+        f"• Most common activity: {summary.most_common or '—'}\n"
+        f"• Medicine adherence: {summary.taken}/{summary.expected} ({summary.adherence_pct}%)\n"
+        f"{per_med}"
+        f"🔥 Exercise streak: {streaks.exercise_current} days (best {streaks.exercise_best})\n"
+        f"💊 Medicine streak: {streaks.meds_current} days (best {streaks.meds_best})"
     )
 
+@metrics.handler
+def missed(update, context):
+    rows = db.missed_doses(update.effective_user.id, 7)
+    if not rows:
+        update.message.reply_text("No missed doses in the last 7 days 🎉")
+        return
+    lines = [f"• {r['name']} ({r['dose'] or '—'}) at {r['due_at'][8:10]}:{r['due_at'][10:12]} on {r['day']}"
+             f"{'' if r['status'] else ' — not answered'}" for r in rows]
+    update.message.reply_text("💊 Missed doses, last 7 days:\n" + "\n".join(lines))
+
+@metrics.handler
+def export(update, context):
+    """Send the user's history as a CSV document, written batch by batch to a temp file."""
+    n = 0
+    with tempfile.TemporaryFile() as tmp:
+        out = io.TextIOWrapper(tmp, encoding="utf-8", newline="")
+        writer = csv.writer(out)
+        writer.writerow(db.HISTORY_COLUMNS)
+        for rows in db.iter_user_history(update.effective_user.id):
+            writer.writerows(rows)
+            n += len(rows)
+        out.detach()  # flushes; tmp stays open for the upload
+        if not n:
+            update.message.reply_text("Nothing to export yet — log a medicine or an exercise first.")
+            return
+        tmp.seek(0)
+        update.message.reply_document(document=tmp, filename=f"healthally-history-{date.today().isoformat()}.csv",
+                                      caption=f"📄 {n} entries")
+
+@metrics.handler
 def cancel(update, context):
     update.message.reply_text("Cancelled.", reply_markup=ReplyKeyboardRemove())
+    return _end(context)
+
+def _end(context):
+    for key in FLOW_KEYS:
+        context.user_data.pop(key, None)
     return ConversationHandler.END
 
+def conversation_timeout(update, context):
+    """Runs on the job queue when a conversation sat idle for CONVERSATION_TIMEOUT seconds."""
+    _end(context)
+    # no update is being handled, so nothing else writes the cleared user_data back
+    context.dispatcher.persistence.update_user_data(update.effective_user.id, context.user_data)
+
+def sweep_state(context):
+    """Evict idle users' user_data, drop chat_data nobody uses, and report what is left."""
+    dp = context.dispatcher
+    evicted = dp.persistence.evict_idle(USER_DATA_TTL) if USER_DATA_TTL > 0 else 0
+    for chat_id, data in list(dp.chat_data.items()):
+        if not data:
+            dp.chat_data.pop(chat_id, None)  # created empty for every chat by CallbackContext
+    state = memory.report(dp)
+    logger.info("memory: evicted user_data of %d idle users; %s", evicted,
+                ", ".join(f"{k}={n} ({size // 1024} KiB)" for k, (n, size) in sorted(state.items())))
+
+class LocalWebhookUpdater(Updater):
+    """Serves the webhook endpoint without registering it with Telegram (WEBHOOK_URL unset),
+    so recorded updates can be POSTed to it locally."""
+
+    def _bootstrap(self, *args, **kwargs):
+        logger.info("WEBHOOK_URL not set: serving on /%s without calling setWebhook", WEBHOOK_PATH)
+
+def build_updater():
+    """Updater whose dispatcher runs handlers on per-user ordered worker lanes."""
+    # connections: one per lane and async worker, plus updater, job queue and main thread
+    bot = ExtBot(require_token(), base_url=TELEGRAM_API_URL or None,
+                 request=Request(con_pool_size=HANDLER_LANES + DISPATCHER_WORKERS + 4))
+    job_queue = JobQueue()
+    dispatcher = OrderedDispatcher(bot, Queue(), workers=DISPATCHER_WORKERS, job_queue=job_queue,
+                                   persistence=SQLitePersistence(CONVERSATION_TIMEOUT, shared=LEADER_ELECTION),
+                                   lanes=HANDLER_LANES, lane_queue_size=HANDLER_QUEUE_SIZE)
+    job_queue.set_dispatcher(dispatcher)
+    metrics.Callback("healthbot_update_queue_depth", "Updates received but not yet routed to a lane.",
+                     dispatcher.update_queue.qsize)
+    metrics.Callback("healthbot_handler_lane_depth", "Updates waiting on handler lanes.", dispatcher.executor.depth)
+    metrics.Callback("healthbot_handler_lane_blocked_total", "Submissions that waited for a full lane.",
+                     lambda: dispatcher.executor.blocked_submits, kind="counter")
+    updater_cls = LocalWebhookUpdater if BOT_MODE == "webhook" and not WEBHOOK_URL else Updater
+    return updater_cls(dispatcher=dispatcher, workers=None)
+
+def start_ingress(updater):
+    if BOT_MODE == "webhook":
+        kwargs = {}
+        if WEBHOOK_URL:
+            kwargs["webhook_url"] = f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}"
+        updater.start_webhook(listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT, url_path=WEBHOOK_PATH,
+                              max_connections=WEBHOOK_MAX_CONNECTIONS, **kwargs)
+        logger.info("Receiving updates via webhook on %s:%s", WEBHOOK_LISTEN, WEBHOOK_PORT)
+    else:
+        updater.start_polling()
+
 def main():
+    if METRICS_PORT:
+        metrics.start_http_server(METRICS_PORT, METRICS_ADDR)
     db.init_db()
+    scheduler.start()
     # schedule existing meds & daily exercise reminder
     try:
         scheduler.schedule_all_meds_for_all_users()
         scheduler.schedule_daily_exercise()
+        scheduler.schedule_maintenance()
     except Exception:
         logger.exception("Scheduling startup jobs failed (check scheduler).")
+    scheduler.start_leader_election()
 
-    updater = Updater(TELEGRAM_TOKEN, use_context=True)
+    updater = build_updater()
     dp = updater.dispatcher
 
-    dp.add_handler(CommandHandler("start", start))
+    # flood control drops updates before they are queued on a handler lane
+    flood = throttle.Throttle(THROTTLE_RATE, THROTTLE_BURST, THROTTLE_MAX_PENDING, THROTTLE_CALLBACK_WINDOW,
+                              depth=dp.executor.depth,
+                              answer=lambda q: scheduler.delivery.submit_answer(q.from_user.id, q.id))
+    dp.admit = flood.admit
+    metrics.Callback("healthbot_throttle_users", "Users with a partly used flood-control bucket.", lambda: len(flood))
 
+    dp.add_handler(CommandHandler("start", start))
 
+    # abandoned conversations end after CONVERSATION_TIMEOUT idle seconds
+    timeout = CONVERSATION_TIMEOUT or None
+    on_timeout = TypeHandler(Update, conversation_timeout)
 
     # add medicine conversation
-    dp.add_handler(ConversationHandler(
+    dp.add_handler(PersistentConversationHandler(
+        name="add_medicine", persistent=True,
         entry_points=[CommandHandler("add_medicine", add_med_start)],
         states={
             MED_NAME: [MessageHandler(Filters.text & ~Filters.command, add_med_dose)],
             MED_DOSE: [MessageHandler(Filters.text & ~Filters.command, med_ask_times)],
             MED_TIMES: [MessageHandler(Filters.text & ~Filters.command, add_med_times)],
+            ConversationHandler.TIMEOUT: [on_timeout],
         },
-        fallbacks=[CommandHandler("cancel", cancel)]
+        fallbacks=[CommandHandler("cancel", cancel)],
+        conversation_timeout=timeout,
     ))
 
     # log exercise conversation
-    dp.add_handler(ConversationHandler(
+    dp.add_handler(PersistentConversationHandler(
+        name="log_exercise", persistent=True,
         entry_points=[CommandHandler("log_exercise", ex_start)],
         states={
             EX_NAME: [MessageHandler(Filters.text & ~Filters.command, ex_qty)],
             EX_QTY: [MessageHandler(Filters.text & ~Filters.command, ex_save)],
+            ConversationHandler.TIMEOUT: [on_timeout],
         },
-        fallbacks=[CommandHandler("cancel", cancel)]
+        fallbacks=[CommandHandler("cancel", cancel)],
+        conversation_timeout=timeout,
     ))
 
     # delete medicine
-    dp.add_handler(ConversationHandler(
+    dp.add_handler(PersistentConversationHandler(
+        name="delete_medicine", persistent=True,
         entry_points=[CommandHandler("delete_medicine", delete_med_start)],
         states={DEL_MED: [MessageHandler(Filters.text & ~Filters.command, delete_med_confirm)]},
-        fallbacks=[CommandHandler("cancel", cancel)]
+        fallbacks=[CommandHandler("cancel", cancel)],
+        conversation_timeout=timeout,
     ))
 
     # delete exercise
-    dp.add_handler(ConversationHandler(
+    dp.add_handler(PersistentConversationHandler(
+        name="delete_exercise", persistent=True,
         entry_points=[CommandHandler("delete_exercise", delete_ex_start)],
         states={DEL_EX: [MessageHandler(Filters.text & ~Filters.command, delete_ex_confirm)]},
-        fallbacks=[CommandHandler("cancel", cancel)]
+        fallbacks=[CommandHandler("cancel", cancel)],
+        conversation_timeout=timeout,
     ))
 
-    # callback handler
+    # callback handlers; list paging first, everything else falls through to on_callback
+    dp.add_handler(CallbackQueryHandler(on_page, pattern=r"^PG\|"))
     dp.add_handler(CallbackQueryHandler(on_callback))
 
     # progress command
     dp.add_handler(CommandHandler("progress", progress))
+    dp.add_handler(CommandHandler("missed", missed))
+    dp.add_handler(CommandHandler("export", export))
+
+    if MEMORY_SWEEP_INTERVAL > 0:
+        dp.job_queue.run_repeating(sweep_state, interval=MEMORY_SWEEP_INTERVAL, first=MEMORY_SWEEP_INTERVAL,
+                                   name="sweep_state")
 
-    updater.start_polling()
+    start_ingress(updater)
     updater.idle()
+    logger.info("handler lanes: %s", updater.dispatcher.executor.stats())
+    scheduler.stop_leader_election()
+    scheduler.delivery.stop()
+    db.close_all()
 
 if __name__ == "__main__":
     main()
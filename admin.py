@@ -0,0 +1,284 @@
+"""Offline maintenance CLI; works on DB_NAME without starting the bot or needing a token.
+
+    python -m admin migrate
+    python -m admin export medicines --format jsonl --out medicines.jsonl.gz
+    python -m admin import exercises exercises.csv --on-conflict replace
+    python -m admin seed --rows 1000000 --days 60
+    python -m admin rebuild-rollups
+    python -m admin backfill-ledger --since 2024-01-01
+    python -m admin archive
+
+Exports stream from one cursor and imports go through executemany in chunked
+transactions, so memory use does not depend on table size.
+"""
+import argparse
+import csv
+import gzip
+import io
+import json
+import logging
+import sys
+import time
+
+import db
+from config import DB_NAME, RETENTION_DAYS, ARCHIVE_CHUNK_SIZE
+
+logger = logging.getLogger("admin")
+
+TABLES = ("users", "medicines", "exercises", "med_logs", "dose_instances")
+
+
+def _open(path, mode):
+    if path in (None, "-"):
+        return io.TextIOWrapper(sys.stdout.buffer if "w" in mode else sys.stdin.buffer, encoding="utf-8",
+                                newline="")
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", compresslevel=6, encoding="utf-8", newline="")
+    return open(path, mode, encoding="utf-8", newline="")
+
+
+def _format_of(path, fmt):
+    if fmt:
+        return fmt
+    name = (path or "").removesuffix(".gz")
+    return "jsonl" if name.endswith((".jsonl", ".json", ".ndjson")) else "csv"
+
+
+def _columns(table):
+    return [r["name"] for r in db.get_conn().execute(f"PRAGMA table_info({table})")]
+
+
+def export_table(table, out, fmt, chunk_size):
+    conn = db.get_conn()
+    columns = _columns(table)
+    cur = conn.execute(f"SELECT {', '.join(columns)} FROM {table} ORDER BY rowid")
+    n = 0
+    if fmt == "csv":
+        writer = csv.writer(out)
+        writer.writerow(columns)
+        for rows in db._iter_batches(cur, chunk_size):
+            writer.writerows(["" if v is None else v for v in row] for row in rows)
+            n += len(rows)
+    else:
+        for rows in db._iter_batches(cur, chunk_size):
+            out.writelines(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n" for row in rows)
+            n += len(rows)
+    return n
+
+
+def _read_rows(src, fmt, table_columns):
+    """(columns, row iterator) for a CSV stream with a header row, or a JSONL stream.
+
+    Only the columns present in the input are written; the rest keep their defaults.
+    """
+    if fmt == "csv":
+        reader = csv.reader(src)
+        columns = next(reader, [])
+        rows = (tuple(v if v != "" else None for v in rec) for rec in reader)
+    else:
+        lines = (line for line in src if line.strip())
+        first = next(lines, None)
+        if first is None:
+            return [], iter(())
+        columns = list(json.loads(first))
+
+        def rows_from_json():
+            for line in _prepend(first, lines):
+                rec = json.loads(line)
+                yield tuple(rec.get(c) for c in columns)
+        rows = rows_from_json()
+    unknown = set(columns) - set(table_columns)
+    if unknown:
+        raise SystemExit(f"unknown columns in input: {', '.join(sorted(unknown))}")
+    return columns, rows
+
+
+def import_table(table, src, fmt, chunk_size, on_conflict):
+    conn = db.get_conn()
+    columns, rows = _read_rows(src, fmt, _columns(table))
+    if not columns:
+        return 0
+    verb = "INSERT OR REPLACE" if on_conflict == "replace" else "INSERT OR IGNORE"
+    sql = f"{verb} INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+    after = None
+    if table == "medicines":
+        after = _medicine_times_sync(columns)
+    elif table == "med_logs":
+        after = _dose_ledger_sync(columns)
+    n = 0
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= chunk_size:
+            n += _insert_chunk(conn, sql, batch, after)
+            batch = []
+    if batch:
+        n += _insert_chunk(conn, sql, batch, after)
+    return n
+
+
+def _medicine_times_sync(columns):
+    """Re-derive medicine_times (the reminder slots) for imported medicines, in the chunk's transaction."""
+    if "med_id" not in columns:
+        # fresh med_ids: nothing stale to remove
+        def sync(conn, rows):
+            conn.execute("""
+              INSERT OR IGNORE INTO medicine_times (slot, med_id)
+              SELECT j.value, m.med_id FROM medicines m, json_each(COALESCE(m.times, '[]')) j
+            """)
+        return sync
+    i = columns.index("med_id")
+
+    def sync(conn, rows):
+        # a replaced row may have new times; its old slots must go
+        ids = [(row[i],) for row in rows]
+        conn.executemany("DELETE FROM medicine_times WHERE med_id=?", ids)
+        conn.executemany("""
+          INSERT OR IGNORE INTO medicine_times (slot, med_id)
+          SELECT j.value, m.med_id FROM medicines m, json_each(COALESCE(m.times, '[]')) j WHERE m.med_id=?
+        """, ids)
+    return sync
+
+
+def _dose_ledger_sync(columns):
+    """Copy imported med_logs answers onto the dose ledger (as migration 011 did), in the chunk's transaction."""
+    if "med_id" not in columns or "scheduled_time" not in columns:
+        return None  # without both, a row names no dose
+    i, j = columns.index("med_id"), columns.index("scheduled_time")
+
+    def sync(conn, rows):
+        conn.executemany(f"""
+          INSERT INTO dose_instances (med_id, user_id, due_at, day, status, answered_at)
+          SELECT med_id, user_id, scheduled_time, {db._DOSE_DAY_SQL}, status, logged_at FROM med_logs
+          WHERE med_id=? AND scheduled_time=? AND user_id IS NOT NULL AND status IN ('taken', 'missed')
+            AND scheduled_time GLOB '[0-9][0-9][0-9][0-9][0-9][0-9][0-9][0-9][0-9][0-9][0-9][0-9]'
+          ON CONFLICT(med_id, due_at) DO UPDATE SET status=excluded.status, answered_at=excluded.answered_at
+          WHERE dose_instances.user_id = excluded.user_id
+        """, [(row[i], row[j]) for row in rows])
+    return sync
+
+
+def _prepend(first, rest):
+    yield first
+    yield from rest
+
+
+def _insert_chunk(conn, sql, rows, after=None):
+    with conn:
+        conn.executemany(sql, rows)
+        if after is not None:
+            after(conn, rows)
+    return len(rows)
+
+
+def cmd_migrate(args):
+    before = db.schema_version()
+    db.init_db()
+    logger.info("%s: schema version %d -> %d", DB_NAME, before, db.schema_version())
+    db.enable_incremental_vacuum()
+
+
+def cmd_export(args):
+    db.init_db()
+    fmt = _format_of(args.out, args.format)
+    started = time.monotonic()
+    with _open(args.out, "w") as out:
+        n = export_table(args.table, out, fmt, args.chunk)
+        out.flush()
+    logger.info("exported %d %s rows as %s in %.1fs", n, args.table, fmt, time.monotonic() - started)
+
+
+def cmd_import(args):
+    db.init_db()
+    fmt = _format_of(args.file, args.format)
+    started = time.monotonic()
+    with _open(args.file, "r") as src:
+        n = import_table(args.table, src, fmt, args.chunk, args.on_conflict)
+    logger.info("imported %d %s rows in %.1fs", n, args.table, time.monotonic() - started)
+    if args.table in ("exercises", "med_logs", "medicines", "dose_instances") and not args.no_rollups:
+        cmd_rebuild_rollups(args)
+
+
+def cmd_seed(args):
+    from benchmarks.datagen import populate
+    db.init_db()
+    started = time.monotonic()
+    populate(args.rows, days=args.days, seed=args.seed)
+    logger.info("seeded %d rows per table in %.1fs", args.rows, time.monotonic() - started)
+
+
+def cmd_rebuild_rollups(args):
+    started = time.monotonic()
+    db.init_db()
+    db.rebuild_rollups()
+    logger.info("rollups rebuilt in %.1fs", time.monotonic() - started)
+
+
+def cmd_backfill_ledger(args):
+    started = time.monotonic()
+    db.init_db()
+    since = args.since or db.get_conn().execute("SELECT MIN(date(created_at)) FROM medicines").fetchone()[0]
+    if since is None:
+        return
+    n = db.backfill_dose_ledger(since)
+    logger.info("added %d estimated doses; ledger now starts %s (%.1fs)",
+                n, db.get_state(db.LEDGER_SINCE), time.monotonic() - started)
+
+
+def cmd_archive(args):
+    db.init_db()
+    db.archive_old_rows(args.days, ARCHIVE_CHUNK_SIZE)
+    logger.info("%d free pages left", db.incremental_vacuum(1 << 30))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m admin", description=__doc__.split("\n")[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    sub.add_parser("migrate", help="apply pending schema migrations and switch to incremental auto_vacuum"
+                   ).set_defaults(fn=cmd_migrate)
+
+    p = sub.add_parser("export", help="stream a table to CSV or JSONL")
+    p.add_argument("table", choices=TABLES)
+    p.add_argument("--out", help="file (.csv, .jsonl, optionally .gz); default stdout")
+    p.add_argument("--format", choices=("csv", "jsonl"))
+    p.add_argument("--chunk", type=int, default=10000)
+    p.set_defaults(fn=cmd_export)
+
+    p = sub.add_parser("import", help="bulk-load a CSV or JSONL file into a table")
+    p.add_argument("table", choices=TABLES)
+    p.add_argument("file", help="file (.csv, .jsonl, optionally .gz) or - for stdin")
+    p.add_argument("--format", choices=("csv", "jsonl"))
+    p.add_argument("--chunk", type=int, default=10000, help="rows per transaction")
+    p.add_argument("--on-conflict", choices=("ignore", "replace"), default="ignore")
+    p.add_argument("--no-rollups", action="store_true", help="skip rebuilding the rollups afterwards")
+    p.set_defaults(fn=cmd_import)
+
+    p = sub.add_parser("seed", help="fill an empty database with synthetic data")
+    p.add_argument("--rows", type=int, default=100000, help="rows per table")
+    p.add_argument("--days", type=int, default=60, help="history spread")
+    p.add_argument("--seed", type=int, default=42)
+    p.set_defaults(fn=cmd_seed)
+
+    sub.add_parser("rebuild-rollups", help="recompute the daily rollups").set_defaults(fn=cmd_rebuild_rollups)
+
+    p = sub.add_parser("backfill-ledger", help="estimate the doses due before the dose ledger started")
+    p.add_argument("--since", help="first day (YYYY-MM-DD); default the day the oldest medicine was added")
+    p.set_defaults(fn=cmd_backfill_ledger)
+
+    p = sub.add_parser("archive", help="move rows older than the hot window to the archive database")
+    p.add_argument("--days", type=int, default=RETENTION_DAYS or 90, help="hot window in days")
+    p.set_defaults(fn=cmd_archive)
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr, format="%(message)s")
+    try:
+        args.fn(args)
+    except BrokenPipeError:
+        pass  # e.g. piped into head
+    finally:
+        db.close_all()
+
+
+if __name__ == "__main__":
+    main()
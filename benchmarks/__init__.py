@@ -0,0 +1,13 @@
+"""Benchmarks for the bot's parsers, database queries, scheduling and fan-out.
+
+Run from the repository root:
+
+    python -m benchmarks                          # 1k and 10k rows, all suites
+    python -m benchmarks --scale 1000,100000,1000000 --only db
+    python -m benchmarks --out results.json
+    python -m benchmarks --baseline results.json  # exit 1 on regressions
+
+Every run works on a throw-away SQLite file filled by benchmarks.datagen and
+sends through benchmarks.stub_bot.StubBot, so no Telegram token or network
+access is needed.
+"""
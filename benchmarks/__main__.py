@@ -0,0 +1,58 @@
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+from .runner import Results, compare, load, save
+
+SUITES = ["parsers", "db", "scheduler"]
+SCALED = {"db", "scheduler"}
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(prog="python -m benchmarks", description="Run the bot's benchmarks.")
+    p.add_argument("--scale", default="1000,10000",
+                   help="comma-separated row counts per table for the synthetic database (e.g. 1000,1000000)")
+    p.add_argument("--only", default=",".join(SUITES), help=f"suites to run, from {', '.join(SUITES)}")
+    p.add_argument("--out", help="write results as JSON to this file")
+    p.add_argument("--baseline", help="compare against a previous --out file; exit 1 on regressions")
+    p.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown vs baseline (default 0.2)")
+    args = p.parse_args(argv)
+
+    suites = [s for s in args.only.split(",") if s]
+    unknown = set(suites) - set(SUITES)
+    if unknown:
+        p.error(f"unknown suite(s): {', '.join(sorted(unknown))}")
+    scales = [int(s) for s in args.scale.split(",") if s]
+
+    results = Results()
+    with tempfile.TemporaryDirectory(prefix="healthbot-bench-") as tmp:
+        # each scale runs in a fresh process against its own database file, so
+        # module-level state (connections, scheduler, delivery queue) starts clean
+        plan = [(0, [s for s in suites if s not in SCALED])] + [(n, [s for s in suites if s in SCALED]) for n in scales]
+        for rows, group in plan:
+            if not group:
+                continue
+            out = os.path.join(tmp, f"result_{rows}.json")
+            env = dict(os.environ, DB_NAME=os.path.join(tmp, f"bench_{rows}.db"),
+                       TELEGRAM_TOKEN=os.environ.get("TELEGRAM_TOKEN") or "123456:BENCHMARK-TOKEN-NOT-USED-xxxxxxxx")
+            print(f"== {', '.join(group)}" + (f" @ {rows} rows" if rows else ""), flush=True)
+            cmd = [sys.executable, "-m", "benchmarks.worker", "--rows", str(rows), "--suites", ",".join(group), "--out", out]
+            subprocess.run(cmd, env=env, check=True)
+            results.results.update(load(out))
+
+    data = results.to_json()
+    if args.out:
+        save(args.out, data)
+        print(f"\nresults written to {args.out}")
+    if args.baseline:
+        regressions = compare(data, load(args.baseline), args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s)")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,47 @@
+"""Per-user query latency and write throughput for db.py."""
+import db
+
+from .datagen import sample_users
+from .runner import measure, once
+
+READS = [
+    "days_exercised_last_7_days",
+    "total_minutes_last_7_days",
+    "most_common_activity_last_7_days",
+    "taken_count_last_7_days",
+    "expected_doses_last_7_days",
+    "adherence",
+    "medicine_adherence",
+    "missed_doses",
+    "list_medicines",
+    "list_recent_exercises",
+    "exercises_page",
+    "medicines_page",
+]
+WRITES = 5000
+
+
+def run(results, rows):
+    users = [(u,) for u in sample_users(rows)]
+    for name in READS:
+        results.add(f"db[{rows}].{name}", measure(getattr(db, name), users) * 1e6, "us/op")
+    for days in (7, 30, 90, 365):
+        results.add(f"db[{rows}].progress_summary_{days}d",
+                    measure(db.progress_summary, [(u, days) for (u,) in users]) * 1e6, "us/op")
+    results.add(f"db[{rows}].streaks", measure(db.streaks, users) * 1e6, "us/op")
+    elapsed, _ = once(db.rebuild_rollups)
+    results.add(f"db[{rows}].rebuild_rollups", elapsed * 1e3, "ms")
+
+    def log_taps():
+        for i in range(WRITES):
+            db.log_med_status(i % rows + 1, i % rows + 1, "202601010900", "taken")
+        db.flush()
+    elapsed, _ = once(log_taps)
+    results.add(f"db[{rows}].log_med_status_throughput", WRITES / elapsed, "rows/s", lower_is_better=False)
+
+    def log_exercise():
+        for i in range(WRITES):
+            db.add_exercise(i % rows + 1, "bench", 1.0)
+        db.flush()
+    elapsed, _ = once(log_exercise)
+    results.add(f"db[{rows}].add_exercise_throughput", WRITES / elapsed, "rows/s", lower_is_better=False)
@@ -0,0 +1,15 @@
+"""Micro-benchmarks for the input parsers in Bot.py."""
+from Bot import parse_quantity_input, parse_times_input
+
+from .runner import measure
+
+TIMES_INPUTS = ["9am,9pm", "09:00, 21:00", "10pm", "9:30pm 21:00", "8", "7:15am, 12:00, 6pm, 22:45"]
+QUANTITY_INPUTS = ["45", "30 mins", "12.5 minutes", "about 20m", "60m"]
+ITERATIONS = 2000
+
+
+def run(results, rows=None):
+    times_args = [(s,) for s in TIMES_INPUTS] * ITERATIONS
+    qty_args = [(s,) for s in QUANTITY_INPUTS] * ITERATIONS
+    results.add("parsers.parse_times_input", measure(parse_times_input, times_args) * 1e6, "us/op")
+    results.add("parsers.parse_quantity_input", measure(parse_quantity_input, qty_args) * 1e6, "us/op")
@@ -0,0 +1,59 @@
+"""Startup scheduling and reminder fan-out, sent through a StubBot."""
+import time
+
+import pytz
+from datetime import datetime
+
+import db
+import scheduler
+from config import DEFAULT_TZ, REMINDER_MODE
+from delivery import TokenBucket
+
+from .datagen import DOSE_TIMES
+from .runner import once
+from .stub_bot import StubBot
+
+
+def _wait_drained(bot, expected, timeout=600):
+    deadline = time.monotonic() + timeout
+    while bot.sent < expected and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def run(results, rows):
+    scheduler.start()
+    bot = StubBot()
+    delivery = scheduler.delivery
+    delivery.bot = bot
+    # measure our own overhead, not Telegram's rate limits
+    delivery.bucket = TokenBucket(1e9)
+    delivery.per_chat_interval = 0
+
+    elapsed, _ = once(scheduler.schedule_all_meds_for_all_users)
+    results.add(f"scheduler[{rows}].bootstrap_{REMINDER_MODE}", elapsed * 1e3, "ms")
+    results.add(f"scheduler[{rows}].jobs_registered", len(scheduler.scheduler.get_jobs()), "jobs",
+                lower_is_better=None)
+
+    users = len(db.list_active_users())
+    started = time.perf_counter()
+    scheduler.send_daily_exercise_reminder()
+    submitted = time.perf_counter() - started
+    _wait_drained(bot, users)
+    drained = time.perf_counter() - started
+    results.add(f"scheduler[{rows}].exercise_broadcast_submit", submitted * 1e3, "ms")
+    results.add(f"scheduler[{rows}].exercise_broadcast_throughput", bot.sent / drained, "msg/s",
+                lower_is_better=False)
+
+    bot.reset()
+    tz = pytz.timezone(DEFAULT_TZ)
+    slot_dt = tz.localize(datetime.combine(datetime.now(tz).date(), datetime.strptime(DOSE_TIMES[1], "%H:%M").time()))
+    due = sum(len(batch) for batch in db.iter_due_doses(DOSE_TIMES[1]))
+    started = time.perf_counter()
+    scheduler.dispatch_slot(slot_dt)
+    submitted = time.perf_counter() - started
+    _wait_drained(bot, due)
+    drained = time.perf_counter() - started
+    results.add(f"scheduler[{rows}].wheel_slot_doses", due, "doses", lower_is_better=None)
+    results.add(f"scheduler[{rows}].wheel_slot_submit", submitted * 1e3, "ms")
+    results.add(f"scheduler[{rows}].wheel_slot_throughput", bot.sent / drained if drained else 0.0, "msg/s",
+                lower_is_better=False)
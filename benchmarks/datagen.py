@@ -0,0 +1,93 @@
+"""Synthetic data for benchmarks: users, medicines, exercises, med_logs and the dose ledger."""
+import json
+import random
+from datetime import date, datetime, timedelta
+
+import db
+
+ACTIVITIES = ["walking", "running", "cycling", "yoga", "pushups", "swimming", "stretching"]
+DOSE_TIMES = ["08:00", "09:00", "13:00", "14:00", "20:00", "21:00", "22:00"]
+CHUNK = 10000
+
+
+def _chunks(rows, size=CHUNK):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _insert(sql, rows):
+    conn = db.get_conn()
+    for batch in _chunks(rows):
+        with conn:
+            conn.executemany(sql, batch)
+
+
+def populate(rows: int, days: int = 60, seed: int = 42):
+    """Fill the (empty, migrated) database with `rows` users, medicines,
+    exercise entries and med_log rows each, spread over the last `days` days."""
+    rnd = random.Random(seed)
+    today = date.today()
+    now = datetime.utcnow()
+
+    _insert("INSERT INTO users (user_id, username) VALUES (?,?)",
+            ((u, f"user{u}") for u in range(1, rows + 1)))
+
+    def medicines():
+        for med_id in range(1, rows + 1):
+            user_id = rnd.randint(1, rows)
+            times = sorted(rnd.sample(DOSE_TIMES, rnd.randint(1, 3)))
+            created = now - timedelta(days=rnd.randint(0, days))
+            yield med_id, user_id, f"med{med_id}", "1 tablet", json.dumps(times), created.strftime("%Y-%m-%d %H:%M:%S")
+    _insert("INSERT INTO medicines (med_id, user_id, name, dose, times, created_at) VALUES (?,?,?,?,?,?)",
+            medicines())
+    conn = db.get_conn()
+    with conn:
+        conn.execute("""
+          INSERT OR IGNORE INTO medicine_times (slot, med_id)
+          SELECT j.value, m.med_id FROM medicines m, json_each(m.times) j
+        """)
+
+    def exercises():
+        seen = set()
+        while len(seen) < rows:
+            key = (rnd.randint(1, rows), (today - timedelta(days=rnd.randint(0, days))).isoformat(),
+                   rnd.choice(ACTIVITIES))
+            if key not in seen:
+                seen.add(key)
+                yield key[0], key[2], float(rnd.randint(5, 90)), key[1]
+    _insert("INSERT INTO exercises (user_id, name, minutes, date) VALUES (?,?,?,?)", exercises())
+
+    def med_logs():
+        seen = set()   # one answer per (med_id, scheduled_time)
+        while len(seen) < rows:
+            when = now - timedelta(minutes=rnd.randint(0, days * 24 * 60))
+            key = (rnd.randint(1, rows), when.strftime("%Y%m%d%H%M"))
+            if key not in seen:
+                seen.add(key)
+                yield (key[0], rnd.randint(1, rows), key[1],
+                       "taken" if rnd.random() < 0.8 else "missed", when.strftime("%Y-%m-%d %H:%M:%S"))
+    _insert("INSERT INTO med_logs (med_id, user_id, scheduled_time, status, logged_at) VALUES (?,?,?,?,?)",
+            med_logs())
+    with conn:
+        conn.execute("""
+          INSERT OR IGNORE INTO dose_instances (med_id, user_id, due_at, day, status, answered_at)
+          SELECT med_id, user_id, scheduled_time,
+                 substr(scheduled_time, 1, 4) || '-' || substr(scheduled_time, 5, 2) || '-' || substr(scheduled_time, 7, 2),
+                 status, logged_at
+          FROM med_logs
+        """)
+
+    db.rebuild_rollups()
+    with conn:
+        conn.execute("ANALYZE")
+
+
+def sample_users(rows: int, n: int = 200, seed: int = 7):
+    rnd = random.Random(seed)
+    return [rnd.randint(1, rows) for _ in range(n)]
@@ -0,0 +1,78 @@
+import json
+import platform
+import sqlite3
+import subprocess
+import time
+from datetime import datetime
+from typing import Optional
+
+
+def measure(fn, args_list, repeat: int = 3):
+    """Call fn(*args) for every args tuple, `repeat` times; per-call seconds (best round)."""
+    rounds = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for args in args_list:
+            fn(*args)
+        rounds.append((time.perf_counter() - started) / max(1, len(args_list)))
+    return min(rounds)
+
+
+def once(fn, *args):
+    started = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - started, result
+
+
+class Results:
+    def __init__(self):
+        self.results = {}
+
+    def add(self, name: str, value: float, unit: str, lower_is_better: Optional[bool] = True):
+        """Record one result; lower_is_better=None marks an informational value (not compared)."""
+        self.results[name] = {"value": value, "unit": unit, "lower_is_better": lower_is_better}
+        print(f"  {name:<55} {value:>14.3f} {unit}")
+
+    def to_json(self) -> dict:
+        return {"meta": _meta(), "results": self.results}
+
+
+def _meta():
+    try:
+        rev = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        rev = ""
+    return {
+        "timestamp": datetime.utcnow().isoformat(timespec="seconds") + "Z",
+        "git_rev": rev,
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+    }
+
+
+def compare(current: dict, baseline: dict, tolerance: float):
+    """Print current vs baseline; returns the names that regressed by more than `tolerance`."""
+    regressions = []
+    base = baseline.get("results", {})
+    print(f"\nComparison with baseline {baseline.get('meta', {}).get('git_rev', '?')} (tolerance {tolerance:.0%}):")
+    for name, cur in sorted(current["results"].items()):
+        if cur["lower_is_better"] is None or name not in base or not base[name]["value"]:
+            continue
+        ratio = cur["value"] / base[name]["value"]
+        worse = ratio - 1 if cur["lower_is_better"] else 1 - ratio
+        flag = "REGRESSION" if worse > tolerance else ""
+        print(f"  {name:<55} {ratio:>7.2f}x  {flag}")
+        if flag:
+            regressions.append(name)
+    return regressions
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save(path, data):
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2, sort_keys=True)
@@ -0,0 +1,31 @@
+import threading
+import time
+
+
+class StubBot:
+    """Stands in for telegram.Bot: records outbound calls instead of making them."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def _record(self, method, chat_id, kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.calls.append((method, chat_id, time.monotonic()))
+
+    def send_message(self, chat_id, text, **kwargs):
+        self._record("send_message", chat_id, kwargs)
+
+    def edit_message_text(self, text, chat_id=None, **kwargs):
+        self._record("edit_message_text", chat_id, kwargs)
+
+    def reset(self):
+        with self._lock:
+            self.calls = []
+
+    @property
+    def sent(self) -> int:
+        return len(self.calls)
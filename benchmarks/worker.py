@@ -0,0 +1,38 @@
+"""Runs benchmark suites in-process for one database size (spawned by __main__)."""
+import argparse
+import json
+import logging
+import sys
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--rows", type=int, required=True)
+    p.add_argument("--suites", required=True)
+    p.add_argument("--out", required=True)
+    args = p.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    import db
+    from . import bench_db, bench_parsers, bench_scheduler, datagen
+    from .runner import Results, once
+
+    results = Results()
+    if args.rows:
+        db.init_db()
+        elapsed, _ = once(datagen.populate, args.rows)
+        print(f"  (generated {args.rows} rows per table in {elapsed:.1f}s)", flush=True)
+    suites = {"parsers": bench_parsers, "db": bench_db, "scheduler": bench_scheduler}
+    for name in args.suites.split(","):
+        suites[name].run(results, args.rows)
+    with open(args.out, "w") as f:
+        json.dump(results.results, f)
+
+    import scheduler
+    if scheduler.scheduler is not None:
+        scheduler.delivery.stop(timeout=0)
+        scheduler.scheduler.shutdown(wait=False)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
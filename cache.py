@@ -0,0 +1,93 @@
+"""Bounded in-process LRU cache with a TTL, for the hot per-user reads in db.py.
+
+Only this process's writes update or drop entries, so the TTL bounds how stale
+a read can get when another process (a second bot, the admin CLI) changes the
+same rows.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+_HITS = metrics.Counter("healthbot_cache_hits_total", "Reads answered from an in-process cache.", ["cache"])
+_MISSES = metrics.Counter("healthbot_cache_misses_total", "Reads that went to the database.", ["cache"])
+
+_MISSING = object()
+
+
+class LRUCache:
+    def __init__(self, name: str, maxsize: int, ttl: float):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()    # key -> (expires_at, value), least recently used first
+        self._epoch = 0               # bumped by every write, see get_or_load()
+        self._lock = threading.Lock()
+        self._hits = _HITS.labels(name)
+        self._misses = _MISSES.labels(name)
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._data.move_to_end(key)
+                    self._hits.inc()
+                    return entry[1]
+                del self._data[key]
+        self._misses.inc()
+        return default
+
+    def get_or_load(self, key, loader):
+        """Cached value for `key`, else loader()'s result (stored unless None).
+
+        A write that lands while loader() runs may not be in its result, so the
+        result is only stored if no write happened in between.
+        """
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        with self._lock:
+            epoch = self._epoch
+        value = loader()
+        if value is not None:
+            with self._lock:
+                if self._epoch == epoch:
+                    self._store(key, value)
+        return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._epoch += 1
+            self._store(key, value)
+
+    def update(self, key, fn):
+        """Replace a cached value with fn(value); nothing happens if `key` is not cached."""
+        with self._lock:
+            self._epoch += 1
+            entry = self._data.get(key)
+            if entry is not None:
+                self._data[key] = (entry[0], fn(entry[1]))
+
+    def pop(self, key):
+        with self._lock:
+            self._epoch += 1
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._data.clear()
+
+    def _store(self, key, value):
+        if self.ttl <= 0 or self.maxsize <= 0:
+            return  # caching disabled
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
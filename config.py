@@ -1,11 +1,20 @@
+import hashlib
 import os
 from dotenv import load_dotenv
 
 load_dotenv()
 
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
-if not TELEGRAM_TOKEN:
-    raise RuntimeError("Please set TELEGRAM_TOKEN in .env")
+
+def require_token() -> str:
+    """The bot token; only code that talks to Telegram needs it (not the admin CLI)."""
+    if not TELEGRAM_TOKEN:
+        raise RuntimeError("Please set TELEGRAM_TOKEN in .env")
+    return TELEGRAM_TOKEN
+
+# Bot API endpoint the token is appended to; point it at a local telegram-bot-api
+# server or at `python -m loadtest`'s fake. Empty uses https://api.telegram.org/bot
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
 
 DB_NAME = os.getenv("DB_NAME", "healthbot.db")
 # default timezone (India) — user is not asked for timezone
@@ -14,3 +23,102 @@ DEFAULT_TZ = "Asia/Kolkata"
 # Daily exercise reminder time (24h)
 EXERCISE_REMINDER_HOUR = 17
 EXERCISE_REMINDER_MINUTE = 0
+
+# SQLite tuning (connections are long-lived, one per thread)
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")   # OFF / NORMAL / FULL
+DB_CACHE_KB = int(os.getenv("DB_CACHE_KB", "16384"))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_STATEMENT_CACHE = int(os.getenv("DB_STATEMENT_CACHE", "256"))
+# exercise logs and Taken/Missed taps: "batched" (write-behind, group commit) or "sync"
+# batched rows not yet flushed are lost if the process is killed without a clean shutdown
+DB_WRITE_MODE = os.getenv("DB_WRITE_MODE", "batched")
+DB_FLUSH_INTERVAL_MS = int(os.getenv("DB_FLUSH_INTERVAL_MS", "200"))
+DB_FLUSH_BATCH = int(os.getenv("DB_FLUSH_BATCH", "500"))
+
+# In-process caches for medicines and known users (entries per cache, seconds).
+# This process's writes keep them current; the TTL bounds staleness from other
+# writers (a second bot process, admin imports). CACHE_TTL=0 disables them.
+CACHE_SIZE = int(os.getenv("CACHE_SIZE", "10000"))
+CACHE_TTL = float(os.getenv("CACHE_TTL", "300"))
+
+# Retention: exercises / med_logs older than RETENTION_DAYS move to ARCHIVE_DB_NAME
+# (daily at ARCHIVE_HOUR:ARCHIVE_MINUTE); statistics come from the rollups. 0 keeps everything.
+RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", "90"))
+ARCHIVE_DB_NAME = os.getenv("ARCHIVE_DB_NAME") or os.path.splitext(DB_NAME)[0] + "-archive.db"
+ARCHIVE_CHUNK_SIZE = int(os.getenv("ARCHIVE_CHUNK_SIZE", "2000"))
+ARCHIVE_HOUR = int(os.getenv("ARCHIVE_HOUR", "3"))
+ARCHIVE_MINUTE = int(os.getenv("ARCHIVE_MINUTE", "30"))
+# free pages returned to the filesystem per idle minute (incremental VACUUM)
+VACUUM_PAGES = int(os.getenv("VACUUM_PAGES", "256"))
+
+# Longest window accepted by /progress <days>
+PROGRESS_MAX_DAYS = int(os.getenv("PROGRESS_MAX_DAYS", "365"))
+
+# Outbound delivery (reminders and broadcasts)
+DELIVERY_WORKERS = int(os.getenv("DELIVERY_WORKERS", "8"))
+DELIVERY_RATE = float(os.getenv("DELIVERY_RATE", "25"))                 # messages/second, all chats
+DELIVERY_PER_CHAT_INTERVAL = float(os.getenv("DELIVERY_PER_CHAT_INTERVAL", "1.0"))  # seconds between messages to one chat
+DELIVERY_MAX_RETRIES = int(os.getenv("DELIVERY_MAX_RETRIES", "3"))
+DELIVERY_RETRY_BACKOFF = float(os.getenv("DELIVERY_RETRY_BACKOFF", "2.0"))  # seconds, doubled per attempt
+
+# Medicine reminder dispatch:
+#   "wheel" - one job per minute looks up the doses due in that slot (constant job count)
+#   "jobs"  - one APScheduler cron job per medicine x time
+REMINDER_MODE = os.getenv("REMINDER_MODE", "wheel")
+WHEEL_BATCH_SIZE = int(os.getenv("WHEEL_BATCH_SIZE", "500"))
+BOOTSTRAP_CHUNK_SIZE = int(os.getenv("BOOTSTRAP_CHUNK_SIZE", "1000"))
+# APScheduler thread pool, and how late (seconds) a job may start before the run
+# is dropped; dropped runs are counted in healthbot_scheduler_missed_runs_total
+SCHEDULER_WORKERS = int(os.getenv("SCHEDULER_WORKERS", "20"))
+SCHEDULER_MISFIRE_GRACE = int(os.getenv("SCHEDULER_MISFIRE_GRACE", "60"))
+# a busy minute's reminders are spread over up to this many seconds
+# (random per-job delay in "jobs" mode, staggered sends in "wheel" mode)
+REMINDER_JITTER = float(os.getenv("REMINDER_JITTER", "20"))
+# sent more than this many seconds after their minute, reminders count as late
+REMINDER_LATE_SECONDS = float(os.getenv("REMINDER_LATE_SECONDS", "60"))
+# doses that fell due while no process ran the scheduler (restart, failover):
+# "send" them late on startup or "skip" them; only the last MISSED_REMINDER_WINDOW
+# minutes are considered, anything older is dropped either way
+MISSED_REMINDER_POLICY = os.getenv("MISSED_REMINDER_POLICY", "send")
+MISSED_REMINDER_WINDOW = int(os.getenv("MISSED_REMINDER_WINDOW", "60"))
+
+# Update ingress: "polling" (getUpdates loop) or "webhook" (python-telegram-bot's tornado server)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("PORT", os.getenv("WEBHOOK_PORT", "8443")))   # PORT is set on Heroku web dynos
+# secret path the endpoint is served on; derived from the token unless set explicitly
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH") or hashlib.sha256((TELEGRAM_TOKEN or "").encode()).hexdigest()[:32]
+# public base URL registered with Telegram, e.g. https://myapp.herokuapp.com
+# leave empty to serve the endpoint locally without calling setWebhook
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+# Several bot processes may share DB_NAME (webhook mode behind one endpoint) when
+# LEADER_ELECTION=1: only the process holding the "scheduler" lease runs reminder
+# and maintenance jobs; another takes over within LEADER_LEASE_TTL seconds if it dies.
+LEADER_ELECTION = os.getenv("LEADER_ELECTION", "0") == "1"
+LEADER_LEASE_TTL = float(os.getenv("LEADER_LEASE_TTL", "10"))
+LEADER_HEARTBEAT = float(os.getenv("LEADER_HEARTBEAT", "3"))
+DISPATCHER_WORKERS = int(os.getenv("DISPATCHER_WORKERS", "4"))
+# handlers run on this many lanes; updates from one user always share a lane (in order)
+HANDLER_LANES = int(os.getenv("HANDLER_LANES", "8"))
+HANDLER_QUEUE_SIZE = int(os.getenv("HANDLER_QUEUE_SIZE", "1000"))   # per lane; a full lane blocks intake
+
+# Inbound flood control (throttle.py), applied before any handler runs
+THROTTLE_RATE = float(os.getenv("THROTTLE_RATE", "1"))          # updates/second per user; 0 disables
+THROTTLE_BURST = float(os.getenv("THROTTLE_BURST", "20"))       # updates a quiet user may send at once
+# above this many updates waiting on the lanes, busy users are shed (0 disables)
+THROTTLE_MAX_PENDING = int(os.getenv("THROTTLE_MAX_PENDING", "500"))
+THROTTLE_CALLBACK_WINDOW = float(os.getenv("THROTTLE_CALLBACK_WINDOW", "1.0"))  # seconds; repeated taps are dropped
+
+# In-memory dispatcher state: a conversation left idle this long is ended (0 disables),
+# and a user's user_data leaves memory after USER_DATA_TTL idle seconds (SQLite keeps it)
+CONVERSATION_TIMEOUT = int(os.getenv("CONVERSATION_TIMEOUT", "900"))
+USER_DATA_TTL = int(os.getenv("USER_DATA_TTL", "3600"))
+# a timeout has to find the user's data still in memory to write its cleanup back
+if CONVERSATION_TIMEOUT > 0 and 0 < USER_DATA_TTL < CONVERSATION_TIMEOUT:
+    raise RuntimeError(f"USER_DATA_TTL ({USER_DATA_TTL}) must be at least CONVERSATION_TIMEOUT ({CONVERSATION_TIMEOUT})")
+MEMORY_SWEEP_INTERVAL = int(os.getenv("MEMORY_SWEEP_INTERVAL", "300"))   # seconds; evict and report
+
+# Prometheus-format metrics on http://METRICS_ADDR:METRICS_PORT/metrics (0 disables)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+METRICS_ADDR = os.getenv("METRICS_ADDR", "127.0.0.1")
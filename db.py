@@ -1,25 +1,170 @@
 import sqlite3
+import atexit
+import itertools
 import json
-from datetime import datetime, date
-from typing import List, Optional
-from config import DB_NAME
+import logging
+import os
+import threading
+import time
+from datetime import datetime, date, timedelta
+from typing import List, NamedTuple, Optional
+import pytz
+from config import (
+    DEFAULT_TZ,
+    DB_NAME, DB_SYNCHRONOUS, DB_CACHE_KB, DB_BUSY_TIMEOUT_MS, DB_STATEMENT_CACHE,
+    DB_WRITE_MODE, DB_FLUSH_INTERVAL_MS, DB_FLUSH_BATCH, ARCHIVE_DB_NAME, CACHE_SIZE, CACHE_TTL,
+    RETENTION_DAYS,
+)
+import metrics
+from cache import LRUCache
 
-def get_conn():
-    # use separate connections per thread/call
-    conn = sqlite3.connect(DB_NAME, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
+logger = logging.getLogger(__name__)
+
+# One long-lived connection per thread (dispatcher workers, scheduler executor
+# threads, main thread). Connections are opened lazily and reused for every call.
+_local = threading.local()
+_all_conns = []
+_all_conns_lock = threading.Lock()
+_generation = 0
+
+def _connect():
+    conn = sqlite3.connect(DB_NAME, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES,
+                           timeout=DB_BUSY_TIMEOUT_MS / 1000, cached_statements=DB_STATEMENT_CACHE,
+                           check_same_thread=False)
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_KB}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
     return conn
 
-def init_db():
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("""
+def get_conn():
+    """Return this thread's persistent connection. Callers must not close it."""
+    conn = getattr(_local, "conn", None)
+    if conn is None or _local.generation != _generation:
+        conn = _connect()
+        with _all_conns_lock:
+            _all_conns.append(conn)
+            _local.conn, _local.generation = conn, _generation
+    return conn
+
+def close_all():
+    """Flush queued writes and close every pooled connection (call on shutdown)."""
+    global _generation
+    flush()
+    with _all_conns_lock:
+        conns = list(_all_conns)
+        _all_conns.clear()
+        _generation += 1
+    for conn in conns:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+# ---------------- Write-behind queue ----------------
+# High-volume, fire-and-forget inserts (exercise logs, Taken/Missed taps) are
+# queued and committed together with executemany, so a burst costs one fsync
+# per batch instead of one per row. DB_WRITE_MODE="sync" writes immediately.
+
+class _WriteBehind:
+    def __init__(self, interval: float, batch_size: int):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.rows_written = 0
+        self.batches = 0
+        self._pending = []        # (sql, params) in arrival order
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+
+    def submit(self, sql, params):
+        with self._cond:
+            self._pending.append((sql, params))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="db-write-behind", daemon=True)
+                self._thread.start()
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify()
+
+    def depth(self) -> int:
+        return len(self._pending)
+
+    def flush(self):
+        """Write everything queued so far; returns once it is committed."""
+        with self._flush_lock:
+            with self._cond:
+                ops, self._pending = self._pending, []
+            if ops:
+                started = time.perf_counter()
+                self._write(ops)
+                _WRITE_BATCH_SECONDS.observe(time.perf_counter() - started)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if len(self._pending) < self.batch_size:
+                    self._cond.wait(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("write-behind flush failed")
+
+    def _write(self, ops):
+        conn = get_conn()
+        try:
+            with conn:
+                # consecutive ops with the same statement go out as one executemany
+                for sql, group in itertools.groupby(ops, key=lambda op: op[0]):
+                    conn.executemany(sql, [params for _, params in group])
+        except sqlite3.Error:
+            # one bad row must not sink the batch: retry individually
+            logger.exception("write-behind batch of %d failed, retrying row by row", len(ops))
+            for sql, params in ops:
+                try:
+                    with conn:
+                        conn.execute(sql, params)
+                except sqlite3.Error:
+                    logger.exception("write-behind dropped row %r for: %s", params, " ".join(sql.split()[:3]))
+        self.rows_written += len(ops)
+        self.batches += 1
+
+_writer = _WriteBehind(DB_FLUSH_INTERVAL_MS / 1000, DB_FLUSH_BATCH)
+_WRITE_BATCH_SECONDS = metrics.DB_QUERY_SECONDS.labels("write_behind_batch")
+metrics.Callback("healthbot_db_write_queue_depth", "Rows waiting in the write-behind queue.", _writer.depth)
+metrics.Callback("healthbot_db_rows_written_total", "Rows committed by the write-behind queue.",
+                 lambda: _writer.rows_written, kind="counter")
+
+def _write(sql, params):
+    if DB_WRITE_MODE == "sync":
+        conn = get_conn()
+        with conn:
+            conn.execute(sql, params)
+    else:
+        _writer.submit(sql, params)
+
+def flush():
+    """Commit any queued write-behind rows now."""
+    _writer.flush()
+
+def pending_writes() -> int:
+    return _writer.depth()
+
+atexit.register(flush)
+
+# ---------------- Schema migrations ----------------
+# Each step runs once, in order; PRAGMA user_version records the last applied
+# step. Append new steps to MIGRATIONS, never edit or reorder existing ones.
+
+def _m001_base_tables(conn):
+    conn.execute("""
       CREATE TABLE IF NOT EXISTS users (
         user_id INTEGER PRIMARY KEY,
         username TEXT
       )
     """)
-    c.execute("""
+    conn.execute("""
       CREATE TABLE IF NOT EXISTS exercises (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         user_id INTEGER,
@@ -29,7 +174,7 @@ def init_db():
         created_at TEXT DEFAULT (datetime('now'))
       )
     """)
-    c.execute("""
+    conn.execute("""
       CREATE TABLE IF NOT EXISTS medicines (
         med_id INTEGER PRIMARY KEY AUTOINCREMENT,
         user_id INTEGER,
@@ -39,7 +184,7 @@ def init_db():
         created_at TEXT DEFAULT (datetime('now'))
       )
     """)
-    c.execute("""
+    conn.execute("""
       CREATE TABLE IF NOT EXISTS med_logs (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         med_id INTEGER,
@@ -49,187 +194,1147 @@ def init_db():
         logged_at TEXT DEFAULT (datetime('now'))
       )
     """)
-    conn.commit()
-    conn.close()
 
+def _m002_indexes(conn):
+    # merge duplicate (user_id, date, name) exercise rows into the newest one
+    # so the unique index can be built on databases created before it existed
+    conn.execute("""
+      UPDATE exercises SET minutes = (
+        SELECT SUM(e2.minutes) FROM exercises e2
+        WHERE e2.user_id=exercises.user_id AND e2.date=exercises.date AND e2.name=exercises.name
+      )
+      WHERE id IN (SELECT MAX(id) FROM exercises GROUP BY user_id, date, name HAVING COUNT(*) > 1)
+    """)
+    conn.execute("""
+      DELETE FROM exercises
+      WHERE id NOT IN (SELECT MAX(id) FROM exercises GROUP BY user_id, date, name)
+    """)
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_exercises_user_date_name ON exercises(user_id, date, name)")
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_med_logs_user_status_logged ON med_logs(user_id, status, logged_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_medicines_user ON medicines(user_id)")
+
+def _m003_user_blocked(conn):
+    # set when Telegram reports the user blocked the bot; cleared on /start
+    conn.execute("ALTER TABLE users ADD COLUMN blocked_at TEXT")
+
+def _m004_medicine_times(conn):
+    # one row per medicine x daily time, so the reminder wheel can look up
+    # everything due in a minute slot with a single index range scan
+    conn.execute("""
+      CREATE TABLE IF NOT EXISTS medicine_times (
+        slot TEXT NOT NULL,    -- "HH:MM" in DEFAULT_TZ
+        med_id INTEGER NOT NULL,
+        PRIMARY KEY (slot, med_id)
+      ) WITHOUT ROWID
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_medicine_times_med ON medicine_times(med_id)")
+    conn.execute("""
+      INSERT OR IGNORE INTO medicine_times (slot, med_id)
+      SELECT j.value, m.med_id FROM medicines m, json_each(COALESCE(m.times, '[]')) j
+    """)
+
+def _m005_bot_state(conn):
+    # ConversationHandler states and context.user_data (see persistence.py)
+    conn.execute("""
+      CREATE TABLE IF NOT EXISTS conversations (
+        name TEXT NOT NULL,
+        key TEXT NOT NULL,     -- JSON list, e.g. [chat_id, user_id]
+        state INTEGER NOT NULL,
+        PRIMARY KEY (name, key)
+      ) WITHOUT ROWID
+    """)
+    conn.execute("""
+      CREATE TABLE IF NOT EXISTS user_data (
+        user_id INTEGER PRIMARY KEY,
+        data TEXT NOT NULL,    -- JSON object
+        updated_at TEXT DEFAULT (datetime('now'))
+      )
+    """)
+
+def _m006_rollups(conn):
+    # per-user daily totals kept current by add_exercise / delete_exercise /
+    # log_med_status and the reminder dispatch; long-range stats read these
+    conn.execute("""
+      CREATE TABLE IF NOT EXISTS rollup_exercise (
+        user_id INTEGER NOT NULL,
+        day TEXT NOT NULL,     -- exercises.date
+        name TEXT NOT NULL,
+        minutes REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, day, name)
+      ) WITHOUT ROWID
+    """)
+    conn.execute("""
+      CREATE TABLE IF NOT EXISTS rollup_meds (
+        user_id INTEGER NOT NULL,
+        day TEXT NOT NULL,     -- date of the scheduled dose in DEFAULT_TZ
+        taken INTEGER NOT NULL DEFAULT 0,
+        missed INTEGER NOT NULL DEFAULT 0,
+        expected INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, day)
+      ) WITHOUT ROWID
+    """)
+    # filling them from existing history takes as long as the history is, so it
+    # is left to `python -m admin rebuild-rollups`; until then init_db() warns
+    if conn.execute("SELECT 1 FROM exercises UNION ALL SELECT 1 FROM med_logs UNION ALL SELECT 1 FROM medicines "
+                    "LIMIT 1").fetchone():
+        _m010_scheduler_state(conn)  # created early to hold the mark
+        conn.execute("INSERT OR REPLACE INTO scheduler_state (name, value) VALUES (?, datetime('now'))",
+                     (ROLLUPS_PENDING,))
+
+def _m007_leases(conn):
+    # named leases for leader election between processes sharing this file (see leader.py)
+    conn.execute("""
+      CREATE TABLE IF NOT EXISTS leases (
+        name TEXT PRIMARY KEY,
+        holder TEXT NOT NULL,
+        expires_at REAL NOT NULL,   -- unix time
+        acquired_at REAL NOT NULL
+      ) WITHOUT ROWID
+    """)
+
+def _m008_med_logs_unique(conn):
+    # one row per dose: keep the latest answer for each (med_id, scheduled_time)
+    conn.execute("""
+      DELETE FROM med_logs
+      WHERE id NOT IN (SELECT MAX(id) FROM med_logs GROUP BY med_id, scheduled_time)
+    """)
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_med_logs_med_sched ON med_logs(med_id, scheduled_time)")
+    if _rollups_pending(conn):
+        return  # the pending rebuild counts them
+    # recount the days whose duplicates were just dropped
+    conn.execute(f"""
+      INSERT INTO rollup_meds (user_id, day, taken, missed)
+      SELECT user_id, {_DOSE_DAY_SQL} AS day, SUM(status='taken'), SUM(status='missed') FROM med_logs
+      WHERE user_id IS NOT NULL
+      GROUP BY user_id, day
+      ON CONFLICT(user_id, day) DO UPDATE SET taken = excluded.taken, missed = excluded.missed
+    """)
+
+def _m009_exercise_keyset(conn):
+    # (user_id, date, id) order for paging through a user's exercises
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_exercises_user_date_id ON exercises(user_id, date, id)")
+
+def _m010_scheduler_state(conn):
+    # small named values the scheduler must keep across restarts (reminder watermark)
+    conn.execute("""
+      CREATE TABLE IF NOT EXISTS scheduler_state (
+        name TEXT PRIMARY KEY,
+        value TEXT NOT NULL,
+        updated_at TEXT DEFAULT (datetime('now'))
+      ) WITHOUT ROWID
+    """)
+
+def _m011_dose_instances(conn):
+    # one row per dose the scheduler sent (or deliberately skipped); the
+    # Taken/Missed answer is written onto that row. due_at is the dose's local
+    # minute as YYYYMMDDHHMM, exactly as in the reminder's callback data.
+    conn.execute("""
+      CREATE TABLE IF NOT EXISTS dose_instances (
+        id INTEGER PRIMARY KEY,
+        med_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        due_at TEXT NOT NULL,
+        day TEXT NOT NULL,       -- dose day, as in rollup_meds
+        status TEXT,             -- NULL until answered, then 'taken' or 'missed'
+        answered_at TEXT
+      )
+    """)
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_dose_instances_med_due ON dose_instances(med_id, due_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_dose_instances_user_day ON dose_instances(user_id, day, status)")
+    # answered doses are known from med_logs; unanswered ones before this point are not
+    conn.execute(f"""
+      INSERT OR IGNORE INTO dose_instances (med_id, user_id, due_at, day, status, answered_at)
+      SELECT med_id, user_id, scheduled_time, {_DOSE_DAY_SQL}, status, logged_at FROM med_logs
+      WHERE med_id IS NOT NULL AND user_id IS NOT NULL
+        AND scheduled_time GLOB '[0-9][0-9][0-9][0-9][0-9][0-9][0-9][0-9][0-9][0-9][0-9][0-9]'
+      ORDER BY id
+    """)
+
+def _m012_conversation_age(conn):
+    # lets startup skip conversations abandoned longer than CONVERSATION_TIMEOUT;
+    # rows already saved count from now
+    conn.execute("ALTER TABLE conversations ADD COLUMN updated_at TEXT")
+    conn.execute("UPDATE conversations SET updated_at=datetime('now')")
+
+def _m013_dose_ledger_since(conn):
+    # the ledger is complete from the day of this upgrade; medicine rollups of
+    # earlier days keep their estimates (`python -m admin backfill-ledger`
+    # extends the ledger back, also an estimate)
+    today = _local_now().date().isoformat()
+    conn.execute("DELETE FROM rollup_meds WHERE day >= ?", (today,))  # recounted from the ledger as doses come in
+    conn.execute("INSERT OR REPLACE INTO scheduler_state (name, value) VALUES (?, ?)", (LEDGER_SINCE, today))
+
+MIGRATIONS = [
+    _m001_base_tables,
+    _m002_indexes,
+    _m003_user_blocked,
+    _m004_medicine_times,
+    _m005_bot_state,
+    _m006_rollups,
+    _m007_leases,
+    _m008_med_logs_unique,
+    _m009_exercise_keyset,
+    _m010_scheduler_state,
+    _m011_dose_instances,
+    _m012_conversation_age,
+    _m013_dose_ledger_since,
+]
+
+def schema_version() -> int:
+    return get_conn().execute("PRAGMA user_version").fetchone()[0]
+
+def migrate():
+    """Apply pending migrations in a single write transaction."""
+    conn = get_conn()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for number, step in enumerate(MIGRATIONS[version:], start=version + 1):
+            step(conn)
+            conn.execute(f"PRAGMA user_version={number}")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+def init_db():
+    conn = get_conn()
+    if not conn.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchone():
+        enable_incremental_vacuum()  # instant while the file has no tables yet
+    migrate()
+    if _rollups_pending(conn):
+        logger.warning("%s: the rollups do not cover the history from before they existed yet, so /progress "
+                       "undercounts; run `python -m admin rebuild-rollups` to fill them", DB_NAME)
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        # a full VACUUM can outlast the platform's startup timeout, so it is left to the admin CLI
+        logger.warning("%s does not use incremental auto_vacuum yet; run `python -m admin migrate` "
+                       "while the bot is stopped to convert it", DB_NAME)
+
+def enable_incremental_vacuum() -> bool:
+    """Switch the file to incremental auto_vacuum (one full VACUUM); False if it already was."""
+    # freed pages are then handed back in small slices by incremental_vacuum()
+    conn = get_conn()
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return False
+    flush()
+    started = time.monotonic()
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("VACUUM")
+    logger.info("switched %s to incremental auto_vacuum in %.2fs", DB_NAME, time.monotonic() - started)
+    return True
+
+# ---------------- Read caches ----------------
+# Hot per-user reads are answered from memory. Every write below that changes
+# a cached row updates or drops the entry in the same call (write-through).
+_medicine_by_id = LRUCache("medicine", CACHE_SIZE, CACHE_TTL)    # med_id -> Medicine
+_medicines_by_user = LRUCache("medicines", CACHE_SIZE, CACHE_TTL)  # user_id -> (Medicine, ...) by med_id
+
+def clear_caches():
+    for c in (_medicine_by_id, _medicines_by_user):
+        c.clear()
+
+@metrics.query
 def add_user(user_id: int, username: Optional[str]):
+    # not cached: another process may have marked the user blocked since, and
+    # this upsert is what clears it (it writes nothing when blocked_at is unset)
     conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("INSERT OR IGNORE INTO users (user_id, username) VALUES (?,?)", (user_id, username))
-    conn.commit()
-    conn.close()
+    with conn:
+        conn.execute("""
+          INSERT INTO users (user_id, username) VALUES (?,?)
+          ON CONFLICT(user_id) DO UPDATE SET blocked_at=NULL WHERE blocked_at IS NOT NULL
+        """, (user_id, username))
 
+@metrics.query
 def list_users():
     conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT user_id, username FROM users")
-    rows = cur.fetchall()
-    conn.close()
-    return rows
+    return conn.execute("SELECT user_id, username FROM users").fetchall()
 
+@metrics.query
+def list_active_users():
+    """Users that have not blocked the bot."""
+    conn = get_conn()
+    return conn.execute("SELECT user_id, username FROM users WHERE blocked_at IS NULL").fetchall()
+
+@metrics.query
+def mark_user_blocked(user_id: int):
+    conn = get_conn()
+    with conn:
+        conn.execute("""
+          INSERT INTO users (user_id, blocked_at) VALUES (?, datetime('now'))
+          ON CONFLICT(user_id) DO UPDATE SET blocked_at=excluded.blocked_at WHERE blocked_at IS NULL
+        """, (user_id,))
+
+@metrics.query
 def add_exercise(user_id: int, name: str, minutes: float, for_date: Optional[str] = None):
     d = for_date or date.today().isoformat()
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT id, minutes FROM exercises WHERE user_id=? AND name=? AND date=?", (user_id, name.lower(), d))
-    row = cur.fetchone()
-    if row:
-        new_minutes = (row["minutes"] or 0) + minutes
-        cur.execute("UPDATE exercises SET minutes=?, created_at=datetime('now') WHERE id=?", (new_minutes, row["id"]))
-    else:
-        cur.execute("INSERT INTO exercises (user_id, name, minutes, date) VALUES (?,?,?,?)",
-                    (user_id, name.lower(), minutes, d))
-    conn.commit()
-    conn.close()
+    _write("""
+      INSERT INTO exercises (user_id, name, minutes, date) VALUES (?,?,?,?)
+      ON CONFLICT(user_id, date, name) DO UPDATE
+      SET minutes = COALESCE(exercises.minutes, 0) + excluded.minutes, created_at = datetime('now')
+    """, (user_id, name.lower(), minutes, d))
+    _write(_ROLLUP_EXERCISE_SQL, (user_id, d, name.lower(), minutes))
 
+@metrics.query
 def list_recent_exercises(user_id: int, days: int = 14):
+    """Exercises logged in the last `days` days, newest first."""
+    flush()  # entry IDs are shown to the user, so include just-logged exercises
     conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("""
+    since = (date.today() - timedelta(days=days - 1)).isoformat()
+    return conn.execute("""
       SELECT id, name, minutes, date
       FROM exercises
-      WHERE user_id=?
+      WHERE user_id=? AND date >= ?
       ORDER BY date DESC, id DESC
-      LIMIT 200
-    """, (user_id,))
-    rows = cur.fetchall()
-    conn.close()
-    return rows
+    """, (user_id, since)).fetchall()
+
+# PAGING
+# Keyset pagination: a page is addressed by the sort key of the row next to it,
+# so every page is one index range scan however far back the user has gone.
+class Page(NamedTuple):
+    rows: list
+    older: Optional[tuple]   # cursor for the next page back, None on the last page
+    newer: Optional[tuple]   # cursor for the page in front of this one, None on the first
+
+def _keyset_page(conn, select: str, keys: tuple, params: tuple, before, after, limit: int) -> Page:
+    """Run `select` (ending in a WHERE clause) newest first over the `keys` columns."""
+    key = "(" + ", ".join(keys) + ")"
+    if after is not None:
+        # walk forwards from the cursor, then flip back to newest first
+        rows = conn.execute(f"{select} AND {key} > ({', '.join('?' * len(keys))}) "
+                            f"ORDER BY {', '.join(keys)} LIMIT ?", params + tuple(after) + (limit + 1,)).fetchall()
+        has_newer, has_older = len(rows) > limit, True
+        rows = rows[:limit][::-1]
+    else:
+        cond, cursor = "", ()
+        if before is not None:
+            cond, cursor = f" AND {key} < ({', '.join('?' * len(keys))})", tuple(before)
+        desc = ", ".join(f"{k} DESC" for k in keys)
+        rows = conn.execute(f"{select}{cond} ORDER BY {desc} LIMIT ?", params + cursor + (limit + 1,)).fetchall()
+        has_older, has_newer = len(rows) > limit, before is not None
+        rows = rows[:limit]
+    if not rows:
+        return Page(rows, None, None)
+    return Page(rows,
+                tuple(rows[-1][k] for k in keys) if has_older else None,
+                tuple(rows[0][k] for k in keys) if has_newer else None)
+
+@metrics.query
+def exercises_page(user_id: int, before: Optional[tuple] = None, after: Optional[tuple] = None,
+                   limit: int = 10) -> Page:
+    """A page of the user's exercises, newest first; cursors are (date, id)."""
+    flush()
+    return _keyset_page(get_conn(), "SELECT id, name, minutes, date FROM exercises WHERE user_id=?",
+                        ("date", "id"), (user_id,), before, after, limit)
 
+@metrics.query
 def delete_exercise(entry_id: int, user_id: int):
+    flush()
     conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM exercises WHERE id=? AND user_id=?", (entry_id, user_id))
-    conn.commit()
-    conn.close()
+    with conn:
+        row = conn.execute("SELECT name, minutes, date FROM exercises WHERE id=? AND user_id=?",
+                           (entry_id, user_id)).fetchone()
+        if row is None:
+            return
+        conn.execute("DELETE FROM exercises WHERE id=?", (entry_id,))
+        conn.execute(_ROLLUP_EXERCISE_SQL, (user_id, row["date"], row["name"], -(row["minutes"] or 0)))
+        conn.execute("DELETE FROM rollup_exercise WHERE user_id=? AND day=? AND name=? AND minutes <= 0",
+                     (user_id, row["date"], row["name"]))
 
+@metrics.query
 def exercises_summary_last_7_days(user_id: int):
     conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("""
+    rows = conn.execute("""
       SELECT date, SUM(minutes) as total_minutes
       FROM exercises
       WHERE user_id=? AND date >= date('now','-6 days')
       GROUP BY date
       ORDER BY date DESC
-    """, (user_id,))
-    rows = cur.fetchall()
-    conn.close()
+    """, (user_id,)).fetchall()
     return [(r["date"], int(r["total_minutes"] or 0)) for r in rows]
 
+@metrics.query
 def total_minutes_last_7_days(user_id: int):
     conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("""
+    row = conn.execute("""
       SELECT SUM(minutes) as total FROM exercises
       WHERE user_id=? AND date >= date('now','-6 days')
-    """, (user_id,))
-    row = cur.fetchone()
-    conn.close()
+    """, (user_id,)).fetchone()
     return int(row["total"] or 0)
 
+@metrics.query
 def days_exercised_last_7_days(user_id: int):
     conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("""
+    row = conn.execute("""
       SELECT COUNT(DISTINCT date) as days FROM exercises
       WHERE user_id=? AND date >= date('now','-6 days')
-    """, (user_id,))
-    row = cur.fetchone()
-    conn.close()
+    """, (user_id,)).fetchone()
     return row["days"] or 0
 
+@metrics.query
 def most_common_activity_last_7_days(user_id: int):
     conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("""
+    row = conn.execute("""
       SELECT name, SUM(minutes) as total FROM exercises
       WHERE user_id=? AND date >= date('now','-6 days')
       GROUP BY name ORDER BY total DESC LIMIT 1
-    """, (user_id,))
-    row = cur.fetchone()
-    conn.close()
+    """, (user_id,)).fetchone()
     return row["name"] if row else None
 
+class Medicine(NamedTuple):
+    med_id: int
+    user_id: int
+    name: str
+    dose: str
+    times: tuple            # ("HH:MM", ...), decoded once from the JSON column
+    created_at: str
+
+_MEDICINE_COLUMNS = "med_id, user_id, name, dose, times, created_at"
+
+def _medicine(row) -> Medicine:
+    try:
+        times = tuple(json.loads(row["times"] or "[]"))
+    except ValueError:
+        times = (row["times"],)
+    return Medicine(row["med_id"], row["user_id"], row["name"], row["dose"], times, row["created_at"])
+
+@metrics.query
 def add_medicine(user_id: int, name: str, dose: str, times_list: List[str]) -> int:
+    # created_at is set here, in datetime('now')'s format, so the cached copy matches the row
+    med = Medicine(0, user_id, name.strip(), dose.strip(), tuple(times_list),
+                   datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"))
     conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("INSERT INTO medicines (user_id, name, dose, times) VALUES (?,?,?,?)",
-                (user_id, name.strip(), dose.strip(), json.dumps(times_list)))
-    med_id = cur.lastrowid
-    conn.commit()
-    conn.close()
+    with conn:
+        cur = conn.execute("INSERT INTO medicines (user_id, name, dose, times, created_at) VALUES (?,?,?,?,?)",
+                           (user_id, med.name, med.dose, json.dumps(times_list), med.created_at))
+        med_id = cur.lastrowid
+        conn.executemany("INSERT OR IGNORE INTO medicine_times (slot, med_id) VALUES (?,?)",
+                         [(t, med_id) for t in times_list])
+    med = med._replace(med_id=med_id)
+    _medicine_by_id.put(med_id, med)
+    _medicines_by_user.update(user_id, lambda meds: meds + (med,))
     return med_id
 
-def list_medicines(user_id: int):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT med_id, name, dose, times, created_at FROM medicines WHERE user_id=? ORDER BY med_id", (user_id,))
-    rows = cur.fetchall()
-    conn.close()
-    return rows
+@metrics.query
+def list_medicines(user_id: int) -> tuple:
+    """The user's medicines in med_id order."""
+    def load():
+        rows = get_conn().execute(f"SELECT {_MEDICINE_COLUMNS} FROM medicines WHERE user_id=? ORDER BY med_id",
+                                  (user_id,)).fetchall()
+        return tuple(_medicine(r) for r in rows)
+    return _medicines_by_user.get_or_load(user_id, load)
 
-def get_medicine(med_id: int):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM medicines WHERE med_id=?", (med_id,))
-    row = cur.fetchone()
-    conn.close()
-    return row
+@metrics.query
+def medicines_page(user_id: int, before: Optional[tuple] = None, after: Optional[tuple] = None,
+                   limit: int = 10) -> Page:
+    """A page of the user's medicines, most recently added first; cursors are (med_id,).
 
+    Same keyset semantics as exercises_page, applied to the cached list.
+    """
+    meds = list_medicines(user_id)
+    if after is not None:
+        newer = [m for m in meds if m.med_id > after[0]]
+        rows = newer[:limit][::-1]
+        has_older, has_newer = True, len(newer) > limit
+    else:
+        older = [m for m in reversed(meds) if before is None or m.med_id < before[0]]
+        rows = older[:limit]
+        has_older, has_newer = len(older) > limit, before is not None
+    if not rows:
+        return Page(rows, None, None)
+    return Page(rows, (rows[-1].med_id,) if has_older else None, (rows[0].med_id,) if has_newer else None)
+
+@metrics.query
+def get_medicine(med_id: int) -> Optional[Medicine]:
+    def load():
+        row = get_conn().execute(f"SELECT {_MEDICINE_COLUMNS} FROM medicines WHERE med_id=?", (med_id,)).fetchone()
+        return _medicine(row) if row is not None else None
+    return _medicine_by_id.get_or_load(med_id, load)
+
+@metrics.query
 def delete_medicine(med_id: int, user_id: int):
     # delete the med row (we keep med_logs history intact)
     conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM medicines WHERE med_id=? AND user_id=?", (med_id, user_id))
-    conn.commit()
-    conn.close()
+    with conn:
+        cur = conn.execute("DELETE FROM medicines WHERE med_id=? AND user_id=?", (med_id, user_id))
+        if cur.rowcount:
+            conn.execute("DELETE FROM medicine_times WHERE med_id=?", (med_id,))
+    if cur.rowcount:
+        _medicine_by_id.pop(med_id)
+        _medicines_by_user.update(user_id, lambda meds: tuple(m for m in meds if m.med_id != med_id))
+
+def iter_due_doses(slot: str, batch_size: int = 500):
+    """Yield lists of medicines due at `slot` ("HH:MM"), skipping users who blocked the bot."""
+    conn = get_conn()
+    cur = conn.execute("""
+      SELECT m.med_id, m.user_id, m.name, m.dose
+      FROM medicine_times t
+      JOIN medicines m ON m.med_id = t.med_id
+      LEFT JOIN users u ON u.user_id = m.user_id
+      WHERE t.slot=? AND u.blocked_at IS NULL
+      ORDER BY t.med_id
+    """, (slot,))
+    yield from _iter_batches(cur, batch_size)
+
+def due_dose_counts() -> dict:
+    """{"HH:MM": number of doses due} over every slot, skipping users who blocked the bot."""
+    conn = get_conn()
+    return dict(conn.execute("""
+      SELECT t.slot, COUNT(*)
+      FROM medicine_times t
+      JOIN medicines m ON m.med_id = t.med_id
+      LEFT JOIN users u ON u.user_id = m.user_id
+      WHERE u.blocked_at IS NULL
+      GROUP BY t.slot
+    """).fetchall())
+
+def iter_all_medicines(batch_size: int = 1000):
+    """Stream every medicine in med_id order as Medicine lists of `batch_size` (not cached)."""
+    conn = get_conn()
+    cur = conn.execute(f"SELECT {_MEDICINE_COLUMNS} FROM medicines ORDER BY med_id")
+    for rows in _iter_batches(cur, batch_size):
+        yield [_medicine(r) for r in rows]
+
+def _iter_batches(cur, batch_size):
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if not rows:
+            break
+        yield rows
 
 # MED LOGS
+@metrics.query
 def log_med_status(med_id: int, user_id: int, scheduled_short: str, status: str):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("INSERT INTO med_logs (med_id, user_id, scheduled_time, status) VALUES (?,?,?,?)",
-                (med_id, user_id, scheduled_short, status))
-    conn.commit()
-    conn.close()
+    """Record the answer for one dose. Repeated taps replace it instead of adding rows."""
+    day = _dose_day(scheduled_short)
+    # only the dose's owner can change its answer
+    _write("""
+      INSERT INTO med_logs (med_id, user_id, scheduled_time, status) VALUES (?,?,?,?)
+      ON CONFLICT(med_id, scheduled_time) DO UPDATE SET status=excluded.status, logged_at=datetime('now')
+      WHERE med_logs.user_id = excluded.user_id
+    """, (med_id, user_id, scheduled_short, status))
+    # answer the dose in place; a dose sent before the ledger existed gets its row now
+    _write("""
+      INSERT INTO dose_instances (med_id, user_id, due_at, day, status, answered_at)
+      VALUES (?, ?, ?, ?, ?, datetime('now'))
+      ON CONFLICT(med_id, due_at) DO UPDATE SET status=excluded.status, answered_at=excluded.answered_at
+      WHERE dose_instances.user_id = excluded.user_id
+    """, (med_id, user_id, scheduled_short, day, status))
+    _write(_ROLLUP_MEDS_SQL.format(users=":user_id"), {"user_id": user_id, "day": day})
 
+# DOSE LEDGER
+# Every query below is a range scan on ix_dose_instances_user_day (or the
+# (med_id, due_at) key), so its cost depends on the window, not on history.
+# The ledger is complete from LEDGER_SINCE (the day migration 013 ran, unless
+# backfill_dose_ledger() moved it back), but once
+# archive_old_rows() has run only RETENTION_DAYS back; windows are clipped to
+# that, see ledger_start().
+LEDGER_SINCE = "dose_ledger_since"
+class Adherence(NamedTuple):
+    expected: int           # doses due in the window
+    taken: int
+    missed: int             # answered "missed"
+
+    @property
+    def unanswered(self) -> int:
+        return self.expected - self.taken - self.missed
+
+    @property
+    def pct(self) -> int:
+        return int(self.taken * 100 / self.expected) if self.expected else 0
+
+def window_start(days: int) -> str:
+    """First day of the last `days` days, in the bot's timezone."""
+    return (_local_now().date() - timedelta(days=days - 1)).isoformat()
+
+def ledger_start(days: int) -> str:
+    """First day of a `days` window that the ledger fully covers."""
+    start = max(window_start(days), get_state(LEDGER_SINCE) or "")
+    if os.path.exists(ARCHIVE_DB_NAME):
+        start = max(start, (_local_now().date() - timedelta(days=RETENTION_DAYS)).isoformat())
+    return start
+
+@metrics.query
+def adherence(user_id: int, days: int = 7) -> Adherence:
+    """Doses due, taken and missed over the last `days` days, from the ledger."""
+    flush()
+    row = get_conn().execute("""
+      SELECT COUNT(*), COALESCE(SUM(status='taken'), 0), COALESCE(SUM(status='missed'), 0)
+      FROM dose_instances WHERE user_id=? AND day >= ?
+    """, (user_id, ledger_start(days))).fetchone()
+    return Adherence(*row)
+
+@metrics.query
+def medicine_adherence(user_id: int, days: int = 7):
+    """Per-medicine (med_id, name, expected, taken, missed) over the last `days` days."""
+    flush()
+    return get_conn().execute("""
+      SELECT d.med_id, COALESCE(m.name, '#' || d.med_id) AS name, COUNT(*) AS expected,
+             SUM(d.status IS 'taken') AS taken, SUM(d.status IS 'missed') AS missed
+      FROM dose_instances d LEFT JOIN medicines m ON m.med_id = d.med_id
+      WHERE d.user_id=? AND d.day >= ?
+      GROUP BY d.med_id
+      ORDER BY d.med_id
+    """, (user_id, ledger_start(days))).fetchall()
+
+@metrics.query
+def missed_doses(user_id: int, days: int = 7, limit: int = 20):
+    """Doses answered "missed" or never answered, newest first; today's are left out if still unanswered."""
+    flush()
+    return get_conn().execute("""
+      SELECT d.med_id, COALESCE(m.name, '#' || d.med_id) AS name, m.dose, d.due_at, d.day, d.status
+      FROM dose_instances d LEFT JOIN medicines m ON m.med_id = d.med_id
+      WHERE d.user_id=? AND d.day >= ? AND (d.status='missed' OR (d.status IS NULL AND d.day < ?))
+      ORDER BY d.day DESC, d.due_at DESC
+      LIMIT ?
+    """, (user_id, ledger_start(days), _local_now().date().isoformat(), limit)).fetchall()
+
+@metrics.query
 def taken_count_last_7_days(user_id: int):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("""
-      SELECT COUNT(*) as taken FROM med_logs
-      WHERE user_id=? AND status='taken' AND logged_at >= datetime('now','-7 days')
-    """, (user_id,))
-    row = cur.fetchone()
-    conn.close()
-    return row["taken"] or 0
+    return adherence(user_id, 7).taken
 
+@metrics.query
 def expected_doses_last_7_days(user_id: int):
-    """Estimate expected doses in last 7 days based on medicine created_at and times count."""
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT times, created_at FROM medicines WHERE user_id=?", (user_id,))
-    rows = cur.fetchall()
-    conn.close()
-    total_expected = 0
-    today = datetime.utcnow().date()
-    for r in rows:
-        times = json.loads(r["times"] or "[]")
-        if not times:
-            continue
-        # parse created_at to date
-        try:
-            created_dt = datetime.strptime(r["created_at"], "%Y-%m-%d %H:%M:%S")
-        except Exception:
+    return adherence(user_id, 7).expected
+
+# ROLLUPS
+# Daily per-user totals, updated alongside every exercise / med_log write so
+# long windows and streaks read one row per day instead of raw history.
+_ROLLUP_EXERCISE_SQL = """
+  INSERT INTO rollup_exercise (user_id, day, name, minutes) VALUES (?,?,?,?)
+  ON CONFLICT(user_id, day, name) DO UPDATE SET minutes = minutes + excluded.minutes
+"""
+# medicine rows are recounted from the dose ledger for :day and the users
+# selected by {users}, so rollup_meds and dose_instances always agree
+_ROLLUP_MEDS_SQL = """
+  INSERT INTO rollup_meds (user_id, day, expected, taken, missed)
+  SELECT user_id, day, COUNT(*), SUM(status IS 'taken'), SUM(status IS 'missed') FROM dose_instances
+  WHERE day=:day AND user_id IN ({users})
+  GROUP BY user_id
+  ON CONFLICT(user_id, day) DO UPDATE SET
+    expected = excluded.expected, taken = excluded.taken, missed = excluded.missed
+"""
+
+# SQL twin of _dose_day() for med_logs rows
+_DOSE_DAY_SQL = """CASE WHEN scheduled_time GLOB '[0-9][0-9][0-9][0-9][0-9][0-9][0-9][0-9]*'
+                    THEN substr(scheduled_time, 1, 4) || '-' || substr(scheduled_time, 5, 2)
+                         || '-' || substr(scheduled_time, 7, 2)
+                    ELSE date(logged_at) END"""
+
+def _local_now():
+    return datetime.now(pytz.timezone(DEFAULT_TZ))
+
+def _dose_day(scheduled_short: str) -> str:
+    """Day a dose belongs to, from its YYYYMMDDHHMM reminder timestamp."""
+    if scheduled_short and scheduled_short[:8].isdigit() and len(scheduled_short) >= 8:
+        return f"{scheduled_short[:4]}-{scheduled_short[4:6]}-{scheduled_short[6:8]}"
+    return _local_now().date().isoformat()
+
+def record_expected_doses(slot: str, due_at: str):
+    """Open a ledger row for every dose due at `slot` ("HH:MM") and recount the rollups;
+    `due_at` is the minute as YYYYMMDDHHMM. Same doses as iter_due_doses()."""
+    day = _dose_day(due_at)
+    _write("""
+      INSERT OR IGNORE INTO dose_instances (med_id, user_id, due_at, day)
+      SELECT m.med_id, m.user_id, ?, ? FROM medicine_times t
+      JOIN medicines m ON m.med_id = t.med_id
+      LEFT JOIN users u ON u.user_id = m.user_id
+      WHERE t.slot=? AND u.blocked_at IS NULL
+    """, (due_at, day, slot))
+    _write(_ROLLUP_MEDS_SQL.format(users="""
+      SELECT m.user_id FROM medicine_times t JOIN medicines m ON m.med_id = t.med_id WHERE t.slot=:slot
+    """), {"day": day, "slot": slot})
+
+def record_expected_dose(med_id: int, user_id: int, due_at: str):
+    day = _dose_day(due_at)
+    _write("INSERT OR IGNORE INTO dose_instances (med_id, user_id, due_at, day) VALUES (?,?,?,?)",
+           (med_id, user_id, due_at, day))
+    _write(_ROLLUP_MEDS_SQL.format(users=":user_id"), {"user_id": user_id, "day": day})
+
+ROLLUPS_PENDING = "rollups_rebuild_pending"   # set by migration 006 over existing history
+
+def _rollups_pending(conn) -> bool:
+    if conn.execute("SELECT 1 FROM main.sqlite_master WHERE name='scheduler_state'").fetchone() is None:
+        return False
+    return conn.execute("SELECT 1 FROM main.scheduler_state WHERE name=?", (ROLLUPS_PENDING,)).fetchone() is not None
+
+def _rebuild_rollups(conn, with_archive=False):
+    now = _local_now()
+    exercises = "exercises"
+    med_logs = f"(SELECT user_id, status, {_DOSE_DAY_SQL} AS day FROM main.med_logs)"
+    if with_archive:
+        exercises = "(SELECT user_id, date, name, minutes FROM main.exercises UNION ALL " \
+                    "SELECT user_id, date, name, minutes FROM archive.exercises)"
+        med_logs = f"(SELECT user_id, status, {_DOSE_DAY_SQL} AS day FROM main.med_logs UNION ALL " \
+                   "SELECT user_id, status, day FROM archive.med_logs)"
+    conn.execute("DELETE FROM rollup_exercise")
+    conn.execute("DELETE FROM rollup_meds")
+    conn.execute(f"""
+      INSERT INTO rollup_exercise (user_id, day, name, minutes)
+      SELECT user_id, date, name, SUM(COALESCE(minutes, 0)) FROM {exercises}
+      WHERE user_id IS NOT NULL AND date IS NOT NULL AND name IS NOT NULL
+      GROUP BY user_id, date, name
+    """)
+    # expected: every daily time of every current medicine from the day it was
+    # added. Each user's daily total only changes on days a medicine was added,
+    # so it is computed per change and then repeated up to the next one.
+    params = {"today": now.date().isoformat(), "hhmm": now.strftime("%H:%M")}
+    conn.execute("""
+      WITH RECURSIVE
+      added AS (
+        SELECT m.user_id, date(m.created_at) AS d, COUNT(*) AS n
+        FROM medicines m JOIN medicine_times t ON t.med_id = m.med_id
+        GROUP BY m.user_id, d
+      ),
+      steps AS (
+        SELECT user_id, d, SUM(n) OVER (PARTITION BY user_id ORDER BY d) AS total,
+               MIN(COALESCE(LEAD(d) OVER (PARTITION BY user_id ORDER BY d), :today), :today) AS until
+        FROM added
+      ),
+      days(user_id, d, total, until) AS (
+        SELECT user_id, d, total, until FROM steps WHERE d < until
+        UNION ALL
+        SELECT user_id, date(d, '+1 day'), total, until FROM days WHERE date(d, '+1 day') < until
+      )
+      INSERT INTO rollup_meds (user_id, day, expected) SELECT user_id, d, total FROM days
+    """, params)
+    # today only counts the slots that have already come round
+    conn.execute("""
+      INSERT INTO rollup_meds (user_id, day, expected)
+      SELECT m.user_id, :today, COUNT(*)
+      FROM medicines m JOIN medicine_times t ON t.med_id = m.med_id
+      WHERE date(m.created_at) <= :today AND t.slot <= :hhmm
+      GROUP BY m.user_id
+      ON CONFLICT(user_id, day) DO UPDATE SET expected = excluded.expected
+    """, params)
+    conn.execute(f"""
+      INSERT INTO rollup_meds (user_id, day, taken, missed)
+      SELECT user_id, day, SUM(status='taken'), SUM(status='missed') FROM {med_logs}
+      WHERE user_id IS NOT NULL AND status IN ('taken', 'missed')
+      GROUP BY user_id, day
+      ON CONFLICT(user_id, day) DO UPDATE SET taken = excluded.taken, missed = excluded.missed
+    """)
+    # from LEDGER_SINCE on, the medicine rows are the dose ledger's counts
+    since = _ledger_since(conn)
+    if since is not None:
+        ledger = "main.dose_instances"
+        if with_archive:
+            ledger = "(SELECT user_id, day, status FROM main.dose_instances " \
+                     "UNION ALL SELECT user_id, day, status FROM archive.dose_instances)"
+        conn.execute("DELETE FROM rollup_meds WHERE day >= ?", (since,))
+        conn.execute(f"""
+          INSERT INTO rollup_meds (user_id, day, expected, taken, missed)
+          SELECT user_id, day, COUNT(*), SUM(status IS 'taken'), SUM(status IS 'missed') FROM {ledger}
+          WHERE day >= ? GROUP BY user_id, day
+        """, (since,))
+    conn.execute("DELETE FROM main.scheduler_state WHERE name=?", (ROLLUPS_PENDING,))
+
+def _ledger_since(conn) -> Optional[str]:
+    # None before migration 013 (also while older migrations rebuild the rollups)
+    if conn.execute("SELECT 1 FROM main.sqlite_master WHERE name='scheduler_state'").fetchone() is None:
+        return None
+    row = conn.execute("SELECT value FROM main.scheduler_state WHERE name=?", (LEDGER_SINCE,)).fetchone()
+    return row[0] if row is not None else None
+
+def rebuild_rollups():
+    """Recompute the rollup tables from exercises, med_logs, the dose ledger (hot and archived) and medicines."""
+    flush()
+    conn = get_conn()
+    with_archive = os.path.exists(ARCHIVE_DB_NAME)
+    if with_archive:
+        _attach_archive(conn)
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        _rebuild_rollups(conn, with_archive)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        if with_archive:
+            conn.execute("DETACH DATABASE archive")
+
+def _local_minute(utc: Optional[str]) -> Optional[str]:
+    """datetime('now')-style UTC text as the bot's local YYYYMMDDHHMM (the dose due_at format)."""
+    if not utc:
+        return None
+    at = pytz.utc.localize(datetime.strptime(utc[:19], "%Y-%m-%d %H:%M:%S"))
+    return at.astimezone(pytz.timezone(DEFAULT_TZ)).strftime("%Y%m%d%H%M")
+
+def backfill_dose_ledger(since: str) -> int:
+    """Add the doses the current medicines imply for the days from `since` up to LEDGER_SINCE; returns how many.
+
+    An estimate: today's reminder times are assumed for every past day, from
+    the minute each medicine was added until its user blocked the bot. Days go
+    newest first, each in its own transaction that also moves LEDGER_SINCE and
+    recounts the day's medicine rollups, so the bot can keep running.
+    """
+    flush()
+    conn = get_conn()
+    if os.path.exists(ARCHIVE_DB_NAME):
+        # older answers are archived, not in the ledger
+        since = max(since, (_local_now().date() - timedelta(days=RETENTION_DAYS)).isoformat())
+    conn.create_function("local_minute", 1, _local_minute, deterministic=True)
+    day = date.fromisoformat(_ledger_since(conn) or _local_now().date().isoformat())
+    added = 0
+    while (day - timedelta(days=1)).isoformat() >= since:
+        day -= timedelta(days=1)
+        params = {"day": day.isoformat(), "ymd": day.strftime("%Y%m%d")}
+        with conn:
+            added += conn.execute("""
+              INSERT OR IGNORE INTO dose_instances (med_id, user_id, due_at, day)
+              SELECT med_id, user_id, due_at, :day FROM (
+                SELECT m.med_id, m.user_id, :ymd || replace(t.slot, ':', '') AS due_at, m.created_at, u.blocked_at
+                FROM medicines m JOIN medicine_times t ON t.med_id = m.med_id
+                LEFT JOIN users u ON u.user_id = m.user_id
+              )
+              WHERE due_at >= local_minute(created_at)
+                AND (blocked_at IS NULL OR due_at < local_minute(blocked_at))
+            """, params).rowcount
+            conn.execute("DELETE FROM rollup_meds WHERE day=:day", params)
+            conn.execute("""
+              INSERT INTO rollup_meds (user_id, day, expected, taken, missed)
+              SELECT user_id, day, COUNT(*), SUM(status IS 'taken'), SUM(status IS 'missed') FROM dose_instances
+              WHERE day=:day GROUP BY user_id
+            """, params)
+            conn.execute("INSERT OR REPLACE INTO scheduler_state (name, value) VALUES (?, ?)",
+                         (LEDGER_SINCE, params["day"]))
+    return added
+
+# RETENTION
+# Raw exercises / med_logs older than the hot window move to a separate
+# archive database file. The rollups keep every statistic for those days, so
+# they are reconciled against the full raw history right before each move.
+_ARCHIVED_ROWS = metrics.Counter("healthbot_archived_rows_total", "Rows moved to the archive database.", ["table"])
+
+def _attach_archive(conn):
+    if not any(r["name"] == "archive" for r in conn.execute("PRAGMA database_list")):
+        conn.execute("ATTACH DATABASE ? AS archive", (ARCHIVE_DB_NAME,))
+    conn.execute("PRAGMA archive.journal_mode=WAL")
+    conn.execute(f"PRAGMA archive.synchronous={DB_SYNCHRONOUS}")
+    with conn:
+        conn.execute("""
+          CREATE TABLE IF NOT EXISTS archive.exercises (
+            id INTEGER PRIMARY KEY, user_id INTEGER, name TEXT, minutes REAL, date TEXT, created_at TEXT
+          )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS archive.ix_exercises_date ON exercises(date)")
+        conn.execute("""
+          CREATE TABLE IF NOT EXISTS archive.med_logs (
+            id INTEGER PRIMARY KEY, med_id INTEGER, user_id INTEGER, scheduled_time TEXT,
+            status TEXT, logged_at TEXT,
+            day TEXT               -- dose day, as in rollup_meds
+          )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS archive.ix_med_logs_day ON med_logs(day)")
+        conn.execute("CREATE INDEX IF NOT EXISTS archive.ix_exercises_user ON exercises(user_id, date)")
+        conn.execute("CREATE INDEX IF NOT EXISTS archive.ix_med_logs_user ON med_logs(user_id, day)")
+        conn.execute("""
+          CREATE TABLE IF NOT EXISTS archive.dose_instances (
+            id INTEGER PRIMARY KEY, med_id INTEGER, user_id INTEGER, due_at TEXT, day TEXT,
+            status TEXT, answered_at TEXT
+          )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS archive.ix_dose_instances_user_day ON dose_instances(user_id, day)")
+
+def _reconcile_rollups(conn, cutoff: str):
+    """Recompute rollups for every day that still has raw rows older than `cutoff`."""
+    since = _ledger_since(conn) or "9999-12-31"   # medicine days from here on come from the ledger
+    conn.execute("""
+      INSERT INTO rollup_exercise (user_id, day, name, minutes)
+      SELECT user_id, date, name, SUM(COALESCE(minutes, 0)) FROM (
+        SELECT user_id, date, name, minutes FROM main.exercises WHERE date < :cutoff
+        UNION ALL
+        SELECT user_id, date, name, minutes FROM archive.exercises
+        WHERE date IN (SELECT DISTINCT date FROM main.exercises WHERE date < :cutoff)
+      )
+      WHERE user_id IS NOT NULL AND name IS NOT NULL
+      GROUP BY user_id, date, name
+      ON CONFLICT(user_id, day, name) DO UPDATE SET minutes = excluded.minutes
+    """, {"cutoff": cutoff})
+    conn.execute(f"""
+      INSERT INTO rollup_meds (user_id, day, taken, missed)
+      SELECT user_id, day, SUM(status='taken'), SUM(status='missed') FROM (
+        SELECT user_id, status, {_DOSE_DAY_SQL} AS day FROM main.med_logs WHERE {_DOSE_DAY_SQL} < :cutoff
+        UNION ALL
+        SELECT user_id, status, day FROM archive.med_logs
+        WHERE day IN (SELECT DISTINCT {_DOSE_DAY_SQL} FROM main.med_logs WHERE {_DOSE_DAY_SQL} < :cutoff)
+      )
+      WHERE user_id IS NOT NULL AND status IN ('taken', 'missed') AND day < :since
+      GROUP BY user_id, day
+      ON CONFLICT(user_id, day) DO UPDATE SET taken = excluded.taken, missed = excluded.missed
+    """, {"cutoff": cutoff, "since": since})
+    conn.execute("""
+      INSERT INTO rollup_meds (user_id, day, expected, taken, missed)
+      SELECT user_id, day, COUNT(*), SUM(status IS 'taken'), SUM(status IS 'missed') FROM (
+        SELECT user_id, day, status FROM main.dose_instances WHERE day < :cutoff
+        UNION ALL
+        SELECT user_id, day, status FROM archive.dose_instances
+        WHERE day IN (SELECT DISTINCT day FROM main.dose_instances WHERE day < :cutoff)
+      )
+      WHERE day >= :since
+      GROUP BY user_id, day
+      ON CONFLICT(user_id, day) DO UPDATE SET
+        expected = excluded.expected, taken = excluded.taken, missed = excluded.missed
+    """, {"cutoff": cutoff, "since": since})
+
+def _move_chunks(conn, table, old_sql, copy_sql, cutoff, chunk_size) -> int:
+    """Copy then delete rows matching `old_sql`, lowest ids first, one transaction per chunk."""
+    moved = 0
+    while True:
+        with conn:
+            hi = conn.execute(f"SELECT MAX(id) FROM (SELECT id FROM main.{table} WHERE {old_sql} ORDER BY id LIMIT ?)",
+                              (cutoff, chunk_size)).fetchone()[0]
+            if hi is None:
+                return moved
+            # OR IGNORE: a chunk copied by an interrupted run is not copied twice
+            conn.execute(copy_sql + f" WHERE id <= ? AND {old_sql}", (hi, cutoff))
+            n = conn.execute(f"DELETE FROM main.{table} WHERE id <= ? AND {old_sql}", (hi, cutoff)).rowcount
+        moved += n
+        _ARCHIVED_ROWS.labels(table).inc(n)
+        time.sleep(0.01)  # let queued writers in between chunks
+
+def archive_old_rows(hot_days: int, chunk_size: int = 2000) -> dict:
+    """Move exercises, med_logs and dose_instances older than `hot_days` days to ARCHIVE_DB_NAME."""
+    started = time.monotonic()
+    flush()
+    conn = get_conn()
+    _attach_archive(conn)
+    cutoff = (_local_now().date() - timedelta(days=hot_days)).isoformat()
+    try:
+        with conn:
+            _reconcile_rollups(conn, cutoff)
+        exercises = _move_chunks(conn, "exercises", "date < ?", """
+          INSERT OR IGNORE INTO archive.exercises (id, user_id, name, minutes, date, created_at)
+          SELECT id, user_id, name, minutes, date, created_at FROM main.exercises""", cutoff, chunk_size)
+        med_logs = _move_chunks(conn, "med_logs", f"{_DOSE_DAY_SQL} < ?", f"""
+          INSERT OR IGNORE INTO archive.med_logs (id, med_id, user_id, scheduled_time, status, logged_at, day)
+          SELECT id, med_id, user_id, scheduled_time, status, logged_at, {_DOSE_DAY_SQL} FROM main.med_logs""",
+                              cutoff, chunk_size)
+        doses = _move_chunks(conn, "dose_instances", "day < ?", """
+          INSERT OR IGNORE INTO archive.dose_instances (id, med_id, user_id, due_at, day, status, answered_at)
+          SELECT id, med_id, user_id, due_at, day, status, answered_at FROM main.dose_instances""",
+                             cutoff, chunk_size)
+    finally:
+        conn.execute("DETACH DATABASE archive")
+    stats = {"cutoff": cutoff, "exercises": exercises, "med_logs": med_logs, "dose_instances": doses,
+             "seconds": round(time.monotonic() - started, 2)}
+    logger.info("archived rows before %s: %d exercises, %d med_logs, %d dose_instances in %.2fs",
+                cutoff, exercises, med_logs, doses, stats["seconds"])
+    return stats
+
+def incremental_vacuum(pages: int) -> int:
+    """Release up to `pages` free pages back to the filesystem. Returns the free pages left."""
+    conn = get_conn()
+    if conn.execute("PRAGMA freelist_count").fetchone()[0]:
+        # executescript steps the pragma to completion; execute() would free a single page
+        conn.executescript(f"PRAGMA incremental_vacuum({int(pages)})")
+    return conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+# EXPORT
+HISTORY_COLUMNS = ("record", "date", "name", "minutes", "dose", "status", "scheduled_time", "logged_at")
+
+def iter_user_history(user_id: int, batch_size: int = 500):
+    """Stream one user's exercises and dose answers, archived ones included, oldest first.
+
+    Yields lists of HISTORY_COLUMNS rows straight from the cursors, so memory use
+    does not depend on how long the user's history is.
+    """
+    flush()
+    conn = get_conn()
+    sources = ["main"]
+    if os.path.exists(ARCHIVE_DB_NAME):
+        _attach_archive(conn)
+        sources.insert(0, "archive")  # archived rows are all older than the hot ones
+    queries = [f"""
+      SELECT 'exercise', date, name, minutes, NULL, NULL, NULL, created_at
+      FROM {src}.exercises WHERE user_id=? ORDER BY date, id
+    """ for src in sources]
+    for src in sources:
+        day = "l.day" if src == "archive" else _DOSE_DAY_SQL  # medicines has no clashing columns
+        queries.append(f"""
+          SELECT 'medicine', {day}, COALESCE(m.name, '#' || l.med_id), NULL, m.dose, l.status,
+                 l.scheduled_time, l.logged_at
+          FROM {src}.med_logs l LEFT JOIN main.medicines m ON m.med_id = l.med_id
+          WHERE l.user_id=? ORDER BY l.scheduled_time, l.id
+        """)
+    try:
+        for sql in queries:
+            cur = conn.execute(sql, (user_id,))
             try:
-                created_dt = datetime.fromisoformat(r["created_at"])
-            except Exception:
-                created_dt = datetime.utcnow()
-        created_date = created_dt.date()
-        days_active = (today - created_date).days + 1
-        if days_active < 0:
-            days_active = 0
-        days_count = min(7, days_active)
-        total_expected += days_count * len(times)
-    return total_expected
+                yield from _iter_batches(cur, batch_size)
+            finally:
+                cur.close()
+    finally:
+        if "archive" in sources:
+            conn.execute("DETACH DATABASE archive")
+
+# LEASES
+def acquire_lease(name: str, holder: str, ttl: float) -> bool:
+    """Take or renew lease `name` for `ttl` seconds. True if `holder` owns it afterwards."""
+    now = time.time()
+    conn = get_conn()
+    with conn:
+        conn.execute("""
+          INSERT INTO leases (name, holder, expires_at, acquired_at) VALUES (:name, :holder, :expires, :now)
+          ON CONFLICT(name) DO UPDATE SET
+            holder = excluded.holder,
+            expires_at = excluded.expires_at,
+            acquired_at = CASE WHEN leases.holder = excluded.holder THEN leases.acquired_at ELSE excluded.acquired_at END
+          WHERE leases.holder = excluded.holder OR leases.expires_at < :now
+        """, {"name": name, "holder": holder, "expires": now + ttl, "now": now})
+        row = conn.execute("SELECT holder FROM leases WHERE name=?", (name,)).fetchone()
+    return row is not None and row["holder"] == holder
+
+def release_lease(name: str, holder: str):
+    conn = get_conn()
+    with conn:
+        conn.execute("DELETE FROM leases WHERE name=? AND holder=?", (name, holder))
+
+def get_lease(name: str):
+    return get_conn().execute("SELECT * FROM leases WHERE name=?", (name,)).fetchone()
+
+# SCHEDULER STATE
+def get_state(name: str) -> Optional[str]:
+    row = get_conn().execute("SELECT value FROM scheduler_state WHERE name=?", (name,)).fetchone()
+    return row["value"] if row is not None else None
+
+def set_state(name: str, value: str):
+    conn = get_conn()
+    with conn:
+        conn.execute("""
+          INSERT INTO scheduler_state (name, value) VALUES (?,?)
+          ON CONFLICT(name) DO UPDATE SET value=excluded.value, updated_at=datetime('now')
+        """, (name, value))
+
+# PROGRESS REPORT
+class ProgressSummary(NamedTuple):
+    days: int               # length of the window
+    exercise_days: int
+    total_minutes: int
+    most_common: Optional[str]
+    taken: int
+    expected: int
+
+    @property
+    def adherence_pct(self) -> int:
+        return int(self.taken * 100 / self.expected) if self.expected else 0
+
+@metrics.query
+def progress_summary(user_id: int, days: int = 7) -> ProgressSummary:
+    """All /progress metrics for the last `days` days, read from the daily rollups."""
+    flush()  # rollups of just-logged exercises and doses are still queued
+    conn = get_conn()
+    row = conn.execute("""
+      WITH ex AS (
+        SELECT day, name, minutes FROM rollup_exercise
+        WHERE user_id=:uid AND day >= :ex_since AND minutes > 0
+      ),
+      ex_totals AS (
+        SELECT COUNT(DISTINCT day) AS exercise_days, SUM(minutes) AS total_minutes FROM ex
+      ),
+      top_activity AS (
+        SELECT name FROM ex GROUP BY name ORDER BY SUM(minutes) DESC LIMIT 1
+      ),
+      meds AS (
+        SELECT SUM(taken) AS taken, SUM(expected) AS expected FROM rollup_meds
+        WHERE user_id=:uid AND day >= :med_since
+      )
+      SELECT ex_totals.exercise_days, ex_totals.total_minutes,
+             (SELECT name FROM top_activity) AS most_common,
+             meds.taken, meds.expected
+      FROM ex_totals, meds
+    """, {"uid": user_id,
+          "ex_since": (date.today() - timedelta(days=days - 1)).isoformat(),
+          "med_since": (_local_now().date() - timedelta(days=days - 1)).isoformat()}).fetchone()
+    return ProgressSummary(
+        days=days,
+        exercise_days=row["exercise_days"] or 0,
+        total_minutes=int(row["total_minutes"] or 0),
+        most_common=row["most_common"],
+        taken=row["taken"] or 0,
+        expected=int(row["expected"] or 0),
+    )
+
+class Streaks(NamedTuple):
+    exercise_current: int   # consecutive days with any exercise, up to today
+    exercise_best: int
+    meds_current: int       # consecutive days with every expected dose taken
+    meds_best: int
+
+def _streak_lengths(days, today: date):
+    """(current, longest) run of consecutive dates among ISO `days`.
+
+    The current run survives until a whole day is missed, so an empty
+    today does not break it yet.
+    """
+    ordinals = sorted({date.fromisoformat(d).toordinal() for d in days})
+    ordinals = [o for o in ordinals if o <= today.toordinal()]
+    longest = run = 0
+    prev = None
+    for o in ordinals:
+        run = run + 1 if prev is not None and o == prev + 1 else 1
+        longest = max(longest, run)
+        prev = o
+    current = run if ordinals and ordinals[-1] >= today.toordinal() - 1 else 0
+    return current, longest
+
+@metrics.query
+def streaks(user_id: int, lookback_days: int = 365) -> Streaks:
+    """Exercise and medicine streaks over the last `lookback_days` days of rollups."""
+    flush()  # rollups of just-logged exercises and doses are still queued
+    conn = get_conn()
+    ex_today = date.today()
+    med_today = _local_now().date()
+    ex_days = [r["day"] for r in conn.execute("""
+      SELECT DISTINCT day FROM rollup_exercise WHERE user_id=? AND day >= ? AND minutes > 0
+    """, (user_id, (ex_today - timedelta(days=lookback_days)).isoformat()))]
+    med_days = [r["day"] for r in conn.execute("""
+      SELECT day FROM rollup_meds WHERE user_id=? AND day >= ? AND expected > 0 AND taken >= expected
+    """, (user_id, (med_today - timedelta(days=lookback_days)).isoformat()))]
+    ex_current, ex_best = _streak_lengths(ex_days, ex_today)
+    med_current, med_best = _streak_lengths(med_days, med_today)
+    return Streaks(ex_current, ex_best, med_current, med_best)
+
+# BOT STATE (conversations / user_data persistence)
+@metrics.query
+def load_conversations(name: str, max_age: int = 0):
+    """Saved conversation states; with `max_age` (seconds), older ones are deleted instead."""
+    conn = get_conn()
+    if max_age > 0:
+        flush()
+        with conn:
+            conn.execute("DELETE FROM conversations WHERE name=? AND updated_at < datetime('now', ?)",
+                         (name, f"-{max_age} seconds"))
+    return conn.execute("SELECT key, state FROM conversations WHERE name=?", (name,)).fetchall()
+
+@metrics.query
+def load_conversation(name: str, key: str):
+    """One saved conversation: its state and age in seconds, or None."""
+    return get_conn().execute("""
+      SELECT state, CAST(strftime('%s','now') - strftime('%s', updated_at) AS INTEGER) AS age
+      FROM conversations WHERE name=? AND key=?
+    """, (name, key)).fetchone()
+
+@metrics.query
+def save_conversation(name: str, key: str, state: Optional[int]):
+    if state is None:
+        _write("DELETE FROM conversations WHERE name=? AND key=?", (name, key))
+    else:
+        _write("INSERT OR REPLACE INTO conversations (name, key, state, updated_at) VALUES (?,?,?,datetime('now'))",
+               (name, key, state))
+
+@metrics.query
+def load_user_data(user_id: int) -> Optional[str]:
+    conn = get_conn()
+    row = conn.execute("SELECT data FROM user_data WHERE user_id=?", (user_id,)).fetchone()
+    return row["data"] if row else None
+
+@metrics.query
+def save_user_data(user_id: int, data: Optional[str]):
+    if data is None:
+        _write("DELETE FROM user_data WHERE user_id=?", (user_id,))
+    else:
+        _write("""
+          INSERT INTO user_data (user_id, data) VALUES (?,?)
+          ON CONFLICT(user_id) DO UPDATE SET data=excluded.data, updated_at=datetime('now')
+        """, (user_id, data))
@@ -0,0 +1,319 @@
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from typing import Optional
+
+from telegram.error import BadRequest, NetworkError, RetryAfter, Unauthorized
+
+import db
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Thread-safe token bucket: `rate` tokens per second, bursts up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def try_acquire(self) -> float:
+        """Take a token if one is available. Returns 0, or the seconds to wait."""
+        with self._lock:
+            now = time.monotonic()
+            if now < self._paused_until:
+                return self._paused_until - now
+            self._refill(now)
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        """Hand out no tokens for `seconds` (used for Telegram's RetryAfter)."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0
+
+
+class DeliveryRun:
+    """Per-run counters for one broadcast or reminder batch."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.monotonic()
+        self.finished = None
+        self.submitted = 0
+        self.sent = 0
+        self.failed = 0
+        self.blocked = 0
+        self.retried = 0
+        self._closed = False
+
+    def summary(self) -> dict:
+        elapsed = (self.finished or time.monotonic()) - self.started
+        return {
+            "run": self.name, "submitted": self.submitted, "sent": self.sent, "failed": self.failed,
+            "blocked": self.blocked, "retried": self.retried, "seconds": round(elapsed, 2),
+            "per_second": round(self.sent / elapsed, 1) if elapsed > 0 else 0.0,
+        }
+
+    @property
+    def done(self) -> bool:
+        return self._closed and self.sent + self.failed + self.blocked >= self.submitted
+
+
+class _Item:
+    __slots__ = ("method", "chat_id", "kwargs", "run", "attempts", "urgent")
+
+    def __init__(self, method, chat_id, kwargs, run, urgent=False):
+        self.method = method
+        self.chat_id = chat_id
+        self.kwargs = kwargs
+        self.run = run
+        self.attempts = 0
+        self.urgent = urgent
+
+
+class DeliveryQueue:
+    """Worker pool that sends Telegram messages under a global rate limit.
+
+    - a token bucket caps the global send rate; RetryAfter pauses the bucket
+    - messages to the same chat are spaced at least `per_chat_interval` apart
+    - network errors are retried with exponential backoff, up to `max_retries`
+    - Unauthorized / "chat not found" marks the user as blocked in the db
+    - interactive items (button feedback) have their own queue, served first
+    """
+
+    def __init__(self, bot, workers: int = 8, rate: float = 25.0, per_chat_interval: float = 1.0,
+                 max_retries: int = 3, backoff: float = 2.0):
+        self.bot = bot
+        self.workers = workers
+        self.per_chat_interval = per_chat_interval
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.bucket = TokenBucket(rate)
+        self.sent = 0
+        self.failed = 0
+        self.blocked = 0
+        self.retried = 0
+        self._heap = []          # (ready_at, seq, item)
+        self._urgent = []        # same, for interactive items
+        self._seq = itertools.count()
+        self._chat_next = {}     # chat_id -> earliest monotonic time of the next send
+        self._in_flight = 0
+        self._cond = threading.Condition()
+        self._threads = []
+        self._stopping = False
+
+    # ---- lifecycle ----
+    def start(self):
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, name=f"delivery-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self, timeout: float = 10.0):
+        """Give pending messages up to `timeout` seconds to drain, then stop the workers."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while (self._heap or self._urgent or self._in_flight) and time.monotonic() < deadline:
+                self._cond.wait(0.1)
+            self._stopping = True
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join(timeout=1)
+        self._threads = []
+
+    # ---- producers ----
+    def start_run(self, name: str) -> DeliveryRun:
+        return DeliveryRun(name)
+
+    def close_run(self, run: DeliveryRun):
+        """No more messages will be submitted for `run`; logs its summary once drained."""
+        with self._cond:
+            run._closed = True
+            self._maybe_finish(run)
+
+    def submit(self, chat_id: int, text: str, run: Optional[DeliveryRun] = None, **kwargs):
+        kwargs["text"] = text
+        self._push(_Item("send_message", chat_id, kwargs, run), new=True)
+
+    def submit_edit(self, chat_id: int, message_id: int, text: str, **kwargs):
+        """Edit a message the user is looking at (button feedback), ahead of any bulk sends."""
+        kwargs.update(message_id=message_id, text=text)
+        self._push(_Item("edit_message_text", chat_id, kwargs, None, urgent=True))
+
+    def submit_answer(self, chat_id: int, callback_query_id: str):
+        """Answer a button tap no handler will see (dropped by flood control), ahead of any bulk sends."""
+        self._push(_Item("answer_callback_query", chat_id, {"callback_query_id": callback_query_id}, None,
+                         urgent=True))
+
+    def submit_batch(self, messages, run: Optional[DeliveryRun] = None, spread: float = 0.0):
+        """Queue many (chat_id, text, kwargs) tuples under a single lock acquisition.
+
+        With `spread`, each message becomes ready at a random point in the next
+        `spread` seconds instead of all at once.
+        """
+        now = time.monotonic()
+        with self._cond:
+            for chat_id, text, kwargs in messages:
+                kwargs["text"] = text
+                if run is not None:
+                    run.submitted += 1
+                ready_at = now + random.uniform(0, spread) if spread else now
+                heapq.heappush(self._heap, (ready_at, next(self._seq), _Item("send_message", chat_id, kwargs, run)))
+            self._cond.notify_all()
+
+    def depth(self) -> int:
+        with self._cond:
+            return len(self._heap) + len(self._urgent)
+
+    # ---- internals ----
+    def _push(self, item, ready_at=None, new=False):
+        if ready_at is None:
+            ready_at = time.monotonic()
+        with self._cond:
+            if new and item.run is not None:
+                item.run.submitted += 1
+            heapq.heappush(self._urgent if item.urgent else self._heap, (ready_at, next(self._seq), item))
+            self._cond.notify()
+
+    def _next(self):
+        with self._cond:
+            while True:
+                if self._stopping:
+                    return None
+                wait = None
+                for heap in (self._urgent, self._heap):
+                    if heap:
+                        until = heap[0][0] - time.monotonic()
+                        if until <= 0:
+                            self._in_flight += 1
+                            return heapq.heappop(heap)[2]
+                        wait = until if wait is None else min(wait, until)
+                self._cond.wait(wait)
+
+    def _reserve_chat(self, chat_id) -> float:
+        """Claim the next send slot for `chat_id`. Returns 0, or when the chat is free again."""
+        with self._cond:
+            now = time.monotonic()
+            ready = self._chat_next.get(chat_id, 0.0)
+            if ready > now:
+                return ready
+            self._chat_next[chat_id] = now + self.per_chat_interval
+            if len(self._chat_next) > 10000:
+                self._chat_next = {c: t for c, t in self._chat_next.items() if t > now}
+            return 0.0
+
+    def _worker(self):
+        while True:
+            item = self._next()
+            if item is None:
+                return
+            try:
+                self._deliver(item)
+            finally:
+                with self._cond:
+                    self._in_flight -= 1
+                    self._cond.notify_all()
+
+    def _deliver(self, item):
+        # an answer is not a message in the chat, so the chat's spacing does not apply
+        answer = item.method == "answer_callback_query"
+        ready = 0.0 if answer else self._reserve_chat(item.chat_id)
+        if ready:
+            self._requeue(item, ready)
+            return
+        self.bucket.acquire()
+        try:
+            started = time.perf_counter()
+            try:
+                if answer:
+                    self.bot.answer_callback_query(**item.kwargs)
+                else:
+                    getattr(self.bot, item.method)(chat_id=item.chat_id, **item.kwargs)
+            finally:
+                metrics.SEND_SECONDS.labels(item.method).observe(time.perf_counter() - started)
+        except RetryAfter as e:
+            metrics.SEND_RESULTS.labels("rate_limited").inc()
+            logger.warning("delivery: rate limited by Telegram, pausing %.1fs", e.retry_after)
+            self.bucket.pause(e.retry_after)
+            self._requeue(item, time.monotonic() + e.retry_after)
+        except Unauthorized:
+            self._blocked(item)
+        except BadRequest as e:
+            if "chat not found" in str(e).lower():
+                self._blocked(item)
+            elif "message is not modified" in str(e).lower():
+                self._finish(item, "sent")  # repeated tap; the message already shows this
+            else:
+                logger.warning("delivery: %s to %s rejected: %s", item.method, item.chat_id, e)
+                self._finish(item, "failed")
+        except NetworkError as e:
+            item.attempts += 1
+            if item.attempts > self.max_retries:
+                logger.warning("delivery: giving up on %s after %d attempts: %s", item.chat_id, item.attempts, e)
+                self._finish(item, "failed")
+            else:
+                self._count("retried", item.run)
+                self._requeue(item, time.monotonic() + self.backoff * 2 ** (item.attempts - 1))
+        except Exception:
+            logger.exception("delivery: unexpected error sending to %s", item.chat_id)
+            self._finish(item, "failed")
+        else:
+            self._finish(item, "sent")
+
+    def _requeue(self, item, ready_at):
+        with self._cond:
+            heapq.heappush(self._urgent if item.urgent else self._heap, (ready_at, next(self._seq), item))
+            self._cond.notify()
+
+    def _blocked(self, item):
+        try:
+            db.mark_user_blocked(item.chat_id)
+        except Exception:
+            logger.exception("delivery: could not mark user %s as blocked", item.chat_id)
+        self._finish(item, "blocked")
+
+    def _count(self, field, run):
+        metrics.SEND_RESULTS.labels(field).inc()
+        with self._cond:
+            setattr(self, field, getattr(self, field) + 1)
+            if run is not None:
+                setattr(run, field, getattr(run, field) + 1)
+
+    def _finish(self, item, outcome):
+        self._count(outcome, item.run)
+        if item.run is not None:
+            with self._cond:
+                self._maybe_finish(item.run)
+
+    def _maybe_finish(self, run):
+        # called with self._cond held
+        if run.done and run.finished is None:
+            run.finished = time.monotonic()
+            if not run.submitted:
+                return
+            s = run.summary()
+            logger.info("delivery run %s: %d sent, %d failed, %d blocked, %d retried in %.1fs (%.1f msg/s)",
+                        s["run"], s["sent"], s["failed"], s["blocked"], s["retried"], s["seconds"], s["per_second"])
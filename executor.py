@@ -0,0 +1,128 @@
+import logging
+import queue
+import threading
+import time
+
+from telegram.ext import Dispatcher
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class OrderedExecutor:
+    """Fixed set of single-threaded lanes with bounded queues.
+
+    Work submitted with the same key always lands on the same lane, so it runs
+    in submission order; different keys run in parallel across lanes. When a
+    lane's queue is full, submit() blocks (backpressure) and the wait is counted.
+    """
+
+    def __init__(self, lanes: int = 8, queue_size: int = 1000, name: str = "lane"):
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(lanes)]
+        self._threads = []
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.blocked_submits = 0
+        self.blocked_seconds = 0.0
+        self.high_water = 0
+        for i, q in enumerate(self._queues):
+            t = threading.Thread(target=self._run, args=(q,), name=f"{name}-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, key, fn, *args):
+        q = self._queues[hash(key) % len(self._queues)]
+        item = (fn, args)
+        try:
+            q.put_nowait(item)
+        except queue.Full:
+            started = time.monotonic()
+            q.put(item)
+            with self._lock:
+                self.blocked_submits += 1
+                self.blocked_seconds += time.monotonic() - started
+        with self._lock:
+            self.submitted += 1
+            self.high_water = max(self.high_water, q.qsize())
+
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "lanes": len(self._queues), "depth": self.depth(), "high_water": self.high_water,
+                "submitted": self.submitted, "completed": self.completed, "failed": self.failed,
+                "blocked_submits": self.blocked_submits, "blocked_seconds": round(self.blocked_seconds, 3),
+            }
+
+    def shutdown(self):
+        """Finish everything already queued, then stop the lanes."""
+        for q in self._queues:
+            q.put(_STOP)
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+    def _run(self, q):
+        while True:
+            item = q.get()
+            if item is _STOP:
+                return
+            fn, args = item
+            try:
+                fn(*args)
+            except Exception:
+                logger.exception("unhandled error in %s", threading.current_thread().name)
+                with self._lock:
+                    self.failed += 1
+            with self._lock:
+                self.completed += 1
+
+
+class OrderedDispatcher(Dispatcher):
+    """Dispatcher that runs handlers on an OrderedExecutor instead of its own thread.
+
+    Updates are keyed by user (falling back to chat), so one user's updates are
+    handled strictly in order - ConversationHandler state stays consistent -
+    while different users are served in parallel.
+    """
+
+    def __init__(self, *args, lanes: int = 8, lane_queue_size: int = 1000, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.executor = OrderedExecutor(lanes, lane_queue_size, name="handler-lane")
+        self.admit = None   # admit(update) -> bool, e.g. throttle.Throttle.admit
+
+    def process_update(self, update):
+        # flood control runs here, so a dropped update never takes a place on a lane
+        if self.admit is not None and not self.admit(update):
+            return
+        key = _ordering_key(update)
+        if key is None:
+            super().process_update(update)
+        else:
+            self.executor.submit(key, super().process_update, update)
+
+    def update_persistence(self, update=None):
+        # Without an update (after every job-queue job, and on shutdown) PTB would
+        # serialise every user in memory. Each handled update already writes its
+        # own user back, so only those calls do anything here.
+        if update is not None:
+            super().update_persistence(update)
+
+    def stop(self):
+        super().stop()
+        self.executor.shutdown()
+
+
+def _ordering_key(update):
+    user = getattr(update, "effective_user", None)
+    if user is not None:
+        return user.id
+    chat = getattr(update, "effective_chat", None)
+    if chat is not None:
+        return chat.id
+    return None
@@ -0,0 +1,150 @@
+"""Leader election over a lease row in the shared SQLite database.
+
+Every process runs a LeaderElector for the same lease name; the one holding
+the lease is the leader. It renews the lease every `heartbeat` seconds, and if
+it stops (crash, kill -9, hung disk) any other process takes the lease once it
+expires, i.e. within ttl + heartbeat seconds.
+
+Try it on one machine:
+    python leader.py --spawn 3
+starts three contenders on DB_NAME, kills whichever becomes leader and reports
+how long the others took to elect a new one.
+"""
+import logging
+import os
+import socket
+import threading
+import time
+from typing import Callable, Optional
+
+import db
+import metrics
+
+logger = logging.getLogger(__name__)
+
+_IS_LEADER = metrics.Gauge("healthbot_is_leader", "1 while this process holds the lease.", ["lease"])
+
+
+class LeaderElector:
+    def __init__(self, name: str, ttl: float = 10.0, heartbeat: float = 3.0,
+                 on_elected: Optional[Callable] = None, on_demoted: Optional[Callable] = None,
+                 on_heartbeat: Optional[Callable] = None, holder: Optional[str] = None):
+        if heartbeat >= ttl:
+            raise ValueError("heartbeat must be shorter than the lease ttl")
+        self.name = name
+        self.ttl = ttl
+        self.heartbeat = heartbeat
+        self.holder = holder or f"{socket.gethostname()}:{os.getpid()}"
+        self.on_elected = on_elected
+        self.on_demoted = on_demoted
+        self.on_heartbeat = on_heartbeat
+        self.is_leader = False
+        self._valid_until = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=f"lease-{self.name}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop renewing and hand the lease back so another process can take it at once."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self.is_leader:
+            self._set_leader(False)
+            try:
+                db.release_lease(self.name, self.holder)
+            except Exception:
+                logger.exception("could not release lease %s", self.name)
+
+    def _run(self):
+        while not self._stop.is_set():
+            started = time.time()
+            try:
+                leader = db.acquire_lease(self.name, self.holder, self.ttl)
+                if leader:
+                    self._valid_until = started + self.ttl
+            except Exception:
+                logger.exception("lease %s: renewal failed", self.name)
+                # keep leading only while the last successful renewal still covers us
+                leader = self.is_leader and time.time() + self.heartbeat < self._valid_until
+            self._set_leader(leader)
+            if leader and self.on_heartbeat:
+                self.on_heartbeat()
+            self._stop.wait(self.heartbeat)
+
+    def _set_leader(self, leader: bool):
+        if leader == self.is_leader:
+            return
+        self.is_leader = leader
+        _IS_LEADER.labels(self.name).set(1 if leader else 0)
+        logger.info("lease %s: %s %s", self.name, self.holder, "elected leader" if leader else "stepped down")
+        callback = self.on_elected if leader else self.on_demoted
+        if callback:
+            try:
+                callback()
+            except Exception:
+                logger.exception("lease %s: leadership callback failed", self.name)
+
+
+def _contend(name, ttl, heartbeat):
+    elector = LeaderElector(name, ttl, heartbeat)
+    elector.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        elector.stop()
+
+
+def _spawn(n, name, ttl, heartbeat):
+    import subprocess
+    import sys
+    args = [sys.executable, os.path.abspath(__file__), "--name", name, "--ttl", str(ttl), "--heartbeat", str(heartbeat)]
+    procs = {}
+    for _ in range(n):
+        p = subprocess.Popen(args)
+        procs[p.pid] = p
+
+    def wait_for_leader(exclude=None, timeout=ttl * 3):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            row = db.get_lease(name)
+            if row is not None and row["holder"] != exclude and row["expires_at"] > time.time():
+                return row["holder"]
+            time.sleep(0.1)
+        return None
+
+    try:
+        first = wait_for_leader()
+        print(f"leader: {first}")
+        pid = int(first.rsplit(":", 1)[1])
+        procs.pop(pid).kill()  # no clean release: the others must wait for the lease to expire
+        killed_at = time.time()
+        second = wait_for_leader(exclude=first)
+        if second is None:
+            print("no new leader elected")
+            return 1
+        print(f"killed {first}; {second} took over after {time.time() - killed_at:.1f}s")
+        return 0
+    finally:
+        for p in procs.values():
+            p.terminate()
+            p.wait()
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Run a lease contender, or a local failover demo.")
+    parser.add_argument("--name", default="demo")
+    parser.add_argument("--ttl", type=float, default=5.0)
+    parser.add_argument("--heartbeat", type=float, default=1.0)
+    parser.add_argument("--spawn", type=int, default=0, help="start this many contenders and kill the leader")
+    opts = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(process)d %(message)s")
+    db.init_db()
+    if opts.spawn:
+        raise SystemExit(_spawn(opts.spawn, opts.name, opts.ttl, opts.heartbeat))
+    _contend(opts.name, opts.ttl, opts.heartbeat)
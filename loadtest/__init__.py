@@ -0,0 +1,18 @@
+"""End-to-end load test: the real bot against a local fake Telegram Bot API.
+
+Run from the repository root:
+
+    python -m loadtest                                # 50 users for 60s, polling
+    python -m loadtest --users 500 --duration 180 --mode webhook
+    python -m loadtest --out load.json
+    python -m loadtest --baseline load.json           # exit 1 on regressions
+
+Bot.py runs unmodified in a subprocess on a throw-away database, with
+TELEGRAM_API_URL pointing at loadtest.fake_api. Simulated users drive
+/add_medicine, /log_exercise, /progress and the Taken/Missed buttons, and the
+run reports throughput, p50/p99 latency and error rates per flow. Medicines
+are scheduled for a minute inside the run, so runs of two minutes or more also
+measure the reminder burst. Other settings (HANDLER_LANES, DELIVERY_RATE, ...)
+are passed through from the environment; per-user flood control is off unless
+THROTTLE_RATE / THROTTLE_CALLBACK_WINDOW are set.
+"""
@@ -0,0 +1,157 @@
+import argparse
+import math
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import pytz
+
+from benchmarks.runner import Results, compare, load, save
+from config import DEFAULT_TZ
+
+from .fake_api import FakeBotAPI
+from .users import FLOWS, SimulatedUser, Stats
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_for_port(port, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def _reminder_slot(lead_seconds=60):
+    """First whole minute at least `lead_seconds` away, as "HH:MM" in the bot's timezone."""
+    at = datetime.now(pytz.timezone(DEFAULT_TZ)) + timedelta(seconds=lead_seconds + 59)
+    return at.strftime("%H:%M")
+
+
+def start_bot(api, tmp, mode, log):
+    """Bot.py in a subprocess talking to `api`; returns (process, webhook port or None)."""
+    env = dict(os.environ, DB_NAME=os.path.join(tmp, "loadtest.db"), TELEGRAM_API_URL=api.base_url,
+               TELEGRAM_TOKEN="123456:LOADTEST-TOKEN-NOT-USED-xxxxxxxxxxx", BOT_MODE=mode,
+               METRICS_PORT="0", LEADER_ELECTION="0", PYTHONUNBUFFERED="1")
+    # simulated users type far faster than people; flood control stays off unless asked for
+    env.setdefault("THROTTLE_RATE", "0")
+    env.setdefault("THROTTLE_CALLBACK_WINDOW", "0")
+    port = None
+    if mode == "webhook":
+        port = _free_port()
+        env.update(WEBHOOK_LISTEN="127.0.0.1", WEBHOOK_PORT=str(port), WEBHOOK_PATH="hook",
+                   WEBHOOK_URL=f"http://127.0.0.1:{port}")
+        env.pop("PORT", None)
+    proc = subprocess.Popen([sys.executable, "Bot.py"], cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+    return proc, port
+
+
+def stop_bot(api, proc):
+    if proc.poll() is None:
+        proc.send_signal(signal.SIGINT)
+        api.release_polls()
+        try:
+            proc.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+
+def report(results, stats, users, elapsed):
+    prefix = f"loadtest[{users}u]"
+    steps = sum(len(v) for v in stats.latencies.values())
+    errors = sum(stats.errors.values())
+    results.add(f"{prefix}.throughput", steps / elapsed, "steps/s", lower_is_better=False)
+    results.add(f"{prefix}.error_rate", 100 * errors / max(1, steps + errors), "%")
+    for flow in FLOWS:
+        lat = stats.latencies.get(flow)
+        if lat:
+            results.add(f"{prefix}.{flow}_p50", percentile(lat, 50) * 1e3, "ms")
+            results.add(f"{prefix}.{flow}_p99", percentile(lat, 99) * 1e3, "ms")
+        results.add(f"{prefix}.{flow}_completed", stats.flows.get(flow, 0), "flows", lower_is_better=None)
+        results.add(f"{prefix}.{flow}_errors", stats.errors.get(flow, 0), "errors", lower_is_better=None)
+    if stats.reminder_lags:
+        results.add(f"{prefix}.reminders_received", len(stats.reminder_lags), "msgs", lower_is_better=None)
+        results.add(f"{prefix}.reminder_lag_p50", percentile(stats.reminder_lags, 50) * 1e3, "ms")
+        results.add(f"{prefix}.reminder_lag_p99", percentile(stats.reminder_lags, 99) * 1e3, "ms")
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(prog="python -m loadtest", description="Load-test the bot against a fake Bot API.")
+    p.add_argument("--users", type=int, default=50, help="concurrent simulated users")
+    p.add_argument("--duration", type=float, default=60, help="seconds of load")
+    p.add_argument("--mode", choices=("polling", "webhook"), default="polling", help="how updates reach the bot")
+    p.add_argument("--think", type=float, default=1.0, help="mean pause between a user's flows, seconds")
+    p.add_argument("--timeout", type=float, default=10, help="seconds to wait for an answer before counting an error")
+    p.add_argument("--seed", type=int, default=42)
+    p.add_argument("--out", help="write results as JSON to this file")
+    p.add_argument("--baseline", help="compare against a previous --out file; exit 1 on regressions")
+    p.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown vs baseline (default 0.2)")
+    args = p.parse_args(argv)
+
+    api = FakeBotAPI()
+    api.start()
+    with tempfile.TemporaryDirectory(prefix="healthbot-load-") as tmp:
+        log_path = os.path.join(tmp, "bot.log")
+        with open(log_path, "wb") as log:
+            proc, hook_port = start_bot(api, tmp, args.mode, log)
+            try:
+                if not api.ready.wait(30) or (hook_port and not _wait_for_port(hook_port, 30)):
+                    raise SystemExit(f"bot did not come up; log:\n{open(log_path).read()}")
+                slot = _reminder_slot()
+                print(f"== {args.users} users for {args.duration:.0f}s over {args.mode}; "
+                      f"medicines due at {slot} {DEFAULT_TZ}", flush=True)
+                stats = Stats()
+                started = time.monotonic()
+                users = [SimulatedUser(api, 10_000 + i, stats, started + args.duration, slot,
+                                       think=args.think, timeout=args.timeout, seed=args.seed + i)
+                         for i in range(args.users)]
+                for u in users:
+                    u.start()
+                for u in users:
+                    u.join()
+                elapsed = time.monotonic() - started
+            finally:
+                stop_bot(api, proc)
+                api.stop()
+        if proc.returncode not in (0, -signal.SIGINT):
+            print(f"bot exited with {proc.returncode}; log:\n{open(log_path).read()}")
+
+    results = Results()
+    report(results, stats, args.users, elapsed)
+    print(f"  API calls: {dict(api.calls)}")
+    data = results.to_json()
+    if args.out:
+        save(args.out, data)
+        print(f"\nresults written to {args.out}")
+    if args.baseline:
+        regressions = compare(data, load(args.baseline), args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s)")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
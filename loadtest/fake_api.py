@@ -0,0 +1,224 @@
+"""A local stand-in for the Telegram Bot API, good enough to run Bot.py against.
+
+Serves the methods the bot calls (getMe, getUpdates, setWebhook, deleteWebhook,
+sendMessage, editMessageText, answerCallbackQuery) under /bot<token>/<method>
+and files every outbound call in the addressed chat's inbox, where simulated
+users wait for the bot's answers. Updates reach the bot the way Telegram
+delivers them: from getUpdates when polling, or POSTed to the setWebhook URL.
+"""
+import collections
+import itertools
+import json
+import queue
+import threading
+import time
+import urllib.parse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import NamedTuple
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Healthally", "username": "healthally_loadtest_bot"}
+
+
+class Outbound(NamedTuple):
+    method: str
+    params: dict
+    at: float       # time.monotonic() when the bot made the call
+
+
+class ApiError(Exception):
+    def __init__(self, code, description):
+        super().__init__(description)
+        self.code = code
+        self.description = description
+
+
+class FakeBotAPI:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self.server = ThreadingHTTPServer((host, port), _make_handler(self))
+        self.server.daemon_threads = True
+        self.base_url = f"http://{host}:{self.server.server_address[1]}/bot"
+        self.webhook_url = None
+        self.ready = threading.Event()      # set once the bot polls or registers its webhook
+        self.calls = collections.Counter()  # method -> number of calls
+        self._updates = []                  # waiting for getUpdates
+        self._cond = threading.Condition()
+        self._closing = False
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._ids = itertools.count(1)
+        self._inboxes = {}
+        self._callbacks = {}                # callback_query id -> chat id
+        self._lock = threading.Lock()
+        self._methods = {
+            "getme": lambda p: BOT_USER,
+            "getupdates": self._get_updates,
+            "setwebhook": self._set_webhook,
+            "deletewebhook": self._delete_webhook,
+            "sendmessage": self._send_message,
+            "editmessagetext": self._edit_message_text,
+            "answercallbackquery": self._answer_callback_query,
+        }
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="fake-bot-api", daemon=True).start()
+
+    def stop(self):
+        self.release_polls()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def release_polls(self):
+        """Answer pending getUpdates long polls at once (lets the bot shut down quickly)."""
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+
+    def inbox(self, chat_id: int) -> queue.Queue:
+        with self._lock:
+            return self._inboxes.setdefault(int(chat_id), queue.Queue())
+
+    # ---- updates towards the bot ----
+    def message(self, user_id: int, text: str):
+        msg = {"message_id": next(self._ids), "date": int(time.time()), "text": text,
+               "chat": {"id": user_id, "type": "private"},
+               "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}}
+        if text.startswith("/"):
+            msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        self._push({"message": msg})
+
+    def callback(self, user_id: int, data: str, message_id: int):
+        query_id = str(next(self._ids))
+        with self._lock:
+            self._callbacks[query_id] = user_id
+        self._push({"callback_query": {
+            "id": query_id, "chat_instance": str(user_id), "data": data,
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            "message": {"message_id": message_id, "date": int(time.time()), "text": "",
+                        "chat": {"id": user_id, "type": "private"}, "from": BOT_USER},
+        }})
+
+    def _push(self, update):
+        update["update_id"] = next(self._update_ids)
+        if self.webhook_url:
+            req = urllib.request.Request(self.webhook_url, json.dumps(update).encode(),
+                                         {"Content-Type": "application/json"})
+            urllib.request.urlopen(req, timeout=10).read()
+        else:
+            with self._cond:
+                self._updates.append(update)
+                self._cond.notify_all()
+
+    # ---- Bot API methods ----
+    def call(self, method: str, params: dict):
+        fn = self._methods.get(method.lower())
+        with self._lock:
+            self.calls[method] += 1
+        if fn is None:
+            raise ApiError(404, f"Not Found: method {method} is not implemented by the fake API")
+        return fn(params)
+
+    def _get_updates(self, params):
+        self.ready.set()
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        deadline = time.monotonic() + float(params.get("timeout") or 0)
+        with self._cond:
+            self._updates = [u for u in self._updates if u["update_id"] >= offset]
+            while not self._updates and not self._closing:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    break
+                self._cond.wait(left)
+            return self._updates[:limit]
+
+    def _set_webhook(self, params):
+        self.webhook_url = params.get("url") or None
+        self.ready.set()
+        return True
+
+    def _delete_webhook(self, params):
+        self.webhook_url = None
+        return True
+
+    def _outbound(self, chat_id, method, params):
+        self.inbox(chat_id).put(Outbound(method, params, time.monotonic()))
+
+    def _message_result(self, params, message_id):
+        msg = {"message_id": message_id, "date": int(time.time()), "from": BOT_USER,
+               "chat": {"id": int(params["chat_id"]), "type": "private"}, "text": params.get("text", "")}
+        if params.get("reply_markup"):
+            msg["reply_markup"] = params["reply_markup"]
+        return msg
+
+    def _send_message(self, params):
+        result = self._message_result(params, next(self._message_ids))
+        self._outbound(params["chat_id"], "sendMessage", dict(params, message_id=result["message_id"]))
+        return result
+
+    def _edit_message_text(self, params):
+        if "chat_id" not in params:
+            raise ApiError(400, "Bad Request: inline messages are not supported by the fake API")
+        self._outbound(params["chat_id"], "editMessageText", params)
+        return self._message_result(params, int(params["message_id"]))
+
+    def _answer_callback_query(self, params):
+        with self._lock:
+            chat_id = self._callbacks.pop(str(params.get("callback_query_id")), None)
+        if chat_id is None:
+            raise ApiError(400, "Bad Request: query is too old and response timeout expired or query id is invalid")
+        self._outbound(chat_id, "answerCallbackQuery", params)
+        return True
+
+
+def _parse_body(handler):
+    length = int(handler.headers.get("Content-Length") or 0)
+    body = handler.rfile.read(length) if length else b""
+    ctype = handler.headers.get("Content-Type", "")
+    if ctype.startswith("application/json"):
+        params = json.loads(body or b"{}")
+    else:
+        params = dict(urllib.parse.parse_qsl(body.decode()))
+    params.update(urllib.parse.parse_qsl(urllib.parse.urlsplit(handler.path).query))
+    # nested objects (reply_markup) arrive JSON-encoded
+    for key, value in params.items():
+        if isinstance(value, str) and value[:1] in "{[":
+            try:
+                params[key] = json.loads(value)
+            except ValueError:
+                pass
+    return params
+
+
+def _make_handler(api: FakeBotAPI):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"   # keep-alive, like the real API
+
+        def _handle(self):
+            parts = urllib.parse.urlsplit(self.path).path.strip("/").split("/")
+            if len(parts) != 2 or not parts[0].startswith("bot"):
+                self._reply(404, {"ok": False, "error_code": 404, "description": "Not Found"})
+                return
+            try:
+                result = api.call(parts[1], _parse_body(self))
+            except ApiError as e:
+                self._reply(e.code, {"ok": False, "error_code": e.code, "description": e.description})
+            except (KeyError, ValueError) as e:
+                self._reply(400, {"ok": False, "error_code": 400, "description": f"Bad Request: {e}"})
+            else:
+                self._reply(200, {"ok": True, "result": result})
+
+        do_GET = do_POST = _handle
+
+        def _reply(self, code, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, fmt, *args):
+            pass
+
+    return Handler
@@ -0,0 +1,175 @@
+"""Simulated users driving the bot's real conversations through the fake API."""
+import queue
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+
+import pytz
+
+from config import DEFAULT_TZ
+
+FLOWS = ("add_medicine", "log_exercise", "progress", "button")
+
+
+class StepFailed(Exception):
+    pass
+
+
+class Stats:
+    """Latencies (seconds) and errors per flow, shared by every simulated user."""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)   # flow -> seconds from update to the bot's answer
+        self.errors = defaultdict(int)
+        self.flows = defaultdict(int)        # completed flows
+        self.reminder_lags = []              # seconds from a dose's minute to its arrival
+        self._lock = threading.Lock()
+
+    def step(self, flow, seconds):
+        with self._lock:
+            self.latencies[flow].append(seconds)
+
+    def done(self, flow):
+        with self._lock:
+            self.flows[flow] += 1
+
+    def error(self, flow):
+        with self._lock:
+            self.errors[flow] += 1
+
+    def reminder(self, lag):
+        with self._lock:
+            self.reminder_lags.append(lag)
+
+
+def _slot_epoch(sched_short):
+    tz = pytz.timezone(DEFAULT_TZ)
+    return tz.localize(datetime.strptime(sched_short, "%Y%m%d%H%M")).timestamp()
+
+
+class SimulatedUser(threading.Thread):
+    """Loops over random flows until `deadline`, waiting for every answer before the next message."""
+
+    def __init__(self, api, user_id, stats, deadline, reminder_slot, think=1.0, timeout=10.0, seed=None):
+        super().__init__(name=f"user-{user_id}", daemon=True)
+        self.api = api
+        self.user_id = user_id
+        self.stats = stats
+        self.deadline = deadline
+        self.reminder_slot = reminder_slot    # "HH:MM" every medicine is scheduled for
+        self.think = think
+        self.timeout = timeout
+        self.rng = random.Random(seed)
+        self.inbox = api.inbox(user_id)
+        self.med_ids = []
+        self.reminders = []                   # (message_id, callback_data) not tapped yet
+
+    def run(self):
+        try:
+            self._send(None, lambda: self.api.message(self.user_id, "/start"), "sendMessage")
+        except StepFailed:
+            self.stats.error("start")
+        while time.monotonic() < self.deadline:
+            flow = self.rng.choice(FLOWS)
+            if flow == "button" and not (self.med_ids or self.reminders):
+                flow = "add_medicine"
+            try:
+                getattr(self, flow)()
+                self.stats.done(flow)
+            except StepFailed:
+                self.stats.error(flow)
+                self._recover()
+            time.sleep(self.think * self.rng.random() * 2)
+
+    # ---- flows ----
+    def add_medicine(self):
+        self.say("add_medicine", "/add_medicine", "Medicine name")
+        self.say("add_medicine", f"Loadtestamol {self.rng.randint(1, 999)}", "Dose")
+        self.say("add_medicine", "1 tablet", "time")
+        answer = self.say("add_medicine", self.reminder_slot, "Saved medicine #")
+        self.med_ids.append(int(re.search(r"#(\d+)", answer).group(1)))
+
+    def log_exercise(self):
+        self.say("log_exercise", "/log_exercise", "What exercise")
+        self.say("log_exercise", self.rng.choice(("walking", "cycling", "yoga")), "Duration")
+        self.say("log_exercise", str(self.rng.randint(5, 60)), "Logged")
+
+    def progress(self):
+        self.say("progress", "/progress", "summary")
+
+    def button(self):
+        """Tap Taken/Missed on a reminder: a real one if it arrived, else one for a saved medicine."""
+        if self.reminders:
+            message_id, data = self.reminders.pop()
+        else:
+            sched = datetime.now(pytz.timezone(DEFAULT_TZ)).strftime("%Y%m%d%H%M")
+            message_id, data = 1, f"MED|{self.rng.choice(self.med_ids)}|{sched}|taken"
+        if self.rng.random() < 0.2:
+            data = data.rsplit("|", 1)[0] + "|missed"
+        self._send("button", lambda: self.api.callback(self.user_id, data, message_id), "answerCallbackQuery")
+        edit = self._send("button", None, "editMessageText")
+        if "Logged" not in edit.params.get("text", ""):
+            raise StepFailed(f"unexpected edit {edit.params.get('text')!r}")
+
+    # ---- plumbing ----
+    def say(self, flow, text, expect):
+        """Send `text` and return the bot's reply, which must contain `expect`."""
+        reply = self._send(flow, lambda: self.api.message(self.user_id, text), "sendMessage")
+        answer = reply.params.get("text", "")
+        if expect not in answer:
+            raise StepFailed(f"{text!r} got {answer!r}")
+        return answer
+
+    def _send(self, flow, push, method):
+        """Push an update (if any) and wait for the bot's next `method` call to this chat."""
+        started = time.monotonic()
+        if push is not None:
+            try:
+                push()
+            except OSError as e:
+                raise StepFailed(f"update not accepted: {e}")
+        deadline = started + self.timeout
+        while True:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                raise StepFailed(f"no {method} within {self.timeout}s")
+            try:
+                out = self.inbox.get(timeout=left)
+            except queue.Empty:
+                continue
+            if out.method == "sendMessage" and self._is_reminder(out):
+                continue
+            if out.method != method:
+                continue  # e.g. a late answer to a step that already timed out
+            if flow is not None:
+                self.stats.step(flow, out.at - started)
+            return out
+
+    def _is_reminder(self, out):
+        markup = out.params.get("reply_markup") or {}
+        rows = markup.get("inline_keyboard") if isinstance(markup, dict) else None
+        data = rows[0][0].get("callback_data", "") if rows and rows[0] else ""
+        if not data.startswith(("MED|", "EX|")):
+            return False
+        if data.startswith("MED|"):
+            self.stats.reminder(time.time() - _slot_epoch(data.split("|")[2]))
+            self.reminders.append((out.params["message_id"], data))
+        return True
+
+    def _recover(self):
+        """Leave whatever conversation a failed step left open and drop stale answers."""
+        try:
+            self.api.message(self.user_id, "/cancel")
+        except OSError:
+            pass
+        time.sleep(1)
+        while True:
+            try:
+                out = self.inbox.get_nowait()
+            except queue.Empty:
+                break
+            if out.method == "sendMessage":
+                self._is_reminder(out)
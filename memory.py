@@ -0,0 +1,59 @@
+"""How much dispatcher state the bot holds in memory, by category.
+
+Bot.sweep_state() refreshes the gauges below and logs the report every
+MEMORY_SWEEP_INTERVAL seconds. Sizes are sys.getsizeof() summed over the
+containers and what they hold, so they are estimates, but they show which
+category grows.
+"""
+import sys
+
+from telegram.ext import ConversationHandler
+
+import metrics
+
+STATE_ENTRIES = metrics.Gauge("healthbot_state_entries", "Entries held in dispatcher state, by category.",
+                              ["category"])
+STATE_BYTES = metrics.Gauge("healthbot_state_bytes", "Approximate bytes held in dispatcher state, by category.",
+                            ["category"])
+
+
+def deep_sizeof(obj, _seen=None) -> int:
+    """sys.getsizeof() of `obj` plus the dicts, lists, tuples, sets and strings inside it."""
+    if _seen is None:
+        _seen = set()
+    if id(obj) in _seen:
+        return 0
+    _seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    # list() takes a snapshot, so handler lanes may keep writing meanwhile
+    if isinstance(obj, dict):
+        for k, v in list(obj.items()):
+            size += deep_sizeof(k, _seen) + deep_sizeof(v, _seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for v in list(obj):
+            size += deep_sizeof(v, _seen)
+    return size
+
+
+def dispatcher_state(dispatcher) -> dict:
+    """{category: container} for everything the dispatcher keeps per user or chat."""
+    state = {"user_data": dispatcher.user_data, "chat_data": dispatcher.chat_data}
+    if hasattr(dispatcher.persistence, "state"):
+        state.update(dispatcher.persistence.state())
+    for handlers in list(dispatcher.handlers.values()):
+        for h in handlers:
+            if isinstance(h, ConversationHandler):
+                state[f"conversations:{h.name}"] = h.conversations
+                state[f"conversation_timeouts:{h.name}"] = h.timeout_jobs
+    return state
+
+
+def report(dispatcher) -> dict:
+    """{category: (entries, approximate bytes)}; also sets the gauges."""
+    out = {}
+    for category, container in dispatcher_state(dispatcher).items():
+        entries, size = len(container), deep_sizeof(container)
+        STATE_ENTRIES.labels(category).set(entries)
+        STATE_BYTES.labels(category).set(size)
+        out[category] = (entries, size)
+    return out
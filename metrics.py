@@ -0,0 +1,235 @@
+"""In-process metrics exposed in Prometheus text format.
+
+Cheap enough to leave on: an observation is a bisect plus a few additions under
+a per-series lock. Series are created on first use and cached, so hot paths
+bind them once (see timed()).
+"""
+import bisect
+import functools
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# seconds; covers sub-millisecond SQLite reads up to slow network sends
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_registry = []
+_registry_lock = threading.Lock()
+
+
+def _register(metric):
+    with _registry_lock:
+        _registry.append(metric)
+    return metric
+
+
+def _fmt_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    inner = ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in pairs)
+    return "{" + inner + "}"
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        _register(self)
+
+    def labels(self, *values):
+        values = tuple(str(v) for v in values)
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return "\n".join(lines)
+
+
+class _Value:
+    __slots__ = ("value", "lock")
+
+    def __init__(self):
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1.0):
+        with self.lock:
+            self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1.0):
+        self.labels().inc(amount)
+
+    def _samples(self):
+        return [f"{self.name}{_fmt_labels(self.labelnames, k)} {c.value}" for k, c in list(self._children.items())]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+class _HistogramChild:
+    __slots__ = ("bounds", "counts", "sum", "count", "lock")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help_text, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def _samples(self):
+        out = []
+        for key, child in list(self._children.items()):
+            with child.lock:
+                counts, total, count = list(child.counts), child.sum, child.count
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                out.append(f"{self.name}_bucket{_fmt_labels(self.labelnames, key, [('le', le)])} {cumulative}")
+            out.append(f"{self.name}_sum{_fmt_labels(self.labelnames, key)} {total}")
+            out.append(f"{self.name}_count{_fmt_labels(self.labelnames, key)} {count}")
+        return out
+
+
+class Callback(_Metric):
+    """Value read from a function at scrape time (queue depths, counters kept elsewhere)."""
+
+    def __init__(self, name, help_text, fn, kind="gauge"):
+        self.fn = fn
+        self.kind = kind
+        super().__init__(name, help_text)
+
+    def _samples(self):
+        try:
+            return [f"{self.name} {float(self.fn())}"]
+        except Exception:
+            logger.exception("metrics: callback for %s failed", self.name)
+            return []
+
+
+def render() -> str:
+    with _registry_lock:
+        metrics = list(_registry)
+    return "\n".join(m.render() for m in metrics) + "\n"
+
+
+# ---- shared metrics ----
+HANDLER_SECONDS = Histogram("healthbot_handler_seconds", "Time spent in a bot handler.", ["handler"])
+HANDLER_ERRORS = Counter("healthbot_handler_errors_total", "Handlers that raised.", ["handler"])
+DB_QUERY_SECONDS = Histogram("healthbot_db_query_seconds", "Time spent in a db.py call.", ["query"])
+REMINDER_LAG_SECONDS = Histogram("healthbot_reminder_lag_seconds",
+                                 "Delay between a reminder's scheduled minute and the moment it was dispatched.",
+                                 ["kind"])
+SEND_SECONDS = Histogram("healthbot_send_seconds", "Latency of outbound Telegram API calls.", ["method"])
+SEND_RESULTS = Counter("healthbot_send_total", "Outbound deliveries by outcome.", ["outcome"])
+
+
+def timed(histogram, label, errors=None):
+    """Decorator recording the wrapped function's duration in `histogram{label}`."""
+    def decorator(fn):
+        child = histogram.labels(label)
+        err_child = errors.labels(label) if errors is not None else None
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            except Exception:
+                if err_child is not None:
+                    err_child.inc()
+                raise
+            finally:
+                child.observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+def handler(fn):
+    return timed(HANDLER_SECONDS, fn.__name__, HANDLER_ERRORS)(fn)
+
+
+def query(fn):
+    return timed(DB_QUERY_SECONDS, fn.__name__)(fn)
+
+
+# ---- HTTP exposition ----
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+def start_http_server(port: int, addr: str = "127.0.0.1"):
+    """Serve /metrics in a daemon thread; None if the port is taken (e.g. by another bot process)."""
+    try:
+        server = ThreadingHTTPServer((addr, port), _Handler)
+    except OSError as e:
+        logger.warning("metrics not served on %s:%d: %s", addr, port, e)
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    logger.info("metrics available on http://%s:%d/metrics", addr, port)
+    return server
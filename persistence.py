@@ -0,0 +1,221 @@
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from telegram import Update
+from telegram.ext import BasePersistence, ConversationHandler
+
+import db
+
+logger = logging.getLogger(__name__)
+
+
+class _LazyUserData(defaultdict):
+    """user_data mapping that loads a user's dict from SQLite on first access."""
+
+    def __init__(self, persistence):
+        super().__init__(dict)
+        self._persistence = persistence
+
+    def __getitem__(self, user_id):
+        self._persistence._touch(user_id)
+        return super().__getitem__(user_id)
+
+    def __missing__(self, user_id):
+        data = self._persistence._load_user_data(user_id)
+        self[user_id] = data
+        return data
+
+    # BasePersistence.insert_bot() copies what get_user_data() returns; keep the loader
+    def __copy__(self):
+        return self
+
+    def copy(self):
+        return dict(self)
+
+
+class SQLitePersistence(BasePersistence):
+    """Stores conversation states and user_data in the bot's SQLite database.
+
+    - user_data is loaded per user the first time that user sends an update
+    - only users whose data actually changed are written back
+    - evict_idle() drops idle users' data from memory; SQLite still has it
+    - conversation rows exist only while a conversation is in progress, so
+      loading them at startup costs in-flight conversations, not users; rows
+      idle longer than `conversation_ttl` seconds are dropped instead
+    Writes go through db's write-behind queue; flush() commits them.
+
+    With `shared` (several processes serving the bot), writes are committed
+    at once and each update reloads its user's data, since the previous update
+    may have been handled by another process.
+    """
+
+    def __init__(self, conversation_ttl: int = 0, shared: bool = False):
+        super().__init__(store_user_data=True, store_chat_data=False, store_bot_data=False)
+        self.conversation_ttl = conversation_ttl
+        self.shared = shared
+        self._written = {}        # user_id -> JSON last written (or loaded)
+        self._seen = {}           # user_id -> time.monotonic() of the last access
+        self._user_data = None
+        self._lock = threading.Lock()
+
+    # ---- user_data ----
+    def get_user_data(self):
+        self._user_data = _LazyUserData(self)
+        return self._user_data
+
+    def _touch(self, user_id):
+        with self._lock:
+            self._seen[user_id] = time.monotonic()
+
+    def evict_idle(self, ttl: float) -> int:
+        """Forget the user_data of users not seen for `ttl` seconds; returns how many.
+
+        Every handled update writes its user's data back, so what is dropped is
+        already in SQLite and gets loaded again on the user's next update.
+        """
+        if self._user_data is None:
+            return 0
+        cutoff = time.monotonic() - ttl
+        evicted = 0
+        with self._lock:
+            for user_id, seen in list(self._seen.items()):
+                if seen <= cutoff:
+                    del self._seen[user_id]
+                    self._written.pop(user_id, None)
+                    self._user_data.pop(user_id, None)
+                    evicted += 1
+        return evicted
+
+    def state(self) -> dict:
+        """In-memory bookkeeping by category, for the memory report."""
+        return {"persistence_written": self._written, "persistence_seen": self._seen}
+
+    def _load_user_data(self, user_id):
+        raw = db.load_user_data(user_id)
+        with self._lock:
+            self._written[user_id] = raw
+        return json.loads(raw) if raw else {}
+
+    def update_user_data(self, user_id, data):
+        try:
+            raw = json.dumps(data, sort_keys=True) if data else None
+        except (TypeError, ValueError):
+            logger.warning("user_data for %s is not JSON serialisable; not persisted", user_id)
+            return
+        with self._lock:
+            if self._written.get(user_id) == raw:
+                return
+            self._written[user_id] = raw
+            self._seen.setdefault(user_id, time.monotonic())  # so evict_idle() also drops this entry
+        db.save_user_data(user_id, raw)
+        if self.shared:
+            db.flush()
+
+    def refresh_user_data(self, user_id, user_data):
+        if not self.shared:
+            return  # this process is the only writer; memory is already current
+        raw = db.load_user_data(user_id)
+        with self._lock:
+            if self._written.get(user_id) == raw:
+                return
+            self._written[user_id] = raw
+        user_data.clear()
+        user_data.update(json.loads(raw) if raw else {})
+
+    # ---- conversations ----
+    def get_conversations(self, name):
+        return {tuple(json.loads(r["key"])): r["state"] for r in db.load_conversations(name, self.conversation_ttl)}
+
+    def update_conversation(self, name, key, new_state):
+        if new_state is not None and not isinstance(new_state, int):
+            return  # pending run_async result; the resolved state is stored later
+        db.save_conversation(name, json.dumps(list(key)), new_state)
+        if self.shared:
+            db.flush()
+
+    # ---- unused stores ----
+    def get_chat_data(self):
+        return defaultdict(dict)
+
+    def get_bot_data(self):
+        return {}
+
+    def update_chat_data(self, chat_id, data):
+        pass
+
+    def update_bot_data(self, data):
+        pass
+
+    def flush(self):
+        db.flush()
+
+
+class PersistentConversationHandler(ConversationHandler):
+    """ConversationHandler that checks SQLite for what its own timeout jobs don't cover.
+
+    - a conversation restored at startup has no timeout job; if it has been
+      idle for conversation_timeout when its user's next update arrives, it is
+      timed out then, before that update is handled
+    - with shared persistence, each update re-reads its conversation's state,
+      so a flow started on one process goes on wherever its next step lands; a
+      timeout only ends the conversation if no process has moved it on since
+    """
+
+    def _shared(self) -> bool:
+        return self.persistent and getattr(self.persistence, "shared", False)
+
+    def check_update(self, update):
+        if (self.persistent and isinstance(update, Update) and update.effective_chat is not None
+                and not (self.per_message and update.callback_query is None)):
+            key = self._get_key(update)
+            with self._timeout_jobs_lock:
+                timed = key in self.timeout_jobs
+            with self._conversations_lock:
+                state = self.conversations.get(key)
+            if self._shared() or (self.conversation_timeout and state is not None and not timed):
+                row = db.load_conversation(self.name, json.dumps(list(key)))
+                if self._shared():
+                    with self._conversations_lock:
+                        if not isinstance(self.conversations.get(key), tuple):  # leave pending run_async states be
+                            if row is None:
+                                self.conversations.pop(key, None)
+                            else:
+                                self.conversations[key] = row["state"]
+                if row is not None and self.conversation_timeout and not timed \
+                        and row["age"] >= self.conversation_timeout:
+                    return key, None, None  # handle_update() times it out first
+        return super().check_update(update)
+
+    def handle_update(self, update, dispatcher, check_result, context=None):
+        key, handler, _ = check_result
+        if handler is None:
+            for handler in self.states.get(self.TIMEOUT, []):
+                check = handler.check_update(update)
+                if check is not None and check is not False:
+                    handler.handle_update(update, dispatcher, check, context)
+            self._update_state(self.END, key)
+            # then handle `update` as if no conversation had been going on
+            check_result = super().check_update(update)
+            if check_result is None or check_result is False:
+                return None
+        return super().handle_update(update, dispatcher, check_result, context)
+
+    def _trigger_timeout(self, context, job=None):
+        job = context.job if job is None else job
+        key = job.context.conversation_key
+        if self._shared():
+            row = db.load_conversation(self.name, json.dumps(list(key)))
+            # ended, or moved on by another process whose own timeout covers it
+            # (updated_at has one-second resolution, hence the slack)
+            if row is None or row["age"] < self.conversation_timeout - 1:
+                with self._timeout_jobs_lock:
+                    if self.timeout_jobs.get(key) is job:
+                        del self.timeout_jobs[key]
+                with self._conversations_lock:
+                    self.conversations.pop(key, None)
+                return
+            job.context.callback_context.refresh_data()  # the timeout handlers write user_data back
+        super()._trigger_timeout(context, job)
@@ -1,78 +1,364 @@
-import json
+import logging
+import os
+import threading
+import time
 import pytz
+from apscheduler.events import EVENT_JOB_MISSED
+from apscheduler.executors.pool import ThreadPoolExecutor
+from apscheduler.jobstores.base import JobLookupError
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
-from datetime import datetime
+from datetime import datetime, timedelta
 from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup
-from config import TELEGRAM_TOKEN, DEFAULT_TZ, EXERCISE_REMINDER_HOUR, EXERCISE_REMINDER_MINUTE
+from telegram.utils.request import Request
+from config import (
+    require_token, TELEGRAM_API_URL, DEFAULT_TZ, EXERCISE_REMINDER_HOUR, EXERCISE_REMINDER_MINUTE,
+    DELIVERY_WORKERS, DELIVERY_RATE, DELIVERY_PER_CHAT_INTERVAL, DELIVERY_MAX_RETRIES, DELIVERY_RETRY_BACKOFF,
+    REMINDER_MODE, WHEEL_BATCH_SIZE, BOOTSTRAP_CHUNK_SIZE, DB_NAME, DB_SYNCHRONOUS,
+    RETENTION_DAYS, ARCHIVE_CHUNK_SIZE, ARCHIVE_HOUR, ARCHIVE_MINUTE, VACUUM_PAGES,
+    LEADER_ELECTION, LEADER_LEASE_TTL, LEADER_HEARTBEAT, SCHEDULER_WORKERS, SCHEDULER_MISFIRE_GRACE,
+    REMINDER_JITTER, REMINDER_LATE_SECONDS, MISSED_REMINDER_POLICY, MISSED_REMINDER_WINDOW,
+)
+from delivery import DeliveryQueue
+from leader import LeaderElector
 import db
+import metrics
 
-bot = Bot(token=TELEGRAM_TOKEN)
-scheduler = BackgroundScheduler()
-scheduler.start()
+logger = logging.getLogger(__name__)
+
+_MISSED_RUNS = metrics.Counter("healthbot_scheduler_missed_runs_total",
+                               "Job runs dropped because they could not start within their misfire grace time.",
+                               ["job"])
+_REMINDERS_LATE = metrics.Counter("healthbot_reminders_late_total",
+                                  "Dose reminders sent more than REMINDER_LATE_SECONDS after their minute.", ["kind"])
+_REMINDERS_DROPPED = metrics.Counter("healthbot_reminders_dropped_total", "Dose reminders that were never sent.",
+                                     ["kind", "reason"])
+
+# per-dose jobs live in a persistent store on the bot's own SQLite file, so a
+# restart only has to add/remove the jobs that changed (REMINDER_MODE="jobs")
+MED_JOBSTORE = "meds"
+
+# Created by start(), so importing this module (admin CLI, benchmarks) has no
+# side effects: no Bot, no scheduler thread, no delivery workers.
+med_store = None
+bot = None
+scheduler = None
+delivery = None
+_start_lock = threading.Lock()
+
+def _make_med_store():
+    from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+    from sqlalchemy import event
+    from sqlalchemy.pool import QueuePool
+    # pooled connections: SQLAlchemy's default for SQLite files reconnects on every operation
+    store = SQLAlchemyJobStore(url="sqlite:///" + os.path.abspath(DB_NAME), tablename="apscheduler_med_jobs",
+                               engine_options={"poolclass": QueuePool,
+                                               "connect_args": {"timeout": 30, "check_same_thread": False}})
+
+    @event.listens_for(store.engine, "connect")
+    def _tune_jobstore_conn(dbapi_conn, _record):
+        dbapi_conn.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+    return store
+
+def start():
+    """Create the Bot, start the scheduler and the delivery workers (once per process)."""
+    global med_store, bot, scheduler, delivery
+    with _start_lock:
+        if scheduler is not None:
+            return
+        if REMINDER_MODE == "jobs":
+            med_store = _make_med_store()
+        # one pooled HTTP connection per delivery worker
+        bot = Bot(token=require_token(), base_url=TELEGRAM_API_URL or None,
+                  request=Request(con_pool_size=DELIVERY_WORKERS + 2))
+        scheduler = BackgroundScheduler(
+            jobstores={MED_JOBSTORE: med_store} if med_store else {},
+            executors={"default": ThreadPoolExecutor(SCHEDULER_WORKERS)},
+            job_defaults={"coalesce": True, "max_instances": 1, "misfire_grace_time": SCHEDULER_MISFIRE_GRACE})
+        scheduler.add_listener(_on_job_missed, EVENT_JOB_MISSED)
+        # with leader election every process schedules the same jobs, but only the
+        # lease holder's scheduler is running (see start_leader_election)
+        scheduler.start(paused=LEADER_ELECTION)
+        delivery = DeliveryQueue(bot, workers=DELIVERY_WORKERS, rate=DELIVERY_RATE,
+                                 per_chat_interval=DELIVERY_PER_CHAT_INTERVAL,
+                                 max_retries=DELIVERY_MAX_RETRIES, backoff=DELIVERY_RETRY_BACKOFF)
+        delivery.start()
+        metrics.Callback("healthbot_delivery_queue_depth", "Messages waiting to be sent.", delivery.depth)
+
+def _observe_lag(kind, target=None):
+    """Record how late a reminder started relative to its scheduled minute.
+
+    Cron jobs here fire on a whole minute and are dropped by APScheduler once
+    they miss their grace time, so the target is the current minute unless the
+    caller knows it exactly (the wheel passes each slot).
+    """
+    now = datetime.now(pytz.timezone(DEFAULT_TZ))
+    if target is None:
+        target = now.replace(second=0, microsecond=0)
+    metrics.REMINDER_LAG_SECONDS.labels(kind).observe(max(0.0, (now - target).total_seconds()))
+
+def _count_late(kind, due, n=1):
+    if n and (datetime.now(pytz.timezone(DEFAULT_TZ)) - due).total_seconds() > REMINDER_LATE_SECONDS:
+        _REMINDERS_LATE.labels(kind).inc(n)
+
+def _on_job_missed(event):
+    job = "med" if event.job_id.startswith("med_") and event.job_id != WHEEL_JOB_ID else event.job_id
+    _MISSED_RUNS.labels(job).inc()
+    if job == "med":
+        _REMINDERS_DROPPED.labels("med", "misfire").inc()
+    logger.warning("job %s missed its %s run", event.job_id, event.scheduled_run_time)
 
 # helper to create short timestamp for callback (YYYYMMDDHHMM)in
 def short_now_tz(tzname=DEFAULT_TZ):
     tz = pytz.timezone(tzname)
     return datetime.now(tz).strftime("%Y%m%d%H%M")
 
-def send_med_reminder(med_id: int, user_id: int, med_name: str, dose: str):
-    sched_short = short_now_tz()
+def med_reminder_message(med_id: int, med_name: str, dose: str, sched_short: str):
+    """Text and send_message kwargs for one dose reminder."""
     text = f"💊 Time to take *{med_name}* ({dose}) 💊."
     kb = InlineKeyboardMarkup([[
         InlineKeyboardButton("Taken ✅", callback_data=f"MED|{med_id}|{sched_short}|taken"),
         InlineKeyboardButton("Missed ❌", callback_data=f"MED|{med_id}|{sched_short}|missed"),
     ]])
-    bot.send_message(chat_id=user_id, text=text, reply_markup=kb, parse_mode="Markdown")
+    return text, {"reply_markup": kb, "parse_mode": "Markdown"}
 
-def schedule_med_jobs_for_med(med_row):
-    """med_row is sqlite Row with med_id, user_id, name, dose, times"""
-    times = json.loads(med_row["times"] or "[]")
-    tzname = DEFAULT_TZ
-    for t in times:
+def _dose_minute(slot: str, now):
+    """Latest occurrence of `slot` ("HH:MM") at or before `now`."""
+    tz = pytz.timezone(DEFAULT_TZ)
+    hour, minute = map(int, slot.split(":"))
+    at = tz.localize(now.replace(tzinfo=None, hour=hour, minute=minute, second=0, microsecond=0))
+    return at if at <= now else tz.normalize(at - timedelta(days=1))
+
+def send_med_reminder(med_id: int, user_id: int, med_name: str, dose: str, slot: str = None):
+    med = db.get_medicine(med_id)
+    if med is None or med.user_id != user_id:
+        # deleted, possibly by a process that did not know about this job
+        logger.info("skipping reminder for deleted medicine #%s", med_id)
+        remove_med_jobs(med_id)
+        return
+    med_name, dose = med.name, med.dose
+    now = datetime.now(pytz.timezone(DEFAULT_TZ))
+    # jobs stored before jitter existed carry no slot and fire on their minute
+    due = _dose_minute(slot, now) if slot else now.replace(second=0, microsecond=0)
+    _observe_lag("med", due)
+    _count_late("med", due)
+    sched_short = due.strftime("%Y%m%d%H%M")
+    text, kwargs = med_reminder_message(med_id, med_name, dose, sched_short)
+    delivery.submit(user_id, text, **kwargs)
+    db.record_expected_dose(med_id, user_id, sched_short)
+
+# ---- Reminder wheel (REMINDER_MODE="wheel") ----
+# A single job fires every minute and sends every dose whose medicine_times
+# slot matches, so the job count does not grow with the number of medicines.
+# The last dispatched minute is persisted, so after a restart or a failover the
+# wheel knows which minutes nobody sent (see MISSED_REMINDER_POLICY).
+WHEEL_JOB_ID = "med_reminder_wheel"
+WATERMARK = "wheel_watermark"
+_MAX_LOOKBACK = timedelta(days=7)   # older gaps are not even counted
+_last_slot = None
+
+def dispatch_slot(slot_dt, spread: float = 0.0) -> int:
+    """Send all reminders due at `slot_dt` (a tz-aware minute) in batches; returns how many."""
+    slot = slot_dt.strftime("%H:%M")
+    sched_short = slot_dt.strftime("%Y%m%d%H%M")
+    _observe_lag("med_wheel", slot_dt)
+    run = delivery.start_run(f"med_reminders_{slot}")
+    sent = 0
+    for rows in db.iter_due_doses(slot, WHEEL_BATCH_SIZE):
+        batch = []
+        for r in rows:
+            text, kwargs = med_reminder_message(r["med_id"], r["name"], r["dose"], sched_short)
+            batch.append((r["user_id"], text, kwargs))
+        delivery.submit_batch(batch, run=run, spread=spread)
+        sent += len(batch)
+    delivery.close_run(run)
+    db.record_expected_doses(slot, sched_short)
+    _count_late("med_wheel", slot_dt, sent)
+    return sent
+
+def _drop_slots(slots, reason) -> int:
+    """Count the doses of minutes that will not be sent; they still count as expected."""
+    if not slots:
+        return 0
+    due = db.due_dose_counts()
+    dropped = 0
+    for slot_dt in slots:
+        n = due.get(slot_dt.strftime("%H:%M"))
+        if n:
+            dropped += n
+            db.record_expected_doses(slot_dt.strftime("%H:%M"), slot_dt.strftime("%Y%m%d%H%M"))
+    _REMINDERS_DROPPED.labels("med_wheel", reason).inc(dropped)
+    return dropped
+
+def _advance(slot_dt):
+    global _last_slot
+    _last_slot = slot_dt
+    db.set_state(WATERMARK, slot_dt.isoformat())
+
+def _catch_up(missed, now, resumed):
+    """Handle minutes between the last dispatched one and `now`.
+
+    A late tick in a running process always sends them. After a restart or
+    failover (`resumed`) MISSED_REMINDER_POLICY decides; minutes older than
+    MISSED_REMINDER_WINDOW are dropped in both cases.
+    """
+    oldest = now - timedelta(minutes=MISSED_REMINDER_WINDOW)
+    too_old = [m for m in missed if m < oldest]
+    recent = [m for m in missed if m >= oldest]
+    skip = resumed and MISSED_REMINDER_POLICY == "skip"
+    dropped = _drop_slots(too_old, "too_old") + (_drop_slots(recent, "skipped") if skip else 0)
+    sent = 0
+    if not skip:
+        for slot_dt in recent:
+            sent += dispatch_slot(slot_dt, spread=REMINDER_JITTER)
+            _advance(slot_dt)
+    logger.warning("reminder wheel: %d minutes without a tick; %d reminders sent late, %d dropped",
+                   len(missed), sent, dropped)
+
+def _load_watermark(tz):
+    raw = db.get_state(WATERMARK)
+    return datetime.fromisoformat(raw).astimezone(tz) if raw else None
+
+def wheel_tick():
+    tz = pytz.timezone(DEFAULT_TZ)
+    now = datetime.now(tz).replace(second=0, microsecond=0)
+    last, resumed = _last_slot, False
+    if last is None:
+        # first tick of this process (or of a new leader): carry on from the persisted minute
+        last, resumed = _load_watermark(tz), True
+    if last is not None and last >= now:
+        return  # this minute was already dispatched
+    missed = []
+    if last is not None:
+        slot_dt = tz.normalize(max(last + timedelta(minutes=1), now - _MAX_LOOKBACK))
+        while slot_dt < now:
+            missed.append(slot_dt)
+            slot_dt = tz.normalize(slot_dt + timedelta(minutes=1))
+    if missed:
+        _catch_up(missed, now, resumed)
+    dispatch_slot(now, spread=REMINDER_JITTER)
+    _advance(now)
+
+def schedule_med_wheel():
+    trigger = CronTrigger(second=0, timezone=pytz.timezone(DEFAULT_TZ))
+    scheduler.add_job(wheel_tick, trigger, id=WHEEL_JOB_ID, replace_existing=True,
+                      max_instances=1, coalesce=True, misfire_grace_time=30)
+
+# ---- Per-job reminders (REMINDER_MODE="jobs") ----
+def _med_job_specs(med):
+    """(job_id, hour, minute) for every daily time of a db.Medicine."""
+    for t in med.times:
         hour, minute = map(int, t.split(":"))
-        job_id = f"med_{med_row['med_id']}_{t}"
-        try:
-            scheduler.remove_job(job_id)
-        except Exception:
-            pass
-        trigger = CronTrigger(hour=hour, minute=minute, timezone=pytz.timezone(tzname))
-        scheduler.add_job(send_med_reminder, trigger, id=job_id, replace_existing=True,
-                          args=[med_row["med_id"], med_row["user_id"], med_row["name"], med_row["dose"]])
+        yield f"med_{med.med_id}_{t}", hour, minute
+
+def _add_med_job(med, job_id, hour, minute):
+    # APScheduler's jitter goes both ways; offsetting by half keeps every run
+    # within [minute, minute + REMINDER_JITTER] and never early
+    half = int(REMINDER_JITTER // 2)
+    trigger = CronTrigger(hour=hour, minute=minute, second=half, jitter=half or None,
+                          timezone=pytz.timezone(DEFAULT_TZ))
+    # with MISSED_REMINDER_POLICY="send", runs missed while the bot was down
+    # still fire on startup as long as they are inside the window
+    grace = MISSED_REMINDER_WINDOW * 60 if MISSED_REMINDER_POLICY == "send" else SCHEDULER_MISFIRE_GRACE
+    scheduler.add_job(send_med_reminder, trigger, id=job_id, jobstore=MED_JOBSTORE, replace_existing=True,
+                      misfire_grace_time=grace, args=[med.med_id, med.user_id, med.name, med.dose,
+                                                      f"{hour:02d}:{minute:02d}"])
+
+# med_id -> IDs of its per-dose jobs, so changing one medicine never scans the job store
+_med_jobs = {}
+_med_jobs_lock = threading.Lock()
+
+def _med_id_of(job_id):
+    return int(job_id.split("_")[1])
+
+def schedule_med_jobs_for_med(med):
+    """med is a db.Medicine"""
+    if REMINDER_MODE == "wheel":
+        return  # db.add_medicine already filled medicine_times
+    med_id = med.med_id
+    with _med_jobs_lock:
+        wanted = set()
+        for job_id, hour, minute in _med_job_specs(med):
+            _add_med_job(med, job_id, hour, minute)
+            wanted.add(job_id)
+        for job_id in (_med_jobs.get(med_id, set()) | _stored_med_job_ids(med_id)) - wanted:
+            _remove_med_job(job_id)
+        _med_jobs[med_id] = wanted
 
 def remove_med_jobs(med_id: int):
-    jobs = scheduler.get_jobs()
-    prefix = f"med_{med_id}_"
-    for j in jobs:
-        if j.id.startswith(prefix):
-            try:
-                scheduler.remove_job(j.id)
-            except Exception:
-                pass
+    if REMINDER_MODE == "wheel":
+        return  # db.delete_medicine clears medicine_times
+    with _med_jobs_lock:
+        # the store is shared with other processes, which may have added jobs this one never indexed
+        for job_id in _med_jobs.pop(med_id, set()) | _stored_med_job_ids(med_id):
+            _remove_med_job(job_id)
+
+def reschedule_med(med_id: int):
+    """Bring one medicine's jobs in line with its database row (removing them if it is gone)."""
+    med = db.get_medicine(med_id)
+    if med is None:
+        remove_med_jobs(med_id)
+    else:
+        schedule_med_jobs_for_med(med)
+
+def _remove_med_job(job_id):
+    try:
+        scheduler.remove_job(job_id, jobstore=MED_JOBSTORE)
+    except JobLookupError:
+        pass
+
+def _stored_med_job_ids(med_id: int = None):
+    """IDs of the per-dose jobs in the store (of one medicine, or all), read without unpickling them."""
+    from sqlalchemy import select
+    col = med_store.jobs_t.c.id
+    query = select([col])
+    if med_id is not None:
+        prefix = f"med_{med_id}_"
+        query = query.where(col >= prefix).where(col < prefix[:-1] + chr(ord("_") + 1))  # primary-key range
+    return {row[0] for row in med_store.engine.execute(query)}
 
 def schedule_all_meds_for_all_users():
-    meds = []
-    users = db.list_users()
-    for u in users:
-        meds += db.list_medicines(u["user_id"])
-    for med_row in meds:
-        schedule_med_jobs_for_med(med_row)
+    if REMINDER_MODE == "wheel":
+        schedule_med_wheel()
+        return
+    started = time.monotonic()
+    existing = _stored_med_job_ids()
+    index = {}
+    meds = jobs = added = 0
+    # stream medicines with one cursor; only jobs missing from the store are created
+    for rows in db.iter_all_medicines(BOOTSTRAP_CHUNK_SIZE):
+        for med in rows:
+            meds += 1
+            job_ids = index.setdefault(med.med_id, set())
+            for job_id, hour, minute in _med_job_specs(med):
+                job_ids.add(job_id)
+                jobs += 1
+                if job_id not in existing:
+                    _add_med_job(med, job_id, hour, minute)
+                    added += 1
+    stale = [j for j in existing if j not in index.get(_med_id_of(j), ())]
+    for job_id in stale:
+        _remove_med_job(job_id)
+    with _med_jobs_lock:
+        _med_jobs.clear()
+        _med_jobs.update(index)
+    logger.info("reminder bootstrap: %d medicines, %d jobs (%d added, %d removed, %d unchanged) in %.2fs",
+                meds, jobs, added, len(stale), jobs - added, time.monotonic() - started)
 
 # DAILY exercise reminder -> sends to every user at configured time
 def send_daily_exercise_reminder():
+    _observe_lag("exercise")
     now_short = short_now_tz()
-    users = db.list_users()
-    for u in users:
-        text = "🏃‍♀️ Did you complete your exercise today? Reply with the buttons.\n\nIf you already exercised, press ✅ Done. If not, press ❌ Skip. It's time to stretch some muscles!"
+    text = "🏃‍♀️ Did you complete your exercise today? Reply with the buttons.\n\nIf you already exercised, press ✅ Done. If not, press ❌ Skip. It's time to stretch some muscles!"
+    run = delivery.start_run("daily_exercise_reminder")
+    # users who blocked the bot are skipped; delivery marks new ones as they fail
+    for u in db.list_active_users():
         kb = InlineKeyboardMarkup([[
             InlineKeyboardButton("Done ✅", callback_data=f"EX|{u['user_id']}|{now_short}|done"),
             InlineKeyboardButton("Skip ❌", callback_data=f"EX|{u['user_id']}|{now_short}|skip"),
         ]])
-        try:
-            bot.send_message(chat_id=u["user_id"], text=text, reply_markup=kb)
-        except Exception:
-            # user may not have started bot or blocked it
-            pass
+        delivery.submit(u["user_id"], text, run=run, reply_markup=kb)
+    delivery.close_run(run)
 
 def schedule_daily_exercise():
     job_id = "daily_exercise_reminder"
@@ -83,3 +369,49 @@ def schedule_daily_exercise():
     tz = pytz.timezone(DEFAULT_TZ)
     trigger = CronTrigger(hour=EXERCISE_REMINDER_HOUR, minute=EXERCISE_REMINDER_MINUTE, timezone=tz)
     scheduler.add_job(send_daily_exercise_reminder, trigger, id=job_id, replace_existing=True)
+
+# ---- Retention / compaction ----
+def archive_old_rows():
+    db.archive_old_rows(RETENTION_DAYS, ARCHIVE_CHUNK_SIZE)
+
+def vacuum_when_idle():
+    # only while nothing is waiting to be written or sent
+    if delivery.depth() or db.pending_writes():
+        return
+    db.incremental_vacuum(VACUUM_PAGES)
+
+def schedule_maintenance():
+    tz = pytz.timezone(DEFAULT_TZ)
+    if RETENTION_DAYS:
+        scheduler.add_job(archive_old_rows, CronTrigger(hour=ARCHIVE_HOUR, minute=ARCHIVE_MINUTE, timezone=tz),
+                          id="archive_old_rows", replace_existing=True, max_instances=1, coalesce=True,
+                          misfire_grace_time=3600)
+    # half past each minute, clear of the reminder wheel's tick
+    scheduler.add_job(vacuum_when_idle, CronTrigger(second=30, timezone=tz), id="incremental_vacuum",
+                      replace_existing=True, max_instances=1, coalesce=True)
+
+# ---- Leader election (LEADER_ELECTION=1) ----
+elector = None
+
+def _on_elected():
+    global _last_slot
+    _last_slot = None   # resume from the watermark the previous leader left
+    scheduler.resume()
+
+def _on_lease_heartbeat():
+    if REMINDER_MODE == "jobs":
+        scheduler.wakeup()  # pick up jobs other processes added to the shared job store
+
+def start_leader_election():
+    """Run the scheduler only while this process holds the "scheduler" lease."""
+    global elector
+    if not LEADER_ELECTION:
+        return
+    elector = LeaderElector("scheduler", ttl=LEADER_LEASE_TTL, heartbeat=LEADER_HEARTBEAT,
+                            on_elected=_on_elected, on_demoted=scheduler.pause,
+                            on_heartbeat=_on_lease_heartbeat)
+    elector.start()
+
+def stop_leader_election():
+    if elector is not None:
+        elector.stop()
@@ -0,0 +1,97 @@
+"""Inbound flood control, run by OrderedDispatcher before an update is queued on a handler lane.
+
+An update is dropped before any lane (and so db.py) sees it when
+- it repeats a callback tap (same user, message and data) within THROTTLE_CALLBACK_WINDOW,
+- its user has used up their token bucket (THROTTLE_RATE per second, bursts of THROTTLE_BURST), or
+- the handler lanes hold more than THROTTLE_MAX_PENDING updates and its user has
+  been busy lately (bucket below half full); users sending the odd message still
+  get through, so a flood mostly slows down the user causing it.
+A dropped callback tap is answered through `answer` (e.g. the delivery queue),
+so its button stops spinning; at most one per user per ANSWER_INTERVAL, so a
+tapping flood does not turn into an API call flood.
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Optional
+
+import metrics
+
+THROTTLED = metrics.Counter("healthbot_updates_throttled_total",
+                            "Updates dropped by flood control before reaching a handler.", ["reason"])
+ANSWER_INTERVAL = 1.0   # seconds between answers to one user's dropped taps
+
+
+class Throttle:
+    def __init__(self, rate: float, burst: float, max_pending: int = 0, callback_window: float = 0.0,
+                 depth: Optional[Callable[[], int]] = None, answer: Optional[Callable] = None):
+        self.rate = rate                      # tokens per second per user; <= 0 turns the buckets off
+        self.burst = max(burst, 1.0)
+        self.max_pending = max_pending        # <= 0 turns load shedding off
+        self.callback_window = callback_window
+        self.depth = depth                    # updates waiting on the handler lanes
+        self.answer = answer                  # answer(callback_query), must not block
+        self._buckets = OrderedDict()         # user_id -> (tokens, last refill), least recently seen first
+        self._taps = OrderedDict()            # (user_id, message, data) -> first tap, oldest first
+        self._answered = OrderedDict()        # user_id -> last answered drop, oldest first
+        self._lock = threading.Lock()
+        self._dropped = {r: THROTTLED.labels(r) for r in ("duplicate", "rate", "overload")}
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def check(self, update) -> Optional[str]:
+        """None if `update` may go on to the handlers, else the reason it is dropped."""
+        user = update.effective_user
+        if user is None:
+            return None
+        now = time.monotonic()
+        overloaded = self.max_pending > 0 and self.depth is not None and self.depth() > self.max_pending
+        q = update.callback_query
+        with self._lock:
+            if q is not None and self.callback_window > 0:
+                while self._taps and next(iter(self._taps.values())) <= now - self.callback_window:
+                    self._taps.popitem(last=False)
+                key = (user.id, q.message.message_id if q.message else q.inline_message_id, q.data)
+                if key in self._taps:
+                    return "duplicate"
+                self._taps[key] = now
+            if self.rate <= 0:
+                return "overload" if overloaded else None
+            # a bucket left alone this long is full again, as good as a new one
+            idle = self.burst / self.rate
+            while self._buckets and next(iter(self._buckets.values()))[1] <= now - idle:
+                self._buckets.popitem(last=False)
+            tokens, last = self._buckets.pop(user.id, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            reason = None
+            if tokens < 1:
+                reason = "rate"
+            elif overloaded and tokens < self.burst / 2:
+                reason = "overload"
+            else:
+                tokens -= 1
+            self._buckets[user.id] = (tokens, now)
+            return reason
+
+    def admit(self, update) -> bool:
+        """False if `update` is dropped; OrderedDispatcher calls this before queueing it."""
+        reason = self.check(update)
+        if reason is None:
+            return True
+        self._dropped[reason].inc()
+        q = update.callback_query
+        # unanswered, the button keeps spinning until Telegram gives up, inviting another tap
+        if q is not None and self.answer is not None and self._may_answer(update.effective_user.id):
+            self.answer(q)
+        return False
+
+    def _may_answer(self, user_id) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            while self._answered and next(iter(self._answered.values())) <= now - ANSWER_INTERVAL:
+                self._answered.popitem(last=False)
+            if user_id in self._answered:
+                return False
+            self._answered[user_id] = now
+            return True